@@ -0,0 +1,326 @@
+"""
+    A stand-in Matrix homeserver for benchmarking. It serves just enough of
+    the client-server API (login, whoami, filters, sync, messages, members
+    and send) for Nitrix to log in, paint its rooms, page through history
+    and receive bursts of new events.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+import asyncio
+import threading
+
+from aiohttp import web
+
+API = "/_matrix/client/v3"
+
+
+class FakeRoom():
+    """A room with a generated history that can grow while the benchmark runs"""
+
+    # Only the first few members ever talk
+    SENDERS = 4
+
+    def __init__(self, room_id: str, name: str, members: list[str], messages: int, start_ts: int):
+        self.room_id = room_id
+        self.name = name
+        self.members = members
+        self.events: list[dict] = []
+        senders = members[:self.SENDERS]
+        for i in range(messages):
+            self.add_message(senders[i % len(senders)], f"Message {i} in {name}", start_ts + i * 1000)
+
+    def add_message(self, sender: str, body: str, ts: int | None = None) -> dict:
+        """Append a text message to the room's history
+
+        Args:
+            sender (str): The user ID sending the message
+            body (str): The message body
+            ts (int | None, optional): Server timestamp in milliseconds. Defaults to now.
+
+        Returns:
+            dict: The event
+        """
+        event = {
+            "event_id": f"${self.room_id[1:].split(':')[0]}_{len(self.events)}",
+            "type": "m.room.message",
+            "sender": sender,
+            "origin_server_ts": ts or int(time.time() * 1000),
+            "content": {"msgtype": "m.text", "body": body},
+        }
+        self.events.append(event)
+        return event
+
+    def state(self, members: set[str] | None = None) -> list[dict]:
+        """The room's state events
+
+        Args:
+            members (set[str] | None, optional): Only include these members, e.g. when lazy loading. Defaults to all of them.
+        """
+        events = [
+            {"type": "m.room.create", "state_key": "", "sender": self.members[0],
+             "event_id": f"$create_{self.room_id}", "origin_server_ts": 0,
+             "content": {"creator": self.members[0]}},
+            {"type": "m.room.name", "state_key": "", "sender": self.members[0],
+             "event_id": f"$name_{self.room_id}", "origin_server_ts": 0,
+             "content": {"name": self.name}},
+        ]
+        for member in self.members:
+            if members is not None and member not in members:
+                continue
+            events.append({
+                "type": "m.room.member", "state_key": member, "sender": member,
+                "event_id": f"$member_{self.room_id}_{member}", "origin_server_ts": 0,
+                "content": {"membership": "join", "displayname": member[1:].split(":")[0]},
+            })
+        return events
+
+
+class FakeHomeserver():
+    """aiohttp application pretending to be a homeserver with generated rooms
+
+    Args:
+        rooms (int, optional): Number of joined rooms. Defaults to 50.
+        messages (int, optional): History length of every room. Defaults to 1000.
+        members (int, optional): Members of every room. Defaults to 50.
+        timeline_limit (int, optional): Events per room in the initial sync. Defaults to 10.
+        latency (float, optional): Seconds added to every request. Defaults to 0.
+    """
+
+    USER_ID = "@bench:localhost"
+    PASSWORD = "bench"
+
+    def __init__(self, rooms: int = 50, messages: int = 1000, members: int = 50, timeline_limit: int = 10, latency: float = 0):
+        self.timeline_limit = timeline_limit
+        self.latency = latency
+        start_ts = int(time.time() * 1000) - messages * 1000
+        members = [self.USER_ID, "@alice:localhost", "@bob:localhost", "@carol:localhost"] + [
+            f"@user{i}:localhost" for i in range(max(0, members - 4))]
+        self.rooms = {
+            f"!room{i}:localhost": FakeRoom(f"!room{i}:localhost", f"Room {i}", members, messages, start_ts)
+            for i in range(rooms)
+        }
+
+        # Room and history index of the events waiting for the next
+        # incremental sync, in order
+        self.pending: list[tuple[str, int]] = []
+        self.batch = 0
+        self._wakeup = asyncio.Event()
+        self.filters: dict[str, dict] = {}
+        self.requests: dict[str, int] = {}
+        self.bytes_sent: dict[str, int] = {}
+        self.initial_sync_bytes = 0
+
+        self.app = web.Application()
+        self.app.router.add_post(f"{API}/login", self.login)
+        self.app.router.add_get(f"{API}/account/whoami", self.whoami)
+        self.app.router.add_post(f"{API}/user/{{user_id}}/filter", self.upload_filter)
+        self.app.router.add_get(f"{API}/sync", self.sync)
+        self.app.router.add_get(f"{API}/rooms/{{room_id}}/messages", self.messages)
+        self.app.router.add_get(f"{API}/rooms/{{room_id}}/joined_members", self.joined_members)
+        self.app.router.add_put(f"{API}/rooms/{{room_id}}/send/{{event_type}}/{{txn_id}}", self.send)
+        self.app.router.add_route("*", "/{tail:.*}", self.unrecognized)
+        self.runner = None
+        self.url = None
+        self.loop = None
+        self.thread = None
+
+    async def start(self) -> str:
+        """Start serving on a free local port
+
+        Returns:
+            str: The homeserver URL
+        """
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def start_in_thread(self) -> str:
+        """Serve from a thread with its own event loop, so the homeserver's
+        work doesn't show up as lag in the client being measured
+
+        Returns:
+            str: The homeserver URL
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        return asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def inject_threadsafe(self, room_id: str, count: int) -> str:
+        """Call `inject` on the homeserver's thread from another event loop
+
+        Args:
+            room_id (str): The room to send the messages to
+            count (int): How many messages to send
+
+        Returns:
+            str: The event ID of the last message sent
+        """
+        async def inject():
+            self.inject(room_id, count)
+            return self.rooms[room_id].events[-1]["event_id"]
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(inject(), self.loop))
+
+    def inject(self, room_id: str, count: int, sender: str = "@alice:localhost"):
+        """Queue new messages for the next sync
+
+        Args:
+            room_id (str): The room to send them to
+            count (int): How many messages to send
+            sender (str, optional): Who sends them. Defaults to "@alice:localhost".
+        """
+        room = self.rooms[room_id]
+        for _ in range(count):
+            room.add_message(sender, f"Burst message {len(room.events)}")
+            self.pending.append((room_id, len(room.events) - 1))
+        self._wakeup.set()
+
+    async def _received(self, request: web.Request):
+        # Count requests per endpoint and simulate the network
+        endpoint = request.match_info.route.resource.canonical
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def login(self, request: web.Request) -> web.Response:
+        await self._received(request)
+        body = await request.json()
+        if body.get("password") != self.PASSWORD:
+            return web.json_response({"errcode": "M_FORBIDDEN", "error": "Invalid password"}, status=403)
+        return web.json_response({
+            "user_id": self.USER_ID,
+            "access_token": "bench_token",
+            "device_id": body.get("device_id") or "BENCH",
+        })
+
+    async def whoami(self, request: web.Request) -> web.Response:
+        await self._received(request)
+        return web.json_response({"user_id": self.USER_ID})
+
+    async def upload_filter(self, request: web.Request) -> web.Response:
+        await self._received(request)
+        filter_id = str(len(self.filters))
+        self.filters[filter_id] = await request.json()
+        return web.json_response({"filter_id": filter_id})
+
+    def _json(self, request: web.Request, body: dict) -> web.Response:
+        # Keep track of how much each endpoint sends
+        response = web.json_response(body)
+        endpoint = request.match_info.route.resource.canonical
+        self.bytes_sent[endpoint] = self.bytes_sent.get(endpoint, 0) + len(response.body)
+        return response
+
+    def _sync_filter(self, request: web.Request) -> dict:
+        value = request.query.get("filter")
+        if not value:
+            return {}
+        if value in self.filters:
+            return self.filters[value]
+        return json.loads(value)
+
+    def _room_info(self, room: FakeRoom, timeline: list[dict], prev_batch: str, state: list[dict] | None = None) -> dict:
+        return {
+            "timeline": {"events": timeline, "limited": bool(state), "prev_batch": prev_batch},
+            "state": {"events": state or []},
+            "ephemeral": {"events": []},
+            "account_data": {"events": []},
+            "unread_notifications": {"notification_count": 0, "highlight_count": 0},
+            "summary": {
+                "m.heroes": [member for member in room.members[:5] if member != self.USER_ID],
+                "m.joined_member_count": len(room.members),
+                "m.invited_member_count": 0,
+            },
+        }
+
+    async def sync(self, request: web.Request) -> web.Response:
+        await self._received(request)
+        if "since" not in request.query:
+            # Initial sync, the latest events of every room plus its state.
+            # Lazy loading only sends the members that sent those events
+            room_filter = self._sync_filter(request).get("room", {})
+            limit = room_filter.get("timeline", {}).get("limit", self.timeline_limit)
+            lazy_load_members = room_filter.get("state", {}).get("lazy_load_members", False)
+            join = {}
+            for room_id, room in self.rooms.items():
+                start = max(0, len(room.events) - limit)
+                timeline = room.events[start:]
+                members = {event["sender"] for event in timeline} | {self.USER_ID} if lazy_load_members else None
+                join[room_id] = self._room_info(room, timeline, f"t{start}", room.state(members))
+            self.pending.clear()
+            response = self._json(request, {"next_batch": f"s{self.batch}", "rooms": {"join": join}})
+            self.initial_sync_bytes = len(response.body)
+            return response
+
+        if not self.pending:
+            timeout = int(request.query.get("timeout", 0)) / 1000
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        join = {}
+        for room_id, index in self.pending:
+            if room_id not in join:
+                join[room_id] = self._room_info(self.rooms[room_id], [], f"t{index}")
+            join[room_id]["timeline"]["events"].append(self.rooms[room_id].events[index])
+        self.pending = []
+        self.batch += 1
+        return self._json(request, {"next_batch": f"s{self.batch}", "rooms": {"join": join}})
+
+    async def messages(self, request: web.Request) -> web.Response:
+        await self._received(request)
+        room = self.rooms.get(request.match_info["room_id"])
+        if room is None:
+            return web.json_response({"errcode": "M_FORBIDDEN", "error": "Not in room"}, status=403)
+        token = request.query.get("from", "")
+        end = int(token[1:]) if token.startswith("t") else len(room.events)
+        limit = int(request.query.get("limit", 10))
+        start = max(0, end - limit)
+        response = {"chunk": room.events[start:end][::-1], "start": token}
+        if start:
+            response["end"] = f"t{start}"
+        return self._json(request, response)
+
+    async def joined_members(self, request: web.Request) -> web.Response:
+        await self._received(request)
+        room = self.rooms.get(request.match_info["room_id"])
+        if room is None:
+            return web.json_response({"errcode": "M_FORBIDDEN", "error": "Not in room"}, status=403)
+        return self._json(request, {"joined": {
+            member: {"display_name": member[1:].split(":")[0], "avatar_url": None}
+            for member in room.members
+        }})
+
+    async def send(self, request: web.Request) -> web.Response:
+        await self._received(request)
+        room_id = request.match_info["room_id"]
+        if room_id not in self.rooms:
+            return web.json_response({"errcode": "M_FORBIDDEN", "error": "Not in room"}, status=403)
+        body = await request.json()
+        room = self.rooms[room_id]
+        event = room.add_message(self.USER_ID, body.get("body", ""))
+        event["content"] = body
+        self.pending.append((room_id, len(room.events) - 1))
+        self._wakeup.set()
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def unrecognized(self, request: web.Request) -> web.Response:
+        return web.json_response({"errcode": "M_UNRECOGNIZED", "error": "Unrecognized request"}, status=404)
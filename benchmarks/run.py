@@ -0,0 +1,302 @@
+"""
+    End to end benchmarks of Nitrix against a local stand-in homeserver.
+    The real client factory, app and screens are driven headless through
+    Textual's pilot, and the results are compared with a stored baseline.
+
+    python -m benchmarks [--rooms 50] [--messages 1000] [--members 50] [--burst 20] [--save-baseline]
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+from pathlib import Path
+
+from benchmarks.homeserver import FakeHomeserver
+from nitrix.metrics import LagProbe
+
+BASELINE = Path(__file__).parent / "baseline.json"
+
+# Metric name -> (unit, whether higher is better)
+METRICS = {
+    "cold_start": ("s", False),
+    "time_to_first_paint": ("s", False),
+    "initial_sync_size": ("KB", False),
+    "room_switch_p50": ("s", False),
+    "room_switch_p95": ("s", False),
+    "sustained_events_per_sec": ("ev/s", True),
+    "peak_rss": ("MB", False),
+}
+
+# Event rates tried when looking for the point the UI starts lagging
+RATES = [100, 200, 500, 1000, 2000, 5000, 10000, 20000]
+
+
+async def wait_for(condition, timeout: float = 60, interval: float = 0.001):
+    """Wait until a condition holds
+
+    Args:
+        condition (Callable[[], bool]): The condition to wait for
+        timeout (float, optional): Seconds to wait before giving up. Defaults to 60.
+        interval (float, optional): Seconds between checks. Defaults to 0.001.
+
+    Raises:
+        TimeoutError: The condition didn't hold in time
+    """
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Timed out waiting for the UI")
+        await asyncio.sleep(interval)
+
+
+async def next_frame(widget):
+    """Wait until the widget has been refreshed on screen
+
+    Args:
+        widget (Widget): The widget to wait for
+    """
+    future = asyncio.get_event_loop().create_future()
+    widget.call_after_refresh(lambda: future.done() or future.set_result(None))
+    widget.refresh()
+    await future
+
+
+def peak_rss() -> float | None:
+    """Peak resident set size of the process in megabytes, None where unsupported"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def measure_cold_start() -> float | None:
+    """Launch nitrix in a fresh interpreter and time how long it takes to
+    paint the login form, as reported by `--profile-startup`
+
+    Returns:
+        float | None: Seconds, None if nitrix didn't report
+    """
+    with tempfile.TemporaryDirectory() as home:
+        result = subprocess.run(
+            [sys.executable, "-m", "nitrix", "--profile-startup"],
+            env={**os.environ, "HOME": home, "LOCALAPPDATA": home},
+            stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=60,
+        )
+    match = re.search(r"first paint\s+([\d.]+) ms", result.stderr)
+    return float(match.group(1)) / 1000 if match else None
+
+
+async def measure_first_paint(app, rooms: int) -> None:
+    """Wait until the main screen has painted the whole room list"""
+    from nitrix.screens import MainScreen
+
+    def painted():
+        if not isinstance(app.screen, MainScreen):
+            return False
+        return len(app.screen.query_one("RoomsContainer").buttons) == rooms
+
+    await wait_for(painted)
+    await next_frame(app.screen)
+
+
+async def measure_room_switches(app, switches: int) -> list[float]:
+    """Switch to rooms that haven't been opened yet, timing each until its
+    messages are on screen
+
+    Returns:
+        list[float]: Seconds per switch
+    """
+    rooms_container = app.screen.query_one("RoomsContainer")
+    messages_container = app.screen.query_one("MessagesContainer")
+    timeline = messages_container.query_one("MessageTimeline")
+    room_ids = list(rooms_container.buttons)
+    step = max(1, len(room_ids) // switches)
+
+    latencies = []
+    for room_id in room_ids[::step][:switches]:
+        start = time.perf_counter()
+        rooms_container.buttons[room_id].value = True
+
+        def shown():
+            layout = messages_container.layouts.get(room_id)
+            return layout is not None and timeline.room_layout is layout and len(layout) > 0
+
+        await wait_for(shown)
+        await next_frame(timeline)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def measure_throughput(app, server: FakeHomeserver, burst: int, duration: float, max_lag: float) -> float:
+    """Push ever faster bursts of events into the open room until the UI
+    can't keep up
+
+    Args:
+        burst (int): Events sent per burst
+        duration (float): Seconds to hold each rate for
+        max_lag (float): The 95th percentile event loop lag, in seconds, counted as lagging
+
+    Returns:
+        float: The highest event rate the UI kept up with
+    """
+    messages_container = app.screen.query_one("MessagesContainer")
+    room_id = app.current_room
+    probe = LagProbe()
+    probe.start()
+
+    sustained = 0.0
+    try:
+        for rate in RATES:
+            probe.reset()
+            start = time.perf_counter()
+            sent = 0
+            while time.perf_counter() - start < duration:
+                last_event = await server.inject_threadsafe(room_id, burst)
+                sent += burst
+                # Keep to the schedule however late the loop gets back to us
+                await asyncio.sleep(max(0, start + sent / rate - time.perf_counter()))
+
+            try:
+                await wait_for(lambda: last_event in messages_container.messages[room_id], timeout=1)
+            except TimeoutError:
+                break
+            if probe.percentile(95) > max_lag:
+                break
+            sustained = rate
+    finally:
+        probe.stop()
+    return sustained
+
+
+async def run(options: argparse.Namespace) -> dict:
+    """Run every benchmark once
+
+    Returns:
+        dict: The measured metrics
+    """
+    cold_start = measure_cold_start()
+    server = FakeHomeserver(options.rooms, options.messages, options.members, latency=options.latency)
+    url = server.start_in_thread()
+
+    with tempfile.TemporaryDirectory() as home:
+        # Keep the config and store of the benchmark account away from the real ones
+        os.environ["HOME"] = home
+        os.environ["LOCALAPPDATA"] = home
+
+        from nitrix.app import NitrixApp
+        from nitrix.utils import NitrixConfig
+
+        NitrixConfig().add_configs("Credentials", {
+            "homeserver": url,
+            "username": "bench",
+            "password": FakeHomeserver.PASSWORD,
+        })
+        if options.set:
+            NitrixConfig().add_configs("Performance", dict(setting.split("=", 1) for setting in options.set))
+
+        # Saved credentials log straight in when the app starts
+        app = NitrixApp()
+        start = time.perf_counter()
+        async with app.run_test(headless=True, size=(120, 40)):
+            await measure_first_paint(app, options.rooms)
+            first_paint = time.perf_counter() - start
+            switches = await measure_room_switches(app, options.switches)
+            sustained = await measure_throughput(
+                app, server, options.burst, options.duration, options.max_lag)
+            client = app.client
+
+        client.stop_sync_forever()
+        await client.close()
+        client.event_store.close()
+
+    # Whatever the client left running is of no interest anymore
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    server.stop_thread()
+
+    return {
+        "cold_start": cold_start,
+        "time_to_first_paint": first_paint,
+        "initial_sync_size": server.initial_sync_bytes / 1024,
+        "room_switch_p50": statistics.median(switches),
+        "room_switch_p95": sorted(switches)[min(len(switches) - 1, int(len(switches) * 0.95))],
+        "sustained_events_per_sec": sustained,
+        "peak_rss": peak_rss(),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Find the metrics that got worse than the baseline by more than the tolerance
+
+    Args:
+        results (dict): The metrics just measured
+        baseline (dict): The stored metrics
+        tolerance (float): Allowed relative change, e.g. 0.25 for 25%
+
+    Returns:
+        list[str]: Descriptions of the regressions
+    """
+    regressions = []
+    for name, (unit, higher_is_better) in METRICS.items():
+        current, previous = results.get(name), baseline.get(name)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{name}: {previous:.3f}{unit} -> {current:.3f}{unit} ({change:+.0%})")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=50, help="Joined rooms")
+    parser.add_argument("--messages", type=int, default=1000, help="History length of every room")
+    parser.add_argument("--members", type=int, default=50, help="Members of every room")
+    parser.add_argument("--burst", type=int, default=20, help="Events per burst while measuring throughput")
+    parser.add_argument("--duration", type=float, default=2, help="Seconds each event rate is held for")
+    parser.add_argument("--switches", type=int, default=10, help="Room switches to time")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds of simulated network latency per request")
+    parser.add_argument("--max-lag", type=float, default=0.05, help="Event loop lag in seconds counted as the UI lagging")
+    parser.add_argument("--set", action="append", metavar="KEY=VALUE", help="Performance config to run with, can be repeated")
+    parser.add_argument("--baseline", type=Path, default=BASELINE, help="Baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    options = parser.parse_args(argv)
+
+    params = {key: getattr(options, key) for key in ("rooms", "messages", "members", "burst", "duration", "switches", "latency", "max_lag", "set")}
+    results = asyncio.run(run(options))
+
+    for name, (unit, _) in METRICS.items():
+        value = results[name]
+        print(f"{name:<26} {'n/a' if value is None else f'{value:.3f}'} {unit}")
+
+    if options.save_baseline:
+        options.baseline.write_text(json.dumps({"params": params, "results": results}, indent=4) + "\n")
+        print(f"Saved baseline to {options.baseline}")
+        return 0
+
+    if not options.baseline.exists():
+        return 0
+    baseline = json.loads(options.baseline.read_text())
+    if baseline.get("params") != params:
+        print("Baseline was recorded with different parameters, not comparing")
+        return 0
+    regressions = compare(results, baseline["results"], options.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
@@ -1,5 +1,25 @@
-from nitrix.app import NitrixApp
+import sys
+
+from nitrix.startup import startup
 
 def main():
+    # The headless streaming mode never loads Textual
+    if sys.argv[1:2] == ["tail"]:
+        from nitrix.tail import main as tail
+        sys.exit(tail(sys.argv[2:]))
+    if sys.argv[1:2] == ["replay"]:
+        from nitrix.replay import main as replay
+        sys.exit(replay(sys.argv[2:]))
+
+    startup.enabled = "--profile-startup" in sys.argv[1:]
+    from nitrix.app import NitrixApp
+    startup.mark("imports")
     app = NitrixApp()
-    app.run()
\ No newline at end of file
+    # Profiling without a terminal, e.g. from a script, still renders everything
+    app.run(headless=startup.enabled and not sys.stdout.isatty())
+    if startup.enabled:
+        print(startup.report(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
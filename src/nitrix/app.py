@@ -1,20 +1,48 @@
+from __future__ import annotations
+
+import time
+import typing
+import asyncio
+import importlib
+
+from textual import events
 from textual.app import App
-from textual.widgets import Header, Footer, Placeholder, Tree
+from textual.widgets import Header, Footer
 from textual.message import Message
 
-from nio import AsyncClient, MatrixRoom, RoomMessageText
-from nio.responses import SyncResponse
+from nitrix.metrics import metrics
+from nitrix.utils import NitrixConfig
+
+if typing.TYPE_CHECKING:
+    from nio import AsyncClient, MatrixRoom
+    from nio.responses import SyncError, SyncResponse
+
+# Loaded once logging in starts, see `NitrixApp.start_session`
+SESSION_MODULES = ("nitrix.client", "nitrix.connections", "nitrix.sync", "nitrix.media")
+
+
+def login_screen():
+    from nitrix.screens.login.screen import LoginScreen
+    return LoginScreen()
+
+
+def main_screen():
+    from nitrix.screens.main.screen import MainScreen
+    return MainScreen()
 
-from nitrix.screens import LoginScreen, MainScreen
 
 class NitrixApp(App):
     BINDINGS = [
         ("q", "quit", "Quit"),
     ]
     
+    # time.monotonic() of the last key press or mouse event
+    last_input = 0.0
+    
+    # Screens, and everything they import, are only loaded when first shown
     SCREENS = {
-        "login": LoginScreen(),
-        "main": MainScreen(),
+        "login": login_screen,
+        "main": main_screen,
     }
     
     def compose(self):
@@ -22,24 +50,162 @@ class NitrixApp(App):
         yield Footer()
         
     def on_mount(self):
+        # The main account, then every other logged in account
         self.client: AsyncClient = None
+        self.clients: list[AsyncClient] = []
         self.current_room = None
+        # Shared by the accounts, so they don't each bring their own
+        # connections, sync thread, media cache and sender cache. Set up by `start_session`
+        self.connections = None
+        self.sync_thread = None
+        self.media = None
+        self.senders = None
+        
+        config = NitrixConfig()
+        metrics.configure(
+            config.get_flag("Performance", "metrics"),
+            config.get_config("Performance", "metrics_export"),
+        )
+        self.set_interval(5, metrics.flush)
+        
         self.push_screen("login")
         
-    class ClientUpdate(Message):
-        def __init__(self, room: MatrixRoom, message: RoomMessageText):
-            self.room = room
-            self.message = message
+    async def on_unmount(self):
+        for client in self.clients:
+            await client.close()
+        if self.connections is None:
+            # Never got as far as logging in
+            return
+        await self.sync_thread.stop()
+        await self.connections.close()
+        self.media.close()
+        
+    async def start_session(self):
+        """Load nio, aiohttp and the rest of the Matrix side of the app, and
+        set up what the accounts share. Waits until logging in starts, so the
+        login form doesn't wait on any of it.
+        """
+        if self.connections is not None:
+            return
+        with metrics.timer("startup.session_imports"):
+            # Importing takes a while, which the event loop needn't sit through
+            for name in SESSION_MODULES:
+                await asyncio.to_thread(importlib.import_module, name)
+        from nitrix.connections import ConnectionPool
+        from nitrix.media import media_downloader
+        from nitrix.members import SenderCache
+        from nitrix.sync import SyncThread
+        
+        self.connections = ConnectionPool()
+        self.sync_thread = SyncThread()
+        # Attachments are cached once for every account
+        config = NitrixConfig()
+        self.media = media_downloader(config)
+        # Names and colours of message senders, for every room of every account
+        self.senders = SenderCache(int(config.get_config("Performance", "sender_cache_size") or SenderCache.MAX_ENTRIES))
+        
+    def add_client(self, client: AsyncClient):
+        """Add a logged in account, the first one becoming the main account
+
+        Args:
+            client (AsyncClient): The account's client
+        """
+        from nio.responses import SyncError, SyncResponse
+        
+        if self.client is None:
+            self.client = client
+        self.clients.append(client)
+        client.add_response_callback(self.sync_callback, SyncResponse)
+        # Accounts other than the main one log in with the main screen already up
+        self.screen.post_message(self.AccountAdded(client))
+        client.add_response_callback(lambda response: self.sync_error_callback(client, response), SyncError)
+        
+    def client_for(self, room_id: str | None) -> AsyncClient:
+        """Get the account a room is shown for. Rooms joined by more than
+        one account are shown for the first of them.
+
+        Args:
+            room_id (str | None): The room ID
+
+        Returns:
+            AsyncClient: The account's client, the main account for unknown rooms
+        """
+        for client in self.clients:
+            if room_id in client.rooms:
+                return client
+        return self.client
+    
+    def get_room(self, room_id: str) -> MatrixRoom | None:
+        return self.client_for(room_id).rooms.get(room_id)
+    
+    @property
+    def rooms(self) -> dict[str, MatrixRoom]:
+        """The joined rooms of every account"""
+        rooms = {}
+        for client in reversed(self.clients):
+            rooms.update(client.rooms)
+        return rooms
+        
+    def account_name(self, room_id: str) -> str:
+        """Short name of the account a room is shown for, to tell rooms
+        apart when logged in to more than one
+
+        Args:
+            room_id (str): The room ID
+
+        Returns:
+            str: The localpart of the account's user ID
+        """
+        return self.client_for(room_id).user_id[1:].split(":")[0]
+        
+    async def on_event(self, event: events.Event):
+        # Work done in the background, like prewarming rooms, waits for
+        # the keys and the mouse to go quiet
+        if isinstance(event, events.InputEvent):
+            self.last_input = time.monotonic()
+        await super().on_event(event)
+        
+    def idle_for(self) -> float:
+        """Seconds since the last key press or mouse event"""
+        return time.monotonic() - self.last_input
+        
+    def _register(self, parent, *widgets, **kwargs):
+        # Every widget mount goes through here
+        metrics.increment("widgets.mounted", len(widgets))
+        return super()._register(parent, *widgets, **kwargs)
+        
+    class AccountAdded(Message):
+        def __init__(self, client: AsyncClient):
+            self.client = client
             super().__init__()
+            
+    class SyncUpdate(Message):
+        def __init__(self, response: SyncResponse, received: float):
+            self.response = response
+            self.received = received
+            super().__init__()
+            
+    def sync_callback(self, response: SyncResponse):
+        """Response callback for the Matrix client to refer back to after every sync.
+        The whole response is delivered as one update, so its timeline events
+        reach the screen batched per room rather than one message at a time.
+
+        Args:
+            response (SyncResponse): The sync response
+        """
+        self.screen.post_message(self.SyncUpdate(response, time.perf_counter()))
         
-    def room_message_callback(self, room: MatrixRoom, message: RoomMessageText):
-        """Callback for the Matrix client to refer back to
+    def sync_error_callback(self, client: AsyncClient, response: SyncError):
+        """Response callback for failed syncs, reporting the ones the account stops syncing on
 
         Args:
-            room (MatrixRoom): Matrix room object
-            message (RoomMessageText): Room message text object
+            client (AsyncClient): The account that failed to sync
+            response (SyncError): The error
         """
-        self.screen.post_message(self.ClientUpdate(room, message))
+        from nitrix.sync import SyncEngine
+        
+        if response.status_code in SyncEngine.FATAL_ERRORS:
+            self.notify(f"Stopped syncing {client.user_id}: {response.message}", severity="error", timeout=30)
         
         
 if __name__ == "__main__":
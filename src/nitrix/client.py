@@ -1,30 +1,247 @@
+import json
 import asyncio
 
-from nio import AsyncClient
-from aiohttp import InvalidURL
+from nio import AsyncClient, ErrorResponse, UploadFilterError, WhoamiError
+from nio.responses import SyncResponse
+from aiohttp import ClientError, InvalidURL
+
+from nitrix.connections import ConnectionPool
+from nitrix.gaps import GapFiller
+from nitrix.metrics import metrics
+from nitrix.scheduler import RequestScheduler
+from nitrix.outbox import Outbox
+from nitrix.receipts import ReadReceipts, TypingNotifier
+from nitrix.recording import TrafficRecorder
+from nitrix.spaces import SpaceCache
+from nitrix.store import EventStore
+from nitrix.sync import SyncEngine, SyncThread
+from nitrix.utils import NitrixConfig
 
 # def sync_forever(client):
 #     asyncio.run(client.sync_forever(timeout=30000))
 
-async def client_factory(homeserver: str, username: str, password: str) -> AsyncClient | None:
-    client = AsyncClient(
+# Ephemeral events kept: read receipts, ours included, and who's typing
+EPHEMERAL_TYPES = ["m.receipt", "m.typing"]
+
+# Timeline events the client does anything with. Everything else stays
+# on the homeserver instead of being sent and parsed just to be dropped
+TIMELINE_TYPES = [
+    "m.room.message",
+    "m.room.encrypted",
+    "m.room.member",
+    "m.room.name",
+    "m.room.canonical_alias",
+    "m.space.child",
+    "m.space.parent",
+]
+
+# Errors saying the saved access token is no good anymore. Anything else,
+# like rate limiting or the homeserver having a bad minute, keeps it
+DEAD_TOKEN_ERRORS = {"M_UNKNOWN_TOKEN", "M_MISSING_TOKEN"}
+
+def sync_filter(config: NitrixConfig, timeline_limit: int | None = None, timeline_types: list[str] | None = TIMELINE_TYPES) -> dict | None:
+    """Build the sync filter described by the Performance section of the config
+
+    Args:
+        config (NitrixConfig): The configuration
+        timeline_limit (int | None, optional): Events per room per sync, overriding the config. Defaults to None.
+        timeline_types (list[str] | None, optional): Timeline event types to sync, None for every type. Defaults to TIMELINE_TYPES.
+
+    Returns:
+        dict | None: The filter definition, None to sync unfiltered
+    """
+    if not config.get_flag("Performance", "sync_filter", default=True):
+        return None
+    lazy_load_members = config.get_flag("Performance", "lazy_load_members", default=True)
+    nothing = {"not_types": ["*"]}
+    timeline = {
+        "limit": timeline_limit or int(config.get_config("Performance", "sync_timeline_limit") or 20),
+        "lazy_load_members": lazy_load_members,
+    }
+    if timeline_types is not None:
+        timeline["types"] = timeline_types
+    return {
+        "presence": nothing,
+        "account_data": nothing,
+        "room": {
+            "state": {"lazy_load_members": lazy_load_members},
+            "timeline": timeline,
+            "ephemeral": {"types": EPHEMERAL_TYPES},
+            "account_data": nothing,
+        },
+    }
+
+class NitrixClient(AsyncClient):
+    """AsyncClient that persists its session, rooms and timeline in an
+    `EventStore`, queues history requests through a `RequestScheduler`,
+    sends messages through an `Outbox`, fills the holes limited syncs leave
+    in room history with a `GapFiller`, batches read receipts and typing
+    notifications, keeps the Space hierarchies that were opened and, given
+    a `SyncEngine`, syncs off the UI's event loop
+    """
+
+    def __init__(self, *args, event_store: EventStore, scheduler: RequestScheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.event_store = event_store
+        self.scheduler = scheduler
+        self.sync_engine: SyncEngine | None = None
+        self.outbox = Outbox(self, event_store)
+        self.receipts = ReadReceipts(self)
+        self.typing = TypingNotifier(self)
+        self.spaces = SpaceCache()
+        self.gaps = GapFiller(self)
+        # Set when the traffic of this session is being recorded
+        self.recorder: TrafficRecorder | None = None
+        self.add_response_callback(scheduler.on_response, ErrorResponse)
+        
+    async def close(self):
+        await self.outbox.close()
+        await self.receipts.close()
+        if self.sync_engine is not None:
+            await self.sync_engine.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        await super().close()
+        
+    async def upload_sync_filter(self, definition: dict | None) -> str | None:
+        """Upload a sync filter, reusing the ID of an identical filter
+        uploaded before
+
+        Args:
+            definition (dict | None): The filter definition
+
+        Returns:
+            str | None: The filter ID, None to sync unfiltered
+        """
+        if definition is None:
+            return None
+        key = json.dumps(definition, sort_keys=True, separators=(",", ":"))
+        if (filter_id := self.event_store.sync_filter_id(key)):
+            return filter_id
+        
+        res = await self.upload_filter(**definition)
+        if isinstance(res, UploadFilterError):
+            # Syncing unfiltered is slower, but still works
+            return None
+        self.event_store.save_sync_filter(key, res.filter_id)
+        return res.filter_id
+        
+    async def sync(self, timeout: int | None = 0, sync_filter=None, since: str | None = None, *args, **kwargs):
+        if self.sync_engine is None:
+            with metrics.timer("sync.round_trip"):
+                return await super().sync(timeout, sync_filter, since, *args, **kwargs)
+        
+        # Fetched and parsed on the engine's thread, only applied here
+        response = await self.sync_engine.fetch(since or self.next_batch, timeout, sync_filter)
+        await self.receive_response(response)
+        return response
+        
+    async def room_messages(self, *args, **kwargs):
+        with metrics.timer("room_messages.round_trip"):
+            return await super().room_messages(*args, **kwargs)
+        
+    async def create_matrix_response(self, response_class, transport_response, data=None, *args, **kwargs):
+        # Reading and parsing the body of every response, e.g. parse.SyncResponse
+        with metrics.timer(f"parse.{response_class.__name__}"):
+            response = await super().create_matrix_response(response_class, transport_response, data, *args, **kwargs)
+        if self.recorder is not None:
+            await self.recorder.add(response_class, transport_response, data[0] if data else None)
+        return response
+        
+    async def receive_response(self, response):
+        # nio applying a response to the client state, including event callbacks
+        with metrics.timer(f"receive.{type(response).__name__}"):
+            await super().receive_response(response)
+
+
+async def client_factory(
+    homeserver: str, username: str, password: str, timeline_limit: int | None = None,
+    timeline_types: list[str] | None = TIMELINE_TYPES,
+    connections: ConnectionPool | None = None, sync_thread: SyncThread | None = None,
+) -> AsyncClient | None:
+    """Log in, or restore the saved login, and start syncing
+
+    Args:
+        homeserver (str): The homeserver to log in to
+        username (str): The username to log in with
+        password (str): The password to log in with
+        timeline_limit (int | None, optional): Events per room per sync, overriding the config. Defaults to None.
+        timeline_types (list[str] | None, optional): Timeline event types to sync, None for every type. Defaults to TIMELINE_TYPES.
+        connections (ConnectionPool | None, optional): Pool shared with other accounts. Defaults to a connection pool of its own.
+        sync_thread (SyncThread | None, optional): Sync thread shared with other accounts. Defaults to a thread of its own.
+
+    Returns:
+        AsyncClient | None: The logged in client, None if logging in failed
+    """
+    config = NitrixConfig()
+    store = EventStore.for_account(homeserver, username)
+    client = NitrixClient(
             homeserver=homeserver,
             user=username,
             device_id="Nitrix",
+            event_store=store,
+            scheduler=RequestScheduler(int(config.get_config("Performance", "fetch_concurrency") or 4)),
         )
-    
+    if connections is not None:
+        connections.attach(client)
+    client.receipts.delay = float(config.get_config("Performance", "read_receipt_delay") or ReadReceipts.DELAY)
+    client.typing.enabled = config.get_flag("Interface", "typing_notifications", default=True)
+    client.gaps.workers = max(1, int(config.get_config("Performance", "gap_fill_workers") or GapFiller.WORKERS))
+
     try:
-        await client.login(password, 'Nitrix')
+        # Reuse the saved access token if the homeserver still accepts it
+        if (session := store.load_session(homeserver)):
+            client.restore_login(*session)
+            try:
+                whoami = await client.whoami()
+            except (ClientError, asyncio.TimeoutError):
+                # Can't reach the homeserver, carry on from disk and let
+                # syncing retry
+                whoami = None
+            if isinstance(whoami, WhoamiError) and whoami.status_code in DEAD_TOKEN_ERRORS:
+                # Only the login is gone, what was synced through it is still good
+                store.clear_session()
+                client.access_token = ""
+
+        if not client.logged_in:
+            await client.login(password, 'Nitrix')
+            if client.logged_in:
+                store.save_session(homeserver, client.user_id, client.device_id, client.access_token)
     except InvalidURL:
         ...
     except Exception as e:
         await client.close()
+        store.close()
         raise
-    
+
     if client.logged_in:
-        await client.sync()
+        if config.get_flag("Performance", "record_traffic"):
+            client.recorder = TrafficRecorder.for_account(homeserver, client.user_id)
+        filter_id = await client.upload_sync_filter(sync_filter(config, timeline_limit, timeline_types))
+        if (config.get_config("Performance", "sync_engine") or "thread") == "thread":
+            client.sync_engine = SyncEngine(client, filter_id, thread=sync_thread)
+            client.sync_engine.start()
+        
+        # Paint rooms straight from disk and resume from the saved token,
+        # only doing a full initial sync when there's nothing stored yet
+        if store.sync_token:
+            client.rooms.update(store.load_rooms(client.user_id))
+            client.next_batch = store.sync_token
+        else:
+            response = await client.sync(sync_filter=filter_id)
+            if client.sync_engine is None:
+                store.save_sync(response)
+        if client.sync_engine is None:
+            # The engine saves responses on its own thread
+            client.add_response_callback(store.save_sync, SyncResponse)
+        client.outbox.restore()
+        client.gaps.restore()
         loop = asyncio.get_event_loop()
-        loop.create_task(client.sync_forever(timeout=30000))
+        if client.sync_engine is not None:
+            loop.create_task(client.sync_engine.sync_forever())
+        else:
+            loop.create_task(client.sync_forever(timeout=30000, sync_filter=filter_id))
         return client
-    
-    client.close()
\ No newline at end of file
+
+    await client.close()
+    store.close()
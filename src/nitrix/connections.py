@@ -0,0 +1,52 @@
+"""
+    Connection pooling shared between accounts. The clients of every
+    account send through the same aiohttp connector, so accounts on the
+    same homeserver share TCP/TLS connections and DNS lookups.
+"""
+
+from __future__ import annotations
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from nio import AsyncClient
+
+
+class ConnectionPool():
+    """One connector, created on first use, for the clients of a single event loop
+
+    Args:
+        limit_per_host (int, optional): Open connections allowed per homeserver. Defaults to 20.
+    """
+
+    # Seconds a DNS lookup is reused for
+    DNS_TTL = 300
+
+    def __init__(self, limit_per_host: int = 20):
+        self.limit_per_host = limit_per_host
+        self.connector: TCPConnector | None = None
+
+    def attach(self, client: AsyncClient):
+        """Have a client send through the pool, instead of the session and
+        connector nio would otherwise create for it. Must be called from
+        the event loop the client is used on.
+
+        Args:
+            client (AsyncClient): The client to attach
+        """
+        if client.proxy:
+            # nio sets up its own proxy connector
+            return
+        if self.connector is None or self.connector.closed:
+            self.connector = TCPConnector(ttl_dns_cache=self.DNS_TTL, limit_per_host=self.limit_per_host)
+        # Closing the client closes its session but leaves the shared connector be
+        client.client_session = ClientSession(
+            connector=self.connector,
+            connector_owner=False,
+            timeout=ClientTimeout(total=client.config.request_timeout),
+        )
+
+    async def close(self):
+        """Close every pooled connection"""
+        if self.connector is not None:
+            await self.connector.close()
+            self.connector = None
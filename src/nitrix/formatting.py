@@ -0,0 +1,328 @@
+"""
+    Rendering of message bodies. `formatted_body` HTML is turned into Rich
+    renderables (the subset of HTML Matrix clients send: emphasis, links,
+    mentions, quotes, lists and code blocks with syntax highlighting),
+    plain bodies get their links picked out and attachments are summed up
+    in a line. Parsing and rendering both
+    happen at most once per event and width, through a bounded `RenderCache`.
+"""
+
+from __future__ import annotations
+
+import re
+
+from collections import OrderedDict
+from html.parser import HTMLParser
+
+from rich.console import Console, ConsoleOptions, Group, RenderableType, RenderResult
+from rich.rule import Rule
+from rich.segment import Segment
+from rich.style import Style
+from rich.syntax import Syntax
+from rich.text import Text
+
+from nitrix.media import describe_media, is_media
+from nitrix.metrics import metrics
+from nitrix.utils import get_user_id_colour
+
+URL_RE = re.compile(r"https?://[^\s<>\"']+[^\s<>\"'.,;:!?)\]]")
+MENTION_RE = re.compile(r"^https://matrix\.to/#/(@[^/?]+)")
+
+# Tags whose contents are dropped, e.g. the quoted fallback of a reply
+SKIPPED_TAGS = {"mx-reply", "script", "style"}
+
+INLINE_STYLES = {
+    "b": Style(bold=True), "strong": Style(bold=True),
+    "i": Style(italic=True), "em": Style(italic=True),
+    "u": Style(underline=True), "ins": Style(underline=True),
+    "s": Style(strike=True), "del": Style(strike=True), "strike": Style(strike=True),
+    "sup": Style(dim=True), "sub": Style(dim=True),
+}
+
+BLOCK_TAGS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol", "li", "table", "tr", "details", "summary"}
+
+
+class Quote():
+    """Renders its contents behind a bar down the left side"""
+
+    def __init__(self, renderable: RenderableType, style: Style):
+        self.renderable = renderable
+        self.style = style
+
+    def __rich_console__(self, console: Console, options: ConsoleOptions) -> RenderResult:
+        bar = Segment("▌ ", self.style)
+        lines = console.render_lines(self.renderable, options.update_width(max(1, options.max_width - 2)), pad=False)
+        for line in lines:
+            yield bar
+            yield from line
+            yield Segment.line()
+
+
+class _HTMLRenderer(HTMLParser):
+    """Builds a list of renderables out of a `formatted_body`"""
+
+    def __init__(self, styles: dict[str, Style], colours: dict[int, Style]):
+        super().__init__(convert_charrefs=True)
+        self.styles = styles
+        self.colours = colours
+        # Blocks of the document, and of every blockquote being built
+        self.stack: list[list[RenderableType]] = [[]]
+        self.text = Text()
+        self.style_stack: list[tuple[str, Style]] = []
+        self.lists: list[list] = []
+        self.skipping = 0
+        self.pre: list[str] | None = None
+        self.pre_language: str | None = None
+
+    @property
+    def style(self) -> Style:
+        return Style.combine([Style(), *(style for _, style in self.style_stack)])
+
+    def flush(self):
+        """End the paragraph being built"""
+        self.text.rstrip()
+        if self.text.plain:
+            self.stack[-1].append(self.text)
+        self.text = Text()
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        attributes = dict(attrs)
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+        if self.skipping:
+            return
+        if self.pre is not None:
+            if tag == "code":
+                for name in (attributes.get("class") or "").split():
+                    if name.startswith("language-"):
+                        self.pre_language = name[len("language-"):]
+            return
+
+        if tag in INLINE_STYLES:
+            self.style_stack.append((tag, INLINE_STYLES[tag]))
+        elif tag == "code":
+            self.style_stack.append((tag, self.styles["code"]))
+        elif tag == "a":
+            href = attributes.get("href") or ""
+            if (mention := MENTION_RE.match(href)):
+                colour = self.colours.get(get_user_id_colour(mention.group(1)), Style())
+                style = self.styles["mention"] + colour
+            else:
+                style = self.styles["link"] + Style(link=href or None)
+            self.style_stack.append((tag, style))
+        elif tag in ("span", "font"):
+            colour = attributes.get("data-mx-color") or attributes.get("color")
+            try:
+                style = Style(color=colour) if colour else Style()
+            except Exception:
+                style = Style()
+            self.style_stack.append((tag, style))
+        elif tag == "br":
+            self.text.append("\n")
+        elif tag == "hr":
+            self.flush()
+            self.stack[-1].append(Rule(style=self.styles["quote"]))
+        elif tag == "img":
+            self.text.append(attributes.get("alt") or attributes.get("title") or "[image]", self.style)
+        elif tag == "pre":
+            self.flush()
+            self.pre = []
+            self.pre_language = None
+        elif tag == "blockquote":
+            self.flush()
+            self.stack.append([])
+        elif tag in ("ul", "ol"):
+            self.flush()
+            self.lists.append([tag, 0])
+        elif tag == "li":
+            self.flush()
+            indent = "  " * max(0, len(self.lists) - 1)
+            if self.lists and self.lists[-1][0] == "ol":
+                self.lists[-1][1] += 1
+                self.text.append(f"{indent}{self.lists[-1][1]}. ")
+            else:
+                self.text.append(f"{indent}• ")
+        elif tag in BLOCK_TAGS:
+            self.flush()
+            if tag[0] == "h" and tag[1:].isdigit():
+                self.style_stack.append((tag, Style(bold=True, underline=tag == "h1")))
+
+    def handle_endtag(self, tag: str):
+        if tag in SKIPPED_TAGS:
+            self.skipping = max(0, self.skipping - 1)
+            return
+        if self.skipping:
+            return
+        if self.pre is not None:
+            if tag == "pre":
+                code = "".join(self.pre).rstrip("\n")
+                self.stack[-1].append(Syntax(
+                    code, self.pre_language or "text", theme="monokai",
+                    word_wrap=True, background_color="default",
+                ))
+                self.pre = None
+            return
+
+        if tag == "blockquote" and len(self.stack) > 1:
+            self.flush()
+            blocks = self.stack.pop()
+            if blocks:
+                self.stack[-1].append(Quote(Group(*blocks), self.styles["quote"]))
+        elif tag in ("ul", "ol"):
+            self.flush()
+            if self.lists:
+                self.lists.pop()
+        elif tag in BLOCK_TAGS:
+            self.flush()
+
+        # Close the style the tag opened, along with anything left open inside it
+        for index in range(len(self.style_stack) - 1, -1, -1):
+            if self.style_stack[index][0] == tag:
+                del self.style_stack[index:]
+                break
+
+    def handle_data(self, data: str):
+        if self.skipping:
+            return
+        if self.pre is not None:
+            self.pre.append(data)
+            return
+        # Whitespace collapses like it does in a browser
+        data = re.sub(r"\s+", " ", data)
+        if not self.text.plain or self.text.plain.endswith(("\n", " ")):
+            data = data.lstrip()
+        if data:
+            self.text.append(data, self.style)
+
+    def result(self) -> RenderableType:
+        self.close()
+        self.flush()
+        while len(self.stack) > 1:
+            blocks = self.stack.pop()
+            self.stack[-1].append(Quote(Group(*blocks), self.styles["quote"]))
+        blocks = self.stack[0]
+        if len(blocks) == 1:
+            return blocks[0]
+        return Group(*blocks)
+
+
+def render_body(event, styles: dict[str, Style], colours: dict[int, Style]) -> RenderableType:
+    """Build the renderable for the body of a message
+
+    Args:
+        event (Event): The message
+        styles (dict[str, Style]): Styles for "code", "quote", "mention", "link" and "media"
+        colours (dict[int, Style]): Username colours, by `get_user_id_colour`
+
+    Returns:
+        RenderableType: The rendered body
+    """
+    if is_media(event):
+        return Text(describe_media(event), style=styles["media"])
+    body = getattr(event, "body", None) or "<ERROR: NO MESSAGE BODY>"
+    formatted = getattr(event, "formatted_body", None)
+    if formatted and getattr(event, "format", None) == "org.matrix.custom.html":
+        renderer = _HTMLRenderer(styles, colours)
+        renderer.feed(formatted)
+        renderable = renderer.result()
+        if not isinstance(renderable, Text) or renderable.plain:
+            return renderable
+
+    text = Text(body)
+    for match in URL_RE.finditer(body):
+        text.stylize(styles["link"] + Style(link=match.group()), match.start(), match.end())
+    return text
+
+
+class RenderCache():
+    """Least recently used cache of parsed message bodies, by event ID,
+    and of their rendered lines, by event ID and width
+
+    Args:
+        max_entries (int, optional): Events kept in each cache. Defaults to 2000.
+    """
+
+    def __init__(self, max_entries: int = 2000):
+        self.max_entries = max_entries
+        self.parsed: OrderedDict[str, RenderableType] = OrderedDict()
+        self.lines: OrderedDict[tuple[str, int], list[list[Segment]]] = OrderedDict()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def clear(self):
+        self.parsed.clear()
+        self.lines.clear()
+
+    def invalidate(self, event_id: str):
+        """Forget an event, e.g. once it's been edited
+
+        Args:
+            event_id (str): The event ID
+        """
+        self.parsed.pop(event_id, None)
+        for key in [key for key in self.lines if key[0] == event_id]:
+            del self.lines[key]
+
+    def _remember(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        if len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    def body(self, event, styles: dict[str, Style], colours: dict[int, Style]) -> CachedBody:
+        """Get a renderable for a message body that comes out of the cache
+
+        Args:
+            event (Event): The message
+            styles (dict[str, Style]): Styles for "code", "quote", "mention", "link" and "media"
+            colours (dict[int, Style]): Username colours, by `get_user_id_colour`
+
+        Returns:
+            CachedBody: The renderable
+        """
+        return CachedBody(self, event, styles, colours)
+
+    def render_lines(self, event, console: Console, options: ConsoleOptions, styles: dict[str, Style], colours: dict[int, Style]) -> list[list[Segment]]:
+        """Get the rendered lines of a message body, parsing and rendering it if needed
+
+        Args:
+            event (Event): The message
+            console (Console): The console rendering it
+            options (ConsoleOptions): The options it's rendered with
+            styles (dict[str, Style]): Styles for "code", "quote", "mention", "link" and "media"
+            colours (dict[int, Style]): Username colours, by `get_user_id_colour`
+
+        Returns:
+            list[list[Segment]]: The lines
+        """
+        key = (event.event_id, options.max_width)
+        if (lines := self.lines.get(key)) is not None:
+            self.lines.move_to_end(key)
+            return lines
+
+        if (renderable := self.parsed.get(event.event_id)) is None:
+            with metrics.timer("render.parse"):
+                renderable = render_body(event, styles, colours)
+            self._remember(self.parsed, event.event_id, renderable)
+        else:
+            self.parsed.move_to_end(event.event_id)
+
+        with metrics.timer("render.lines"):
+            lines = console.render_lines(renderable, options, pad=False)
+        self._remember(self.lines, key, lines)
+        return lines
+
+
+class CachedBody():
+    """Renderable handing out the cached lines of a message body"""
+
+    def __init__(self, cache: RenderCache, event, styles: dict[str, Style], colours: dict[int, Style]):
+        self.cache = cache
+        self.event = event
+        self.styles = styles
+        self.colours = colours
+
+    def __rich_console__(self, console: Console, options: ConsoleOptions) -> RenderResult:
+        for line in self.cache.render_lines(self.event, console, options, self.styles, self.colours):
+            yield from line
+            yield Segment.line()
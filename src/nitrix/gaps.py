@@ -0,0 +1,146 @@
+"""
+    Holes in room history. A limited sync only has the latest events of a
+    room, and the store notes a gap before the first of them with the sync's
+    `prev_batch` token. Gaps are filled in the background by paginating
+    backwards from that token until an event we already have turns up. The
+    current room's gaps go first, everyone else's wait for one of a few
+    workers.
+"""
+
+from __future__ import annotations
+
+import heapq
+import asyncio
+import itertools
+
+from typing import Any, Callable
+
+from aiohttp import ClientConnectionError
+from nio import AsyncClient, Event, RoomMessagesError
+
+from nitrix.metrics import metrics
+from nitrix.scheduler import Priority, RateLimited
+
+
+class GapFiller():
+    """Fills the gaps in an account's rooms through its `RequestScheduler`
+
+    Args:
+        client (AsyncClient): The client to paginate with, with an `event_store` and a `scheduler`
+        workers (int, optional): Rooms filled at once, not counting the current room. Defaults to WORKERS.
+    """
+
+    # Events per request, and requests per room before it goes to the
+    # back of the line again
+    PAGE_SIZE = 100
+    MAX_PAGES = 10
+
+    WORKERS = 2
+
+    def __init__(self, client: AsyncClient, workers: int = WORKERS):
+        self.client = client
+        self.workers = workers
+        # Rooms waiting for a worker: (priority, order, room ID), and their priority
+        self._queue: list[tuple[int, int, str]] = []
+        self._waiting: dict[str, Priority] = {}
+        self._running: set[str] = set()
+        self._counter = itertools.count()
+        self._callbacks: list[Callable[[str, list[Event]], Any]] = []
+
+    def add_callback(self, callback: Callable[[str, list[Event]], Any]):
+        """Get told whenever events were filled in
+
+        Args:
+            callback (Callable[[str, list[Event]], Any]): Called with the room ID and the events, oldest first
+        """
+        self._callbacks.append(callback)
+
+    def restore(self):
+        """Queue the gaps left unfilled by the last run"""
+        for room_id in self.client.event_store.gap_rooms():
+            self.queue(room_id)
+
+    def queue(self, room_id: str, priority: Priority = Priority.BACKGROUND):
+        """Fill a room's gaps when it's its turn. The current room doesn't wait for a worker.
+
+        Args:
+            room_id (str): The room
+            priority (Priority, optional): How urgently. Defaults to Priority.BACKGROUND.
+        """
+        if room_id in self._running:
+            if priority is Priority.CURRENT:
+                self.client.scheduler.reprioritize(("gap", room_id), priority)
+            return
+        if priority is Priority.CURRENT:
+            self._waiting.pop(room_id, None)
+            self._start(room_id, priority)
+            return
+        if priority < self._waiting.get(room_id, Priority.BACKGROUND + 1):
+            # The old heap entry is skipped when popped as its priority is stale
+            self._waiting[room_id] = priority
+            heapq.heappush(self._queue, (priority, next(self._counter), room_id))
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._queue and len(self._running) < self.workers:
+            priority, _, room_id = heapq.heappop(self._queue)
+            if self._waiting.get(room_id) != priority:
+                continue
+            del self._waiting[room_id]
+            self._start(room_id, priority)
+
+    def _start(self, room_id: str, priority: Priority):
+        self._running.add(room_id)
+        future = self.client.scheduler.submit(("gap", room_id), lambda: self._fill(room_id), priority)
+        future.add_done_callback(lambda future: self._done(room_id, future))
+
+    def _done(self, room_id: str, future: asyncio.Future):
+        self._running.discard(room_id)
+        if not future.cancelled() and future.exception() is None and future.result():
+            # More left after MAX_PAGES, the room goes back in line
+            self.queue(room_id)
+        self._dispatch()
+
+    async def _fill(self, room_id: str) -> bool:
+        """Fill a room's gaps, newest first, for up to MAX_PAGES requests
+
+        Args:
+            room_id (str): The room
+
+        Raises:
+            RateLimited: The homeserver asked to slow down
+
+        Returns:
+            bool: True if there's still a gap left
+        """
+        store = self.client.event_store
+        for _ in range(self.MAX_PAGES):
+            if (gap := store.next_gap(room_id)) is None:
+                return False
+            event_id, token = gap
+            try:
+                with metrics.timer("gaps.fill_page"):
+                    response = await self.client.room_messages(room_id, token, limit=self.PAGE_SIZE)
+            except (ClientConnectionError, asyncio.TimeoutError):
+                # Offline, the gap is still in the store for next time
+                return False
+            if isinstance(response, RoomMessagesError):
+                if response.status_code == "M_LIMIT_EXCEEDED":
+                    raise RateLimited(response.retry_after_ms)
+                return False
+
+            # The chunk runs newest first, up to the events on the other side of the gap
+            events = []
+            closed = not response.chunk or not response.end
+            for event in response.chunk:
+                if store.has_event(event.event_id):
+                    closed = True
+                    break
+                events.append(event)
+            events.reverse()
+            store.fill_gap(room_id, event_id, events, None if closed else response.end)
+            metrics.increment("gaps.events_filled", len(events))
+            if events:
+                for callback in self._callbacks:
+                    callback(room_id, events)
+        return store.next_gap(room_id) is not None
@@ -0,0 +1,485 @@
+"""
+    Media attachments. Downloads go through a `MediaDownloader`, which
+    queues them with a cap on how many run at once and keeps whatever it
+    fetched in a `MediaCache` on disk. The cache is content-addressed, so
+    the same file sent twice is only stored once, and is held under a size
+    cap by evicting the least recently used files.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import time
+import asyncio
+import hashlib
+import pathlib
+import sqlite3
+
+from collections import OrderedDict
+from typing import Any, Callable
+
+from rich.color import Color
+from rich.style import Style
+from rich.text import Text
+
+from nio import AsyncClient, DownloadError, Event, RoomEncryptedMedia, RoomMessageMedia, ThumbnailError
+from nio.crypto.attachments import decrypt_attachment
+
+from nitrix.metrics import metrics
+from nitrix.scheduler import Priority, RateLimited, RequestScheduler
+
+try:
+    from PIL import Image
+except ImportError:
+    # Previews are optional, everything else works without Pillow
+    Image = None
+
+MEDIA_EVENTS = (RoomMessageMedia, RoomEncryptedMedia)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    key TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    content_type TEXT,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_digest ON media (digest);
+"""
+
+
+class MediaError(Exception):
+    """Raised when a file can't be downloaded"""
+
+
+def is_media(event: Event) -> bool:
+    return isinstance(event, MEDIA_EVENTS)
+
+
+def parse_mxc(uri: str) -> tuple[str, str]:
+    """Split an `mxc://` URI
+
+    Args:
+        uri (str): The URI
+
+    Raises:
+        MediaError: The URI isn't an `mxc://` URI
+
+    Returns:
+        tuple[str, str]: Server name and media ID
+    """
+    if not uri or not uri.startswith("mxc://"):
+        raise MediaError(f"Not an mxc:// URI: {uri!r}")
+    server_name, _, media_id = uri[len("mxc://"):].partition("/")
+    if not server_name or not media_id:
+        raise MediaError(f"Not an mxc:// URI: {uri!r}")
+    return server_name, media_id
+
+
+def media_source(event: Event, thumbnail: bool = False) -> tuple[str | None, dict | None]:
+    """Find where an attachment, or its thumbnail, is stored
+
+    Args:
+        event (Event): The media event
+        thumbnail (bool, optional): Whether to look for the thumbnail. Defaults to False.
+
+    Returns:
+        tuple[str | None, dict | None]: The `mxc://` URI, and the keys to decrypt it with for encrypted rooms
+    """
+    content = event.source.get("content", {})
+    info = content.get("info") or {}
+    if thumbnail:
+        file, url = info.get("thumbnail_file"), info.get("thumbnail_url")
+    else:
+        file, url = content.get("file"), content.get("url")
+    if isinstance(file, dict):
+        return file.get("url"), file
+    return url, None
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def describe_media(event: Event) -> str:
+    """Summarize an attachment in one line, e.g. "🖼 cat.png · image/png · 1.2 MB · 800×600"
+
+    Args:
+        event (Event): The media event
+
+    Returns:
+        str: The summary
+    """
+    content = event.source.get("content", {})
+    info = content.get("info") or {}
+    icon = {"m.image": "🖼", "m.video": "🎞", "m.audio": "🔊"}.get(content.get("msgtype"), "📎")
+    parts = [content.get("filename") or getattr(event, "body", None) or "attachment"]
+    if info.get("mimetype"):
+        parts.append(info["mimetype"])
+    if isinstance(info.get("size"), int):
+        parts.append(format_size(info["size"]))
+    if info.get("w") and info.get("h"):
+        parts.append(f"{info['w']}×{info['h']}")
+    if isinstance(info.get("duration"), int):
+        seconds = info["duration"] // 1000
+        parts.append(f"{seconds // 60}:{seconds % 60:02}")
+    return f"{icon} " + " · ".join(str(part) for part in parts)
+
+
+def build_preview(data: bytes, max_width: int = 32, max_height: int = 10) -> Text | None:
+    """Draw an image with half blocks, two pixels to a cell
+
+    Args:
+        data (bytes): The encoded image
+        max_width (int, optional): Most cells across. Defaults to 32.
+        max_height (int, optional): Most lines down. Defaults to 10.
+
+    Returns:
+        Text | None: The preview, None without Pillow or if the image can't be read
+    """
+    if Image is None:
+        return None
+    try:
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+    except Exception:
+        return None
+    # Terminal cells are about twice as tall as they're wide
+    width = max_width
+    height = max(1, round(width * image.height / image.width / 2))
+    if height > max_height:
+        width = max(1, round(width * max_height / height))
+        height = max_height
+    image = image.resize((width, height * 2))
+    pixels = image.load()
+    preview = Text()
+    for y in range(0, height * 2, 2):
+        if y:
+            preview.append("\n")
+        for x in range(width):
+            preview.append("▀", Style(
+                color=Color.from_rgb(*pixels[x, y]), bgcolor=Color.from_rgb(*pixels[x, y + 1])))
+    return preview
+
+
+class MediaCache():
+    """Files on disk, named after the SHA-256 of their contents, with a
+    SQLite index from the URIs they were fetched from to their digests
+
+    Args:
+        folder (pathlib.Path): Where the files and index are kept
+        max_bytes (int, optional): Size the files are held under. Defaults to 512MB.
+    """
+
+    def __init__(self, folder: pathlib.Path, max_bytes: int = 512 * 1024 * 1024):
+        self.folder = pathlib.Path(folder)
+        self.max_bytes = max_bytes
+        (self.folder / "blobs").mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.folder / "index.db")
+        self.connection.executescript(SCHEMA)
+        self.total = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM media GROUP BY digest)"
+        ).fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def path(self, digest: str) -> pathlib.Path:
+        return self.folder / "blobs" / digest[:2] / digest
+
+    def get(self, key: str) -> pathlib.Path | None:
+        """Look a file up, marking it as used
+
+        Args:
+            key (str): What the file was stored under
+
+        Returns:
+            pathlib.Path | None: The file, None if it isn't cached
+        """
+        row = self.connection.execute("SELECT digest FROM media WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        path = self.path(row[0])
+        if not path.exists():
+            # Deleted from under us
+            self._forget(row[0])
+            return None
+        with self.connection:
+            self.connection.execute("UPDATE media SET last_used = ? WHERE key = ?", (time.time(), key))
+        return path
+
+    def write(self, data: bytes) -> str:
+        """Write a file's contents to disk, without indexing it. Doesn't touch
+        the index, so it's safe to call from another thread.
+
+        Args:
+            data (bytes): The contents
+
+        Returns:
+            str: The digest it was written under
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            partial = path.with_suffix(".part")
+            partial.write_bytes(data)
+            os.replace(partial, path)
+        return digest
+
+    def add(self, key: str, digest: str, size: int, content_type: str | None = None) -> pathlib.Path:
+        """Index a file written with `write`, evicting the least recently
+        used files while the cache is over its size
+
+        Args:
+            key (str): What to store the file under
+            digest (str): The digest `write` returned
+            size (int): Size of the file in bytes
+            content_type (str | None, optional): MIME type of the file. Defaults to None.
+
+        Returns:
+            pathlib.Path: The file
+        """
+        known = self.connection.execute("SELECT 1 FROM media WHERE digest = ?", (digest,)).fetchone()
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO media (key, digest, size, content_type, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, digest, size, content_type, time.time()),
+            )
+        if not known:
+            self.total += size
+        self.evict(keep=digest)
+        return self.path(digest)
+
+    def evict(self, keep: str | None = None):
+        """Delete the least recently used files until the cache fits in its size
+
+        Args:
+            keep (str | None, optional): Digest never to evict, e.g. the file just added. Defaults to None.
+        """
+        while self.total > self.max_bytes:
+            row = self.connection.execute(
+                "SELECT digest FROM media WHERE digest != ? GROUP BY digest ORDER BY MAX(last_used) LIMIT 1",
+                (keep or "",),
+            ).fetchone()
+            if row is None:
+                break
+            self._forget(row[0])
+            metrics.increment("media.evicted")
+
+    def _forget(self, digest: str):
+        size = self.connection.execute("SELECT MAX(size) FROM media WHERE digest = ?", (digest,)).fetchone()[0]
+        with self.connection:
+            self.connection.execute("DELETE FROM media WHERE digest = ?", (digest,))
+        self.total -= size or 0
+        self.path(digest).unlink(missing_ok=True)
+
+
+class MediaDownloader():
+    """Fetches attachments and thumbnails through a `MediaCache`. Requests
+    for the same file are merged, and at most `concurrency` run at once,
+    the ones the user asked for ahead of prefetches.
+
+    Args:
+        cache (MediaCache): Where fetched files are kept
+        concurrency (int, optional): Downloads allowed at once. Defaults to 4.
+    """
+
+    # Size of the thumbnails asked of the homeserver
+    THUMBNAIL_SIZE = (96, 96)
+
+    # Image previews kept in memory
+    MAX_PREVIEWS = 256
+
+    def __init__(self, cache: MediaCache, concurrency: int = 4):
+        self.cache = cache
+        self.scheduler = RequestScheduler(concurrency)
+        self.previews: OrderedDict[str, Text] = OrderedDict()
+        # Attachments saved with `save`, by event ID
+        self.saved: dict[str, pathlib.Path] = {}
+        self.saving: set[str] = set()
+        self._callbacks: list[Callable[[Event], Any]] = []
+
+    def add_callback(self, callback: Callable[[Event], Any]):
+        """Get told whenever an attachment starts or finishes saving, or gets a preview
+
+        Args:
+            callback (Callable[[Event], Any]): Called with the media event
+        """
+        self._callbacks.append(callback)
+
+    def _notify(self, event: Event):
+        for callback in self._callbacks:
+            callback(event)
+
+    @property
+    def previews_enabled(self) -> bool:
+        return Image is not None
+
+    def close(self):
+        self.cache.close()
+
+    async def fetch(self, client: AsyncClient, event: Event, thumbnail: bool = False, priority: Priority = Priority.CURRENT) -> bytes | None:
+        """Get the contents of an attachment or its thumbnail, from the cache
+        when it's there and from the homeserver otherwise
+
+        Args:
+            client (AsyncClient): The client of the account the event was seen by
+            event (Event): The media event
+            thumbnail (bool, optional): Whether to fetch the thumbnail. Defaults to False.
+            priority (Priority, optional): Priority of the download. Defaults to Priority.CURRENT.
+
+        Raises:
+            MediaError: The file couldn't be downloaded
+
+        Returns:
+            bytes | None: The decrypted contents, None if there's no thumbnail
+        """
+        uri, encryption = media_source(event, thumbnail)
+        size = None
+        if thumbnail and uri is None:
+            # Unencrypted images without a thumbnail of their own can be
+            # shrunk by the homeserver
+            uri, encryption = media_source(event)
+            if encryption is not None or not isinstance(event, RoomMessageMedia):
+                return None
+            size = self.THUMBNAIL_SIZE
+        if uri is None:
+            raise MediaError("The event has no attachment")
+
+        # Encrypted files are cached as they were downloaded, still encrypted
+        key = uri if size is None else f"{uri}#thumbnail={size[0]}x{size[1]}"
+        if (path := self.cache.get(key)) is not None:
+            metrics.increment("media.cache_hit")
+            data = await asyncio.to_thread(path.read_bytes)
+        else:
+            metrics.increment("media.cache_miss")
+            data = await self.scheduler.submit(key, lambda: self._download(client, key, uri, size), priority)
+        if encryption is not None:
+            data = await asyncio.to_thread(self._decrypt, data, encryption)
+        return data
+
+    async def prefetch_preview(self, client: AsyncClient, event: Event) -> bool:
+        """Fetch the thumbnail of an attachment and build its preview
+
+        Args:
+            client (AsyncClient): The client of the account the event was seen by
+            event (Event): The media event
+
+        Returns:
+            bool: True if there's a new preview to show
+        """
+        if not self.previews_enabled or event.event_id in self.previews:
+            return False
+        content = event.source.get("content", {})
+        if content.get("msgtype") not in ("m.image", "m.video"):
+            return False
+        try:
+            data = await self.fetch(client, event, thumbnail=True, priority=Priority.VISIBLE)
+        except MediaError:
+            return False
+        if data is None or (preview := await asyncio.to_thread(build_preview, data)) is None:
+            return False
+        self.previews[event.event_id] = preview
+        if len(self.previews) > self.MAX_PREVIEWS:
+            self.previews.popitem(last=False)
+        self._notify(event)
+        return True
+
+    async def save(self, client: AsyncClient, event: Event, folder: pathlib.Path) -> pathlib.Path:
+        """Download an attachment into a folder, under its own file name
+
+        Args:
+            client (AsyncClient): The client of the account the event was seen by
+            event (Event): The media event
+            folder (pathlib.Path): The folder to save it in
+
+        Raises:
+            MediaError: The file couldn't be downloaded
+
+        Returns:
+            pathlib.Path: Where it was saved
+        """
+        if (path := self.saved.get(event.event_id)) is not None and path.exists():
+            return path
+        self.saving.add(event.event_id)
+        self._notify(event)
+        try:
+            data = await self.fetch(client, event)
+            content = event.source.get("content", {})
+            name = pathlib.Path(content.get("filename") or getattr(event, "body", None) or "attachment").name
+            path = await asyncio.to_thread(self._write_unique, pathlib.Path(folder).expanduser(), name, data)
+            self.saved[event.event_id] = path
+        finally:
+            self.saving.discard(event.event_id)
+            self._notify(event)
+        return path
+
+    def status(self, event: Event) -> str:
+        """Describe what's been done with an attachment
+
+        Args:
+            event (Event): The media event
+
+        Returns:
+            str: e.g. "click to download"
+        """
+        if event.event_id in self.saving:
+            return "downloading…"
+        if (path := self.saved.get(event.event_id)) is not None:
+            return f"saved to {path}"
+        return "click to download"
+
+    async def _download(self, client: AsyncClient, key: str, uri: str, size: tuple[int, int] | None) -> bytes:
+        server_name, media_id = parse_mxc(uri)
+        with metrics.timer("media.download"):
+            if size is None:
+                response = await client.download(server_name=server_name, media_id=media_id)
+            else:
+                response = await client.thumbnail(server_name, media_id, *size)
+        if isinstance(response, (DownloadError, ThumbnailError)):
+            if response.status_code == "M_LIMIT_EXCEEDED":
+                raise RateLimited(response.retry_after_ms)
+            raise MediaError(response.message)
+        data = response.body
+        metrics.increment("media.downloaded_bytes", len(data))
+        digest = await asyncio.to_thread(self.cache.write, data)
+        self.cache.add(key, digest, len(data), response.content_type)
+        return data
+
+    @staticmethod
+    def _decrypt(data: bytes, encryption: dict) -> bytes:
+        try:
+            return decrypt_attachment(
+                data, encryption["key"]["k"], encryption["hashes"]["sha256"], encryption["iv"])
+        except Exception as e:
+            raise MediaError(f"Couldn't decrypt the file: {e}") from e
+
+    @staticmethod
+    def _write_unique(folder: pathlib.Path, name: str, data: bytes) -> pathlib.Path:
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / name
+        number = 1
+        while path.exists():
+            path = folder / f"{pathlib.Path(name).stem} ({number}){pathlib.Path(name).suffix}"
+            number += 1
+        path.write_bytes(data)
+        return path
+
+
+def media_downloader(config) -> MediaDownloader:
+    """Set up the downloader with the cache under the config folder
+
+    Args:
+        config (NitrixConfig): The configuration
+
+    Returns:
+        MediaDownloader: The downloader
+    """
+    size = int(config.get_config("Performance", "media_cache_size") or 512)
+    concurrency = int(config.get_config("Performance", "media_downloads") or 4)
+    cache = MediaCache(config.config_folder / "media", size * 1024 * 1024)
+    return MediaDownloader(cache, max(1, concurrency))
@@ -0,0 +1,150 @@
+"""
+    Who sent what. The display name and colour of a sender are worked out
+    once per room and member, and kept in a bounded cache shared by the
+    timelines of every room. `m.room.member` events coming down sync
+    update the cached names in place, so showing a message never looks a
+    name up or hashes a user ID again.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Callable
+
+from nio import MatrixRoom, RoomMemberEvent
+from nio.responses import SyncResponse
+
+from nitrix.utils import get_user_id_colour
+
+
+def localpart(user_id: str) -> str:
+    return user_id[1:].split(":")[0]
+
+
+class Sender():
+    """How a member of a room is shown
+
+    Args:
+        user_id (str): The member's user ID
+        name (str): The name to show
+        colour (int): The member's colour, by `get_user_id_colour`
+    """
+
+    __slots__ = ("user_id", "name", "colour")
+
+    def __init__(self, user_id: str, name: str, colour: int):
+        self.user_id = user_id
+        self.name = name
+        self.colour = colour
+
+
+def plain_sender(user_id: str) -> Sender:
+    """A sender going by the localpart of their user ID, for when there's no room to look them up in"""
+    return Sender(user_id, localpart(user_id), get_user_id_colour(user_id))
+
+
+class SenderCache():
+    """The most recently shown senders of every room
+
+    Args:
+        max_entries (int, optional): Senders kept before the least recently shown are forgotten. Defaults to MAX_ENTRIES.
+    """
+
+    MAX_ENTRIES = 5000
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[str, str], Sender] = OrderedDict()
+        # Room ID -> user IDs of the room's cached senders
+        self._rooms: dict[str, set[str]] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def resolve(self, room_id: str, user_id: str, room: MatrixRoom | None = None) -> Sender:
+        """Get how a member of a room is shown
+
+        Args:
+            room_id (str): The room
+            user_id (str): The member's user ID
+            room (MatrixRoom | None, optional): The room's state, to get display names from. Defaults to None.
+
+        Returns:
+            Sender: The sender, the same object for as long as it's cached
+        """
+        key = (room_id, user_id)
+        if (sender := self.entries.get(key)) is not None:
+            self.entries.move_to_end(key)
+            return sender
+        sender = self.entries[key] = Sender(user_id, self._name(room, user_id), get_user_id_colour(user_id))
+        self._rooms.setdefault(room_id, set()).add(user_id)
+        if len(self.entries) > self.max_entries:
+            (old_room, old_user), _ = self.entries.popitem(last=False)
+            self._discard(old_room, old_user)
+        return sender
+
+    def _discard(self, room_id: str, user_id: str):
+        users = self._rooms[room_id]
+        users.discard(user_id)
+        if not users:
+            del self._rooms[room_id]
+
+    def _name(self, room: MatrixRoom | None, user_id: str) -> str:
+        # Members that haven't been loaded go by their localpart
+        return (room.user_name(user_id) if room is not None else None) or localpart(user_id)
+
+    def refresh_room(self, room_id: str, room: MatrixRoom | None) -> set[str]:
+        """Work out the names of a room's cached senders again, e.g. once its full member list is loaded
+
+        Args:
+            room_id (str): The room
+            room (MatrixRoom | None): The room's state
+
+        Returns:
+            set[str]: User IDs of the senders whose name changed
+        """
+        changed = set()
+        for user_id in self._rooms.get(room_id, ()):
+            sender = self.entries[(room_id, user_id)]
+            if (name := self._name(room, user_id)) != sender.name:
+                sender.name = name
+                changed.add(user_id)
+        return changed
+
+    def apply_sync(self, response: SyncResponse, get_room: Callable[[str], MatrixRoom | None]) -> dict[str, set[str]]:
+        """Update the senders whose names the member events of a sync response
+        changed. Members sharing a display name are told apart by user ID, so
+        a name change can rename others too.
+
+        Args:
+            response (SyncResponse): The sync response, already applied to the rooms
+            get_room (Callable[[str], MatrixRoom | None]): Gets the state of a room
+
+        Returns:
+            dict[str, set[str]]: User IDs of the members that joined, left or may have been renamed, by room ID
+        """
+        changed: dict[str, set[str]] = {}
+        for room_id, room_info in response.rooms.join.items():
+            members = [
+                event for event in room_info.state + room_info.timeline.events
+                if isinstance(event, RoomMemberEvent)
+            ]
+            if not members:
+                continue
+            room = get_room(room_id)
+            affected = changed.setdefault(room_id, set())
+            for event in members:
+                affected.add(event.state_key)
+                if room is None:
+                    continue
+                for content in (event.content, event.prev_content or {}):
+                    if (name := content.get("displayname")):
+                        affected.update(room.names.get(name, ()))
+            for user_id in affected:
+                if (sender := self.entries.get((room_id, user_id))) is not None:
+                    sender.name = self._name(room, user_id)
+
+        for room_id in response.rooms.leave:
+            for user_id in self._rooms.pop(room_id, ()):
+                del self.entries[(room_id, user_id)]
+        return changed
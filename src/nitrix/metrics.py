@@ -0,0 +1,224 @@
+"""
+    Low overhead timing instrumentation. Hot paths record into histograms
+    through the module level `metrics`, which does next to nothing while
+    it's disabled. Samples can come from the sync thread as well as the
+    interface's, so recording and reading take a lock.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+import asyncio
+import bisect
+import atexit
+import contextlib
+import threading
+
+from pathlib import Path
+
+
+class Histogram():
+    """Counts values into exponentially growing buckets, so percentiles
+    come out within a few percent while recording stays O(log buckets)
+    """
+
+    # Buckets grow by 10% from 10µs, covering up to roughly ten minutes
+    BOUNDS = [0.00001 * 1.1 ** i for i in range(190)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, percent: float) -> float:
+        """Estimate a percentile from the buckets
+
+        Args:
+            percent (float): The percentile, from 0 to 100
+
+        Returns:
+            float: The upper bound of the bucket the percentile falls in
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                bound = self.BOUNDS[index] if index < len(self.BOUNDS) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class _Timer():
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+
+class Metrics():
+    """Named histograms and counters, optionally exported sample by sample as JSONL"""
+
+    # Shared by every timer while disabled so timing a block costs a
+    # single attribute check
+    _NULL_TIMER = contextlib.nullcontext()
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms: dict[str, Histogram] = {}
+        self.counters: dict[str, int] = {}
+        self.export_path: Path | None = None
+        self._samples: list[str] = []
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool, export_path: str | None = None):
+        """Turn instrumentation on or off
+
+        Args:
+            enabled (bool): Whether to record anything
+            export_path (str | None, optional): JSONL file to append every sample to. Defaults to None.
+        """
+        self.enabled = enabled
+        if export_path and self.export_path is None:
+            atexit.register(self.flush)
+        self.export_path = Path(export_path).expanduser() if export_path else None
+
+    def record(self, name: str, value: float):
+        """Add a value, in seconds for timings, to a histogram
+
+        Args:
+            name (str): The histogram's name
+            value (float): The value to add
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if (histogram := self.histograms.get(name)) is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(value)
+            if self.export_path is not None:
+                self._samples.append(json.dumps({"ts": time.time(), "metric": name, "value": value}))
+
+    def increment(self, name: str, amount: int = 1):
+        """Add to a counter
+
+        Args:
+            name (str): The counter's name
+            amount (int, optional): How much to add. Defaults to 1.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+            if self.export_path is not None:
+                self._samples.append(json.dumps({"ts": time.time(), "metric": name, "count": amount}))
+
+    def timer(self, name: str):
+        """Time a block of code into a histogram
+
+        Args:
+            name (str): The histogram's name
+
+        Returns:
+            ContextManager: Records the time spent in the block
+        """
+        if not self.enabled:
+            return self._NULL_TIMER
+        return _Timer(self, name)
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                "counters": dict(self.counters),
+            }
+
+    def flush(self):
+        """Append the samples recorded since the last flush to the export file"""
+        if not self._samples or self.export_path is None:
+            return
+        with self._lock:
+            samples, self._samples = self._samples, []
+        with open(self.export_path, "a") as fil:
+            fil.write("\n".join(samples) + "\n")
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Exact percentile of a list of samples, for when there are few enough to keep
+
+    Args:
+        values (list[float]): The samples
+        percent (float): The percentile, from 0 to 100
+
+    Returns:
+        float: The sample at the percentile, 0 if there are none
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class LagProbe():
+    """Measures how late the event loop wakes up, which is how late the
+    interface gets to handle input and paint. Used by the benchmarks and
+    `nitrix replay`.
+
+    Args:
+        interval (float, optional): Seconds between wake ups. Defaults to 0.01.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags: list[float] = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def reset(self):
+        self.lags = []
+
+    def percentile(self, percent: float) -> float:
+        return percentile(self.lags, percent)
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - start - self.interval)
+
+
+metrics = Metrics()
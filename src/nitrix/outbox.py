@@ -0,0 +1,236 @@
+"""
+    Outgoing messages. Every room has its own queue that sends one message
+    at a time, so messages arrive in the order they were written, and keeps
+    retrying until the homeserver takes them. Queued messages are kept in
+    the store until then, so they survive a restart. Messages the
+    homeserver turns down for good stay in the store marked as failed until
+    they're retried.
+
+    Sends aren't pipelined. The homeserver orders events as it gets round
+    to each request, and sends over separate connections can be handled in
+    any order, so a message going out before the one ahead of it has landed
+    could end up above it in the room.
+"""
+
+from __future__ import annotations
+
+import enum
+import time
+import uuid
+import asyncio
+
+from collections import deque
+from typing import Any, Callable
+
+from aiohttp import ClientConnectionError
+from nio import AsyncClient, ErrorResponse, Event, RoomSendResponse
+
+from nitrix.metrics import metrics
+from nitrix.store import EventStore
+
+
+class SendState(enum.Enum):
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+class OutgoingMessage():
+    """A message in the outbox
+
+    Args:
+        room_id (str): The room the message goes to
+        txn_id (str): Transaction ID, which makes retrying the send safe
+        content (dict): The event content
+        created (int): When the message was written, in milliseconds since the epoch
+    """
+
+    def __init__(self, room_id: str, txn_id: str, content: dict, created: int):
+        self.room_id = room_id
+        self.txn_id = txn_id
+        self.content = content
+        self.created = created
+        self.state = SendState.PENDING
+        self.event_id: str | None = None
+        self.error: str | None = None
+
+    def local_echo(self, sender: str) -> Event:
+        """Build the event shown in the timeline until the real one comes down sync.
+        It's keyed by the transaction ID, and links back to this message
+        through its `outgoing` attribute.
+
+        Args:
+            sender (str): Our own user ID
+
+        Returns:
+            Event: The stand-in event
+        """
+        event = Event.parse_event({
+            "type": "m.room.message",
+            "event_id": self.txn_id,
+            "sender": sender,
+            "origin_server_ts": self.created,
+            "content": self.content,
+            "unsigned": {"transaction_id": self.txn_id},
+        })
+        event.outgoing = self
+        return event
+
+
+class Outbox():
+    """Per room send queues with retries, persisted in an `EventStore`
+
+    Args:
+        client (AsyncClient): The client to send with
+        store (EventStore): Where queued messages are kept
+    """
+
+    # Seconds between retries, doubling from RETRY_MIN up to RETRY_MAX
+    RETRY_MIN = 1
+    RETRY_MAX = 60
+
+    # Errors retrying won't fix
+    PERMANENT_ERRORS = {
+        "M_FORBIDDEN", "M_NOT_FOUND", "M_BAD_JSON", "M_NOT_JSON",
+        "M_TOO_LARGE", "M_UNKNOWN_TOKEN", "M_MISSING_TOKEN",
+    }
+
+    def __init__(self, client: AsyncClient, store: EventStore):
+        self.client = client
+        self.store = store
+        self.queues: dict[str, deque[OutgoingMessage]] = {}
+        # Messages that failed to send, by transaction ID
+        self.failed: dict[str, OutgoingMessage] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self._callbacks: list[Callable[[OutgoingMessage], Any]] = []
+
+    def add_callback(self, callback: Callable[[OutgoingMessage], Any]):
+        """Get told whenever a message is queued or its state changes
+
+        Args:
+            callback (Callable[[OutgoingMessage], Any]): Called with the message
+        """
+        self._callbacks.append(callback)
+
+    def pending(self) -> list[OutgoingMessage]:
+        """Get every message that hasn't been sent
+
+        Returns:
+            list[OutgoingMessage]: The failed messages, then the queued ones in the order they'll be sent per room
+        """
+        return list(self.failed.values()) + [message for queue in self.queues.values() for message in queue]
+
+    def restore(self):
+        """Queue the messages left unsent by the last run again, and bring back the failed ones"""
+        for room_id, txn_id, content, created, error in self.store.load_outgoing():
+            message = OutgoingMessage(room_id, txn_id, content, created)
+            if error is None:
+                self._enqueue(message)
+                continue
+            message.state = SendState.FAILED
+            message.error = error
+            self.failed[txn_id] = message
+            self._notify(message)
+
+    def retry(self, txn_id: str) -> bool:
+        """Queue a message that failed to send again
+
+        Args:
+            txn_id (str): The message's transaction ID
+
+        Returns:
+            bool: False if there's no failed message with that ID
+        """
+        if (message := self.failed.pop(txn_id, None)) is None:
+            return False
+        message.state = SendState.PENDING
+        message.error = None
+        self.store.set_outgoing_error(txn_id, None)
+        self._enqueue(message)
+        return True
+
+    def send(self, room_id: str, content: dict) -> OutgoingMessage:
+        """Queue a message
+
+        Args:
+            room_id (str): The room to send to
+            content (dict): The event content
+
+        Returns:
+            OutgoingMessage: The queued message
+        """
+        message = OutgoingMessage(room_id, str(uuid.uuid4()), content, int(time.time() * 1000))
+        self.store.save_outgoing(room_id, message.txn_id, content, message.created)
+        self._enqueue(message)
+        return message
+
+    async def close(self):
+        """Stop sending, whatever's left stays in the store for next time"""
+        for task in self._workers.values():
+            task.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers = {}
+
+    def _enqueue(self, message: OutgoingMessage):
+        self.queues.setdefault(message.room_id, deque()).append(message)
+        self._notify(message)
+        if message.room_id not in self._workers:
+            self._workers[message.room_id] = asyncio.get_event_loop().create_task(self._run(message.room_id))
+
+    def _notify(self, message: OutgoingMessage):
+        for callback in self._callbacks:
+            callback(message)
+
+    async def _run(self, room_id: str):
+        queue = self.queues[room_id]
+        try:
+            # The next message only goes once the one before it has landed
+            while queue:
+                await self._deliver(queue[0])
+                queue.popleft()
+        finally:
+            del self._workers[room_id]
+            if not queue:
+                self.queues.pop(room_id, None)
+
+    async def _deliver(self, message: OutgoingMessage):
+        delay = self.RETRY_MIN
+        while True:
+            try:
+                response = await self.client.room_send(
+                    message.room_id, "m.room.message", message.content, tx_id=message.txn_id)
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                response = None
+                message.error = str(e)
+            except Exception as e:
+                # e.g. the room's encryption not being set up, which won't
+                # change by trying again
+                message.state = SendState.FAILED
+                message.error = str(e)
+                break
+
+            if isinstance(response, RoomSendResponse):
+                message.state = SendState.SENT
+                message.event_id = response.event_id
+                message.error = None
+                metrics.record("outbox.send_latency", time.time() - message.created / 1000)
+                break
+            if isinstance(response, ErrorResponse):
+                message.error = response.message
+                if response.status_code in self.PERMANENT_ERRORS:
+                    message.state = SendState.FAILED
+                    break
+
+            # Rate limits say how long to wait, anything else backs off
+            # exponentially. The transaction ID stops a retry of a send
+            # that did go through from posting the message twice
+            retry_after_ms = getattr(response, "retry_after_ms", None)
+            await asyncio.sleep(retry_after_ms / 1000 if retry_after_ms else delay)
+            delay = min(delay * 2, self.RETRY_MAX)
+
+        if message.state is SendState.FAILED:
+            self.failed[message.txn_id] = message
+            self.store.set_outgoing_error(message.txn_id, message.error or "unknown error")
+        else:
+            self.store.remove_outgoing(message.txn_id)
+        self._notify(message)
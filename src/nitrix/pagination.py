@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from nio import AsyncClient, Event, RoomMessagesError
+
+from nitrix.scheduler import RateLimited
+
+
+class RoomPaginator():
+    """Pages backwards through a room's history. Pages come from the local
+    store first and only hit the homeserver (via the room's stored
+    `prev_batch` token) once the store runs out.
+    """
+
+    MIN_PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 200
+
+    # Seconds of scrolling a page should cover, so the next page has time
+    # to arrive before the user reaches the top
+    LOOKAHEAD = 2
+
+    # Round trips per page before giving up on rooms with few messages
+    MAX_REQUESTS = 3
+
+    def __init__(self, client: AsyncClient, room_id: str, oldest_event_id: str | None = None):
+        self.client = client
+        self.room_id = room_id
+        self.oldest_event_id = oldest_event_id
+        self.exhausted = False
+        self._at_room_start = False
+
+    def page_size(self, velocity: float) -> int:
+        """Size the next page after how fast the user is scrolling up
+
+        Args:
+            velocity (float): Upwards scroll speed in lines per second
+
+        Returns:
+            int: Number of messages to fetch
+        """
+        # Messages are roughly two lines tall
+        size = int(velocity * self.LOOKAHEAD / 2)
+        return max(self.MIN_PAGE_SIZE, min(self.MAX_PAGE_SIZE, size))
+
+    async def fetch(self, limit: int) -> list[Event]:
+        """Get the next page of older messages
+
+        Args:
+            limit (int): The maximum number of messages
+
+        Raises:
+            RateLimited: The homeserver rate limited the request
+
+        Returns:
+            list[Event]: The messages, oldest first
+        """
+        store = self.client.event_store
+        events = store.load_events(self.room_id, limit, before=self.oldest_event_id)
+        requests = 0
+        while len(events) < limit and not self._at_room_start and requests < self.MAX_REQUESTS:
+            requests += 1
+            token = store.prev_batch(self.room_id)
+            if not token:
+                self._at_room_start = True
+                break
+
+            res = await self.client.room_messages(self.room_id, token, limit=limit - len(events))
+            if isinstance(res, RoomMessagesError):
+                if res.status_code == "M_LIMIT_EXCEEDED":
+                    raise RateLimited(res.retry_after_ms)
+                break
+
+            # Everything goes through the store so pages stay contiguous
+            store.save_events(self.room_id, res.chunk)
+            store.set_prev_batch(self.room_id, res.end if res.chunk else None)
+            if not res.chunk or not res.end:
+                self._at_room_start = True
+
+            before = events[0].event_id if events else self.oldest_event_id
+            events = store.load_events(self.room_id, limit - len(events), before=before) + events
+
+        if events:
+            self.oldest_event_id = events[0].event_id
+        self.exhausted = self._at_room_start and len(events) < limit
+        return events
@@ -0,0 +1,73 @@
+"""
+    Guessing which rooms are opened next, so they can be got ready while the
+    user isn't doing anything. Rooms score points for being under or next to
+    the room list's cursor, for being where the user usually goes from the
+    current room, and for having unread messages or mentions.
+"""
+
+from __future__ import annotations
+
+from collections import Counter, deque
+
+
+class RoomPredictor():
+    """Ranks rooms by how likely they are to be opened next
+
+    Args:
+        history (int, optional): Room switches remembered. Defaults to HISTORY.
+    """
+
+    HISTORY = 50
+
+    # Points per reason a room might be next
+    CURSOR = 8.0
+    CURSOR_NEIGHBOUR = 3.0
+    PREVIOUS = 4.0
+    TRANSITION = 2.0
+    VISIT = 0.5
+    MENTION = 4.0
+    UNREAD = 2.0
+
+    def __init__(self, history: int = HISTORY):
+        self.switches: deque[str] = deque(maxlen=history)
+
+    def record_switch(self, room_id: str):
+        """Note that a room was opened
+
+        Args:
+            room_id (str): The room
+        """
+        if not self.switches or self.switches[-1] != room_id:
+            self.switches.append(room_id)
+
+    def predict(self, current: str | None, cursor: list[str], unread: dict[str, bool], limit: int) -> list[str]:
+        """Rank the rooms most likely to be opened after the current one
+
+        Args:
+            current (str | None): The room that's open
+            cursor (list[str]): The room under the room list's cursor followed by its neighbours, if the list has focus
+            unread (dict[str, bool]): Rooms with unread messages, True for those that mention us
+            limit (int): How many rooms to return
+
+        Returns:
+            list[str]: Room IDs, most likely first
+        """
+        scores: Counter[str] = Counter()
+        for position, room_id in enumerate(cursor):
+            scores[room_id] += self.CURSOR if position == 0 else self.CURSOR_NEIGHBOUR
+
+        switches = list(self.switches)
+        # Going back to where we came from is the most common switch
+        if len(switches) >= 2 and switches[-1] == current:
+            scores[switches[-2]] += self.PREVIOUS
+        for before, after in zip(switches, switches[1:]):
+            if before == current:
+                scores[after] += self.TRANSITION
+        for room_id in switches:
+            scores[room_id] += self.VISIT
+
+        for room_id, mentioned in unread.items():
+            scores[room_id] += self.MENTION if mentioned else self.UNREAD
+
+        scores.pop(current, None)
+        return [room_id for room_id, score in scores.most_common(limit) if score > 0]
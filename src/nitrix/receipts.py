@@ -0,0 +1,167 @@
+"""
+    Read receipts and typing notifications going out. Neither is sent per
+    event or per keystroke: marking a room read only notes the latest event
+    and every room gets at most one receipt per flush, and typing is sent
+    once when it starts, renewed before the homeserver times it out, and
+    stopped once the keys go quiet.
+"""
+
+from __future__ import annotations
+
+import time
+import asyncio
+
+from aiohttp import ClientConnectionError
+from nio import AsyncClient, RoomReadMarkersResponse
+
+from nitrix.metrics import metrics
+
+
+class ReadReceipts():
+    """Read markers waiting to be sent, coalesced per room
+
+    Args:
+        client (AsyncClient): The client to send with
+    """
+
+    # Seconds between marking a room read and sending the receipt
+    DELAY = 2.0
+
+    def __init__(self, client: AsyncClient):
+        self.client = client
+        self.delay = self.DELAY
+        # Room ID -> (event ID, server timestamp) of the latest event marked read
+        self.pending: dict[str, tuple[str, int]] = {}
+        # Room ID -> server timestamp of the latest event the homeserver has as read
+        self.sent: dict[str, int] = {}
+        self._task: asyncio.Task | None = None
+
+    def mark(self, room_id: str, event_id: str, timestamp: int) -> bool:
+        """Mark a room read up to an event, sent with the next flush
+
+        Args:
+            room_id (str): The room that was read
+            event_id (str): The latest event that was read
+            timestamp (int): Server timestamp of the event in milliseconds
+
+        Returns:
+            bool: False if the room was already read up to this event
+        """
+        read = max(self.sent.get(room_id, 0), self.pending.get(room_id, ("", 0))[1])
+        if timestamp <= read or not event_id.startswith("$"):
+            return False
+        self.pending[room_id] = (event_id, timestamp)
+        metrics.increment("receipts.marked")
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._flush_later())
+        return True
+
+    def read_elsewhere(self, room_id: str, timestamp: int):
+        """Note a receipt sent by another of our devices, so nothing older
+        gets sent after it
+
+        Args:
+            room_id (str): The room that was read
+            timestamp (int): Server timestamp of the event read up to in milliseconds
+        """
+        self.sent[room_id] = max(self.sent.get(room_id, 0), timestamp)
+        if self.pending.get(room_id, ("", timestamp + 1))[1] <= timestamp:
+            del self.pending[room_id]
+
+    async def flush(self):
+        """Send every pending receipt now, one request per room"""
+        pending, self.pending = self.pending, {}
+        await asyncio.gather(*(
+            self._send(room_id, event_id, timestamp)
+            for room_id, (event_id, timestamp) in pending.items()
+        ))
+
+    async def close(self):
+        """Send what's pending instead of waiting for the delay"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self._task = None
+        await self.flush()
+
+    async def _send(self, room_id: str, event_id: str, timestamp: int):
+        try:
+            response = await self.client.room_read_markers(room_id, event_id, event_id)
+        except (ClientConnectionError, asyncio.TimeoutError):
+            response = None
+        if isinstance(response, RoomReadMarkersResponse):
+            metrics.increment("receipts.sent")
+            self.sent[room_id] = max(self.sent.get(room_id, 0), timestamp)
+            return
+        # Tried again with the next flush, unless something newer is marked by then
+        if room_id not in self.pending:
+            self.pending[room_id] = (event_id, timestamp)
+
+
+class TypingNotifier():
+    """Typing notifications for the room being typed in
+
+    Args:
+        client (AsyncClient): The client to send with
+    """
+
+    # Seconds the homeserver shows us typing for, renewed halfway through
+    TIMEOUT = 30
+    # Seconds without a keystroke before we stop typing
+    IDLE = 5.0
+
+    def __init__(self, client: AsyncClient):
+        self.client = client
+        self.enabled = True
+        self.idle = self.IDLE
+        # The room we're shown typing in, and when that was last sent
+        self.room_id: str | None = None
+        self.sent_at = 0.0
+        self._stop: asyncio.TimerHandle | None = None
+        # Keeps a start and the stop after it from overtaking each other
+        self._lock = asyncio.Lock()
+
+    def keystroke(self, room_id: str):
+        """Note a keystroke in a room's message box
+
+        Args:
+            room_id (str): The room being typed in
+        """
+        if not self.enabled:
+            return
+        if self.room_id is not None and self.room_id != room_id:
+            self.stop()
+        now = time.monotonic()
+        if self.room_id is None or now - self.sent_at > self.TIMEOUT / 2:
+            self.room_id = room_id
+            self.sent_at = now
+            self._send(room_id, True)
+        if self._stop is not None:
+            self._stop.cancel()
+        self._stop = asyncio.get_event_loop().call_later(self.idle, self.stop)
+
+    def stop(self):
+        """Stop typing, e.g. once the message is sent or the box is cleared"""
+        if self._stop is not None:
+            self._stop.cancel()
+            self._stop = None
+        if self.room_id is None:
+            return
+        room_id, self.room_id = self.room_id, None
+        self._send(room_id, False)
+
+    def _send(self, room_id: str, typing: bool):
+        asyncio.get_event_loop().create_task(self._request(room_id, typing))
+
+    async def _request(self, room_id: str, typing: bool):
+        async with self._lock:
+            metrics.increment("typing.sent")
+            try:
+                await self.client.room_typing(room_id, typing, timeout=self.TIMEOUT * 1000)
+            except (ClientConnectionError, asyncio.TimeoutError):
+                # Typing is only a hint, it times out by itself anyway
+                pass
@@ -0,0 +1,181 @@
+"""
+    Recordings of sync traffic. Every sync and /messages response is written
+    as it arrives, with the time it arrived, to a gzipped JSON lines file
+    under the config folder, which `nitrix replay` plays back. Credentials
+    are never written, and sync and pagination tokens are swapped for
+    placeholders that still match up with each other.
+"""
+
+from __future__ import annotations
+
+import re
+import gzip
+import json
+import time
+import zlib
+import threading
+
+from pathlib import Path
+from typing import Iterator
+from urllib.parse import urlparse
+
+from aiohttp import ClientResponse
+from nio.responses import RoomMessagesResponse, SyncResponse
+
+from nitrix.utils import NitrixConfig
+
+# Version of the recording format, in the first line of every recording
+FORMAT = 1
+
+# Response classes that get recorded, and what they're recorded as
+RECORDED = {SyncResponse: "sync", RoomMessagesResponse: "messages"}
+
+# Keys whose values are dropped wherever they turn up
+SECRET_KEYS = {"access_token", "refresh_token", "password", "token"}
+
+# Keys holding sync and pagination tokens
+TOKEN_KEYS = {"next_batch", "prev_batch", "start", "end", "since"}
+
+# Parts of a sync response that are only about our devices and keys
+DEVICE_KEYS = {"to_device", "device_lists", "device_one_time_keys_count", "device_unused_fallback_key_types"}
+
+
+class TrafficRecorder():
+    """Writes responses to a recording, from any thread
+
+    Args:
+        path (Path): The recording to write
+        user_id (str): The account the traffic belongs to
+    """
+
+    # Seconds between flushes, so a recording of a frozen client that had
+    # to be killed is readable up to the last second or so
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path: Path, user_id: str):
+        self.path = path
+        self.started = time.monotonic()
+        self.tokens: dict[str, str] = {}
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._flushed = self.started
+        self._write({"format": FORMAT, "user_id": user_id, "started": time.time()})
+
+    @classmethod
+    def for_account(cls, homeserver: str, user_id: str) -> TrafficRecorder:
+        """Start a new recording of an account in the config folder
+
+        Args:
+            homeserver (str): The account's homeserver
+            user_id (str): The account's user ID
+
+        Returns:
+            TrafficRecorder: The recorder
+        """
+        host = urlparse(homeserver).netloc or homeserver
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", f"{user_id.lstrip('@').split(':')[0]}_{host}")
+        folder = NitrixConfig().config_folder / "recordings"
+        folder.mkdir(parents=True, exist_ok=True)
+        return cls(folder / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl.gz", user_id)
+
+    async def add(self, response_class: type, transport_response: ClientResponse, room_id: str | None = None):
+        """Record a response, if it's a successful one of a kind that's recorded
+
+        Args:
+            response_class (type): The nio response class the body was parsed as
+            transport_response (ClientResponse): The HTTP response, its body already read
+            room_id (str | None, optional): The room of a /messages response. Defaults to None.
+        """
+        kind = RECORDED.get(response_class)
+        if kind is None or transport_response.status != 200:
+            return
+        # aiohttp keeps the body once read, so this doesn't go to the network again
+        body = await transport_response.json()
+        self.record(kind, body, room_id)
+
+    def record(self, kind: str, body: dict, room_id: str | None = None):
+        """Record a response body
+
+        Args:
+            kind (str): "sync" or "messages"
+            body (dict): The response body
+            room_id (str | None, optional): The room of a /messages response. Defaults to None.
+        """
+        entry = {"t": round(time.monotonic() - self.started, 4), "kind": kind}
+        if room_id is not None:
+            entry["room_id"] = room_id
+        with self._lock:
+            if self._file is None:
+                return
+            entry["body"] = self.scrub(body)
+            self._write(entry)
+
+    def scrub(self, value, tokens: bool = True):
+        """Copy a response body without secrets, device keys or real tokens
+
+        Args:
+            value (Any): The body, or a part of it
+            tokens (bool, optional): Whether tokens can be in this part. Events, which come in lists, have none. Defaults to True.
+
+        Returns:
+            Any: The scrubbed copy
+        """
+        if isinstance(value, list):
+            return [self.scrub(item, tokens=False) for item in value]
+        if not isinstance(value, dict):
+            return value
+        scrubbed = {}
+        for key, item in value.items():
+            if key in SECRET_KEYS or key in DEVICE_KEYS:
+                continue
+            if tokens and key in TOKEN_KEYS and isinstance(item, str):
+                scrubbed[key] = self.tokens.setdefault(item, f"t{len(self.tokens)}")
+            else:
+                scrubbed[key] = self.scrub(item, tokens)
+        return scrubbed
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        if (now := time.monotonic()) - self._flushed > self.FLUSH_INTERVAL:
+            self._file.flush()
+            self._flushed = now
+
+
+def read_recording(path: Path) -> tuple[dict, Iterator[dict]]:
+    """Open a recording
+
+    Args:
+        path (Path): The recording
+
+    Raises:
+        ValueError: The file isn't a recording, or one in a newer format
+
+    Returns:
+        tuple[dict, Iterator[dict]]: Its header, and its entries in the order they were recorded
+    """
+    file = gzip.open(path, "rt", encoding="utf-8")
+    try:
+        header = json.loads(file.readline())
+    except (OSError, EOFError, zlib.error, json.JSONDecodeError) as e:
+        file.close()
+        raise ValueError(f"{path} isn't a recording") from e
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        file.close()
+        raise ValueError(f"{path} isn't a recording nitrix can replay")
+
+    def entries():
+        with file:
+            try:
+                for line in file:
+                    yield json.loads(line)
+            except (EOFError, zlib.error, json.JSONDecodeError):
+                # Recordings of a client that was killed just stop
+                return
+
+    return header, entries()
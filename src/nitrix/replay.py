@@ -0,0 +1,246 @@
+"""
+    Plays a recording of sync traffic back through the app, headless, so a
+    freeze seen with real traffic can be reproduced and a fix measured
+    against the same traffic. Syncs are applied at the pace they were
+    recorded at, sped up, or as fast as the interface keeps up, and scrolling
+    back is answered with the recorded /messages responses.
+
+    nitrix replay RECORDING [--speed 1 | --max] [--room ROOM] [--size 120x40]
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+from collections import deque
+from pathlib import Path
+
+from textual import events
+
+from nio import ErrorResponse, responses
+from nio.responses import RoomMessagesResponse, SyncResponse
+
+from nitrix.app import NitrixApp
+from nitrix.client import NitrixClient
+from nitrix.metrics import LagProbe, metrics
+from nitrix.recording import read_recording
+from nitrix.scheduler import RequestScheduler
+from nitrix.store import EventStore
+from nitrix.utils import NitrixConfig
+
+# Syncs handed to the interface before waiting for it, like the sync engine's queue
+MAX_IN_FLIGHT = 2
+
+
+class ReplayClient(NitrixClient):
+    """A client that never touches the network. /messages is answered from
+    the recording, room by room in the order it was recorded, and every
+    other request fails the way it would without a homeserver.
+    """
+
+    HOMESERVER = "https://replay.invalid"
+
+    def __init__(self, user_id: str, event_store: EventStore, scheduler: RequestScheduler):
+        super().__init__(self.HOMESERVER, user_id, "Nitrix", event_store=event_store, scheduler=scheduler)
+        # Logged in as far as nio can tell, nothing is ever sent with it
+        self.restore_login(user_id, "Nitrix", "replay")
+        self.pages: dict[str, deque[dict]] = {}
+
+    async def _send(self, response_class: type, method: str, path: str, data=None, response_data=None, *args, **kwargs):
+        if response_class is RoomMessagesResponse:
+            room_id = response_data[0]
+            pages = self.pages.get(room_id)
+            # Past what was recorded the room seems to have no more history
+            body = pages.popleft() if pages else {"chunk": [], "start": "", "end": None}
+            return RoomMessagesResponse.from_dict(body, room_id)
+        # e.g. DownloadResponse -> DownloadError
+        error_class = getattr(responses, response_class.__name__.replace("Response", "Error"), ErrorResponse)
+        if not (isinstance(error_class, type) and issubclass(error_class, ErrorResponse)):
+            error_class = ErrorResponse
+        return error_class("Not available in a replay", "M_NOT_FOUND")
+
+
+class ReplayApp(NitrixApp):
+    """The app showing the main screen straight away for a replay client"""
+
+    def __init__(self, client: ReplayClient, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replay_client = client
+
+    async def on_mount(self, event: events.Mount):
+        # Instead of NitrixApp's, which would show the login form and log in
+        event.prevent_default()
+        self.client = None
+        self.clients = []
+        self.current_room = None
+        self.connections = None
+        self.sync_thread = None
+        self.media = None
+        self.senders = None
+        # Played back with the settings nitrix is run with
+        self.config = NitrixConfig()
+        # What's reported comes from the metrics, so they're always on
+        metrics.configure(True, self.config.get_config("Performance", "metrics_export"))
+        await self.start_session()
+        self.add_client(self.replay_client)
+        await self.push_screen("main")
+
+
+def busiest_room(syncs: list[tuple[float, dict]]) -> str | None:
+    """The room with the most timeline events in a recording"""
+    counts: dict[str, int] = {}
+    for _, body in syncs:
+        for room_id, room in body.get("rooms", {}).get("join", {}).items():
+            counts[room_id] = counts.get(room_id, 0) + len(room.get("timeline", {}).get("events", []))
+    return max(counts, key=counts.get) if counts else None
+
+
+async def replay(app: ReplayApp, syncs: list[tuple[float, dict]], speed: float | None, room: str | None) -> dict:
+    """Feed the recorded syncs through the client and the app, the way the
+    sync engine does
+
+    Args:
+        app (ReplayApp): The running app
+        syncs (list[tuple[float, dict]]): When each sync arrived in seconds, and its body
+        speed (float | None): How much faster than recorded to play, None for as fast as possible
+        room (str | None): The room to have open
+
+    Returns:
+        dict: The results
+    """
+    from nitrix.screens import MainScreen
+
+    client = app.replay_client
+    while not isinstance(app.screen, MainScreen):
+        await asyncio.sleep(0.01)
+    probe = LagProbe()
+    probe.start()
+
+    in_flight: deque[asyncio.Future] = deque()
+    events = 0
+    opened = False
+    start = time.perf_counter()
+    first = syncs[0][0] if syncs else 0
+    for arrived, body in syncs:
+        if speed is not None:
+            await asyncio.sleep(max(0, start + (arrived - first) / speed - time.perf_counter()))
+        response = SyncResponse.from_dict(body)
+        if not isinstance(response, SyncResponse):
+            continue
+        events += sum(len(info.timeline.events) for info in response.rooms.join.values())
+        await client.receive_response(response)
+        await client.run_response_callbacks([response])
+
+        # Wait for the screen to get through all but the latest few updates
+        done = asyncio.get_event_loop().create_future()
+        app.screen.call_later(lambda done=done: done.done() or done.set_result(None))
+        in_flight.append(done)
+        while len(in_flight) > MAX_IN_FLIGHT:
+            await in_flight.popleft()
+
+        if not opened and room in response.rooms.join:
+            # Opened once it's in the room list, to have its messages rendered
+            await asyncio.sleep(0)
+            rooms_container = app.screen.query_one("RoomsContainer")
+            if (btn := rooms_container.buttons.get(room)) is not None:
+                btn.value = True
+                opened = True
+                messages_container = app.screen.query_one("MessagesContainer")
+                while messages_container.displayed_room != room:
+                    await asyncio.sleep(0.01)
+    for done in in_flight:
+        await done
+    # and for what they changed to be painted
+    painted = asyncio.get_event_loop().create_future()
+    app.screen.call_after_refresh(lambda: painted.done() or painted.set_result(None))
+    app.screen.refresh()
+    await painted
+    elapsed = time.perf_counter() - start
+    probe.stop()
+
+    histograms = metrics.snapshot()["histograms"]
+    return {
+        "syncs": len(syncs),
+        "events": events,
+        "seconds": elapsed,
+        "events_per_sec": events / elapsed if elapsed else 0.0,
+        "apply": histograms.get("sync.apply_ui"),
+        "rendered": histograms.get("event.received_to_rendered"),
+        "lag_p95": probe.percentile(95),
+        "lag_max": max(probe.lags, default=0.0),
+    }
+
+
+def report(results: dict, room: str | None) -> str:
+    lines = [
+        f"replayed {results['syncs']} syncs, {results['events']} events in {results['seconds']:.2f} s"
+        f" ({results['events_per_sec']:.0f} events/s)",
+    ]
+    if room:
+        lines.append(f"  open room                 {room}")
+    for name, label in (("apply", "sync applied"), ("rendered", "received to rendered")):
+        if (stats := results[name]):
+            lines.append(
+                f"  {label:<24}  p50 {stats['p50'] * 1000:8.1f} ms  p95 {stats['p95'] * 1000:8.1f} ms"
+                f"  max {stats['max'] * 1000:8.1f} ms")
+    lines.append(
+        f"  {'event loop lag':<24}  p95 {results['lag_p95'] * 1000:8.1f} ms  max {results['lag_max'] * 1000:8.1f} ms")
+    return "\n".join(lines)
+
+
+async def run(options: argparse.Namespace) -> int:
+    try:
+        header, entries = read_recording(options.recording)
+    except (OSError, ValueError) as e:
+        print(f"nitrix replay: {e}", file=sys.stderr)
+        return 2
+
+    with tempfile.TemporaryDirectory() as folder:
+        # The replay gets a store of its own, so what's saved for the real account stays as it is
+        store = EventStore(Path(folder) / "replay.db")
+        store.save_session(ReplayClient.HOMESERVER, header["user_id"], "Nitrix", "")
+        client = ReplayClient(header["user_id"], store, RequestScheduler(4))
+        client.add_response_callback(store.save_sync, SyncResponse)
+
+        syncs = []
+        for entry in entries:
+            if entry["kind"] == "sync":
+                syncs.append((entry["t"], entry["body"]))
+            elif entry["kind"] == "messages":
+                client.pages.setdefault(entry["room_id"], deque()).append(entry["body"])
+        room = options.room or busiest_room(syncs)
+
+        results = {}
+
+        async def drive(pilot):
+            results.update(await replay(app, syncs, None if options.max else options.speed, room))
+            app.exit()
+
+        width, _, height = options.size.partition("x")
+        app = ReplayApp(client)
+        await app.run_async(headless=True, size=(int(width), int(height)), auto_pilot=drive)
+        store.close()
+
+    if not results:
+        print("nitrix replay: the replay didn't finish", file=sys.stderr)
+        return 1
+    print(report(results, room))
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="nitrix replay", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("recording", type=Path, help="Recording to play, from the recordings folder in the config folder")
+    parser.add_argument("--speed", type=float, default=1.0, help="How many times faster than recorded to play")
+    parser.add_argument("--max", action="store_true", help="Play as fast as the interface keeps up")
+    parser.add_argument("--room", help="Room ID to have open. Defaults to the room with the most events")
+    parser.add_argument("--size", default="120x40", help="Terminal size to render at")
+    options = parser.parse_args(argv)
+    try:
+        return asyncio.run(run(options))
+    except KeyboardInterrupt:
+        return 130
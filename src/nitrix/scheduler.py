@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import enum
+import heapq
+import asyncio
+import itertools
+
+from typing import Any, Awaitable, Callable, Hashable
+
+from nio import ErrorResponse
+
+
+class Priority(enum.IntEnum):
+    """Order in which queued requests are sent, lowest first"""
+    CURRENT = 0
+    VISIBLE = 1
+    UNREAD = 2
+    BACKGROUND = 3
+
+
+class RateLimited(Exception):
+    """Raised by a request to have it retried once the rate limit passes"""
+
+    def __init__(self, retry_after_ms: int | None = None):
+        self.retry_after_ms = retry_after_ms
+        super().__init__(f"Rate limited, retry after {retry_after_ms}ms")
+
+
+class _Job():
+    def __init__(self, factory: Callable[[], Awaitable[Any]], priority: Priority, future: asyncio.Future):
+        self.factory = factory
+        self.priority = priority
+        self.future = future
+
+
+class RequestScheduler():
+    """Runs homeserver requests through a priority queue with a cap on how
+    many are in flight at once. Requests are keyed so they can be
+    re-prioritized or cancelled while queued.
+    """
+
+    # Back off used when the homeserver doesn't say how long to wait
+    DEFAULT_BACKOFF_MS = 5000
+
+    def __init__(self, concurrency: int = 4):
+        self.concurrency = concurrency
+        self._queue: list[tuple[int, int, Hashable]] = []
+        self._pending: dict[Hashable, _Job] = {}
+        self._running: dict[Hashable, tuple[_Job, asyncio.Task]] = {}
+        self._counter = itertools.count()
+        self._resume_at = 0.0
+        self._wakeup: asyncio.TimerHandle | None = None
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._pending or key in self._running
+
+    def submit(self, key: Hashable, factory: Callable[[], Awaitable[Any]], priority: Priority = Priority.BACKGROUND) -> asyncio.Future:
+        """Queue a request. Submitting a key that's already queued or running
+        returns the existing request, bumping its priority if needed.
+
+        Args:
+            key (Hashable): Identifies the request
+            factory (Callable[[], Awaitable[Any]]): Creates the request's coroutine when it's its turn
+            priority (Priority, optional): Priority of the request. Defaults to Priority.BACKGROUND.
+
+        Returns:
+            asyncio.Future: Resolves to the request's result
+        """
+        if key in self._running:
+            return self._running[key][0].future
+        if key in self._pending:
+            self.reprioritize(key, min(priority, self._pending[key].priority))
+            return self._pending[key].future
+
+        job = _Job(factory, priority, asyncio.get_event_loop().create_future())
+        self._pending[key] = job
+        heapq.heappush(self._queue, (priority, next(self._counter), key))
+        self._dispatch()
+        return job.future
+
+    def reprioritize(self, key: Hashable, priority: Priority):
+        """Change the priority of a queued request
+
+        Args:
+            key (Hashable): The request to change
+            priority (Priority): Its new priority
+        """
+        job = self._pending.get(key)
+        if job is None or job.priority == priority:
+            return
+        # The old heap entry is skipped when popped as its priority is stale
+        job.priority = priority
+        heapq.heappush(self._queue, (priority, next(self._counter), key))
+
+    def cancel(self, key: Hashable):
+        """Drop a queued request or cancel it if it's already in flight
+
+        Args:
+            key (Hashable): The request to cancel
+        """
+        if (job := self._pending.pop(key, None)):
+            job.future.cancel()
+        elif key in self._running:
+            self._running[key][1].cancel()
+
+    def back_off(self, retry_after_ms: int | None = None):
+        """Hold off on sending anything new for a while
+
+        Args:
+            retry_after_ms (int | None, optional): How long to wait. Defaults to DEFAULT_BACKOFF_MS.
+        """
+        loop = asyncio.get_event_loop()
+        resume_at = loop.time() + (retry_after_ms or self.DEFAULT_BACKOFF_MS) / 1000
+        self._resume_at = max(self._resume_at, resume_at)
+
+    def on_response(self, response: ErrorResponse):
+        """Response callback backing off whenever the homeserver rate limits us
+
+        Args:
+            response (ErrorResponse): Any error response from the client
+        """
+        if response.status_code in ("M_LIMIT_EXCEEDED", 429):
+            self.back_off(response.retry_after_ms)
+
+    def _dispatch(self):
+        loop = asyncio.get_event_loop()
+        if (delay := self._resume_at - loop.time()) > 0:
+            if self._wakeup is None:
+                self._wakeup = loop.call_later(delay, self._resume)
+            return
+
+        while self._queue and len(self._running) < self.concurrency:
+            priority, _, key = heapq.heappop(self._queue)
+            job = self._pending.get(key)
+            if job is None or job.priority != priority:
+                continue
+            del self._pending[key]
+            if job.future.done():
+                # Whoever was waiting on it has gone away
+                continue
+            self._running[key] = (job, loop.create_task(self._run(key, job)))
+
+    def _resume(self):
+        self._wakeup = None
+        self._dispatch()
+
+    async def _run(self, key: Hashable, job: _Job):
+        try:
+            result = await job.factory()
+        except RateLimited as e:
+            # Put the request back in line and pause everything until the
+            # homeserver is willing to talk to us again
+            self.back_off(e.retry_after_ms)
+            del self._running[key]
+            self._pending[key] = job
+            heapq.heappush(self._queue, (job.priority, next(self._counter), key))
+        except asyncio.CancelledError:
+            del self._running[key]
+            job.future.cancel()
+        except Exception as e:
+            del self._running[key]
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            del self._running[key]
+            if not job.future.done():
+                job.future.set_result(result)
+        self._dispatch()
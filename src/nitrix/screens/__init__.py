@@ -1,3 +1,18 @@
-from .login.screen import LoginScreen
-from .main.screen import MainScreen
-from .popup.screen import PopupScreen
\ No newline at end of file
+import importlib
+
+# Screens are imported when they're first asked for, so importing one
+# doesn't load every other screen and whatever they depend on
+_SCREENS = {
+    "LoginScreen": ".login.screen",
+    "MainScreen": ".main.screen",
+    "PopupScreen": ".popup.screen",
+    "SearchScreen": ".search.screen",
+}
+
+__all__ = list(_SCREENS)
+
+
+def __getattr__(name: str):
+    if name not in _SCREENS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_SCREENS[name], __name__), name)
@@ -1,14 +1,13 @@
 import json
+import asyncio
 
 from pathlib import Path
 
-from nio import AsyncClient, RoomMessageText
-
 from textual.screen import Screen
 from textual.widgets import Input, Button, Checkbox
 from textual.containers import Container, Center, Horizontal, Vertical
 
-from nitrix.client import client_factory
+from nitrix.startup import startup
 from nitrix.utils import NitrixConfig
 
 
@@ -74,9 +73,17 @@ class LoginScreen(Screen):
         username.value = config.get_config("Credentials", "username") or ""
         password.value = config.get_config("Credentials", "password") or ""
         
-       
-
+        # Logging in waits until the form is on screen
+        self.call_after_refresh(self.after_first_paint)
+        
+    async def after_first_paint(self):
+        startup.mark("first_paint")
+        if startup.enabled:
+            self.app.exit()
+            return
+        
         # If we were able to get the login information, attempt to login
+        homeserver, username, password = self.get_inputs()
         if homeserver.value and username.value and password.value:
             await self.try_login()
         
@@ -97,6 +104,26 @@ class LoginScreen(Screen):
                 self.app.push_screen(PopupScreen(message="Error: Could not login"))
 
         
+    async def add_other_accounts(self):
+        """Log in to every other account saved in the config, side by side"""
+        from nio import AsyncClient
+        from nitrix.client import client_factory
+        
+        logins = [
+            login for login in NitrixConfig().get_accounts()
+            if login[:2] != (self.app.client.homeserver, self.app.client.user)
+        ]
+        clients = await asyncio.gather(*(
+            client_factory(*login, connections=self.app.connections, sync_thread=self.app.sync_thread)
+            for login in logins
+        ), return_exceptions=True)
+        for login, client in zip(logins, clients):
+            if isinstance(client, AsyncClient):
+                self.app.add_client(client)
+            else:
+                # One account failing shouldn't keep the others out
+                self.log.error("Could not log in", homeserver=login[0], username=login[1], error=client)
+        
     async def try_login(self):
 
 
@@ -107,19 +134,26 @@ class LoginScreen(Screen):
         """
         homeserver, username, password = self.get_inputs()
         
+        # nio and friends only get loaded now
+        await self.app.start_session()
+        from nitrix.client import client_factory
+        
         # Attempt to create a client
-        if (client := await client_factory(homeserver.value, username.value, password.value)):
-            # On successful client creation, add an event callback and
-            # store the client object in the app
-            client.add_event_callback(self.app.room_message_callback, RoomMessageText)
-            self.app.client = client
+        if (client := await client_factory(
+                homeserver.value, username.value, password.value,
+                connections=self.app.connections, sync_thread=self.app.sync_thread)):
+            # On successful client creation, store the client object in
+            # the app, which adds its sync callback
+            self.app.add_client(client)
             
             # If the remember me flag was checked, save the login info
             if self.query_one("#remember_me").value:
                 self.save_login(homeserver.value, username.value, password.value)
-            
-            # If we successfully logged in, switch to the main screen
+                
+            # If we successfully logged in, switch to the main screen. The
+            # other accounts join it as they log in, rather than holding it up
             self.app.switch_screen("main")
+            self.app.run_worker(self.add_other_accounts(), group="accounts")
             return
 
         raise LoginError
\ No newline at end of file
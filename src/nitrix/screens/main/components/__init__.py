@@ -1,3 +1,5 @@
 from .room_browser import RoomsContainer
 from .messages import MessagesContainer
-from .message_box import MessageBox
\ No newline at end of file
+from .message_box import MessageBox
+from .member_list import MemberList
+from .performance import PerformanceOverlay
\ No newline at end of file
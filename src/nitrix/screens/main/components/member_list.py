@@ -0,0 +1,135 @@
+"""
+    The member roster of the open room. Members are fetched when a room is
+    opened, and rooms can have tens of thousands of them, so the roster is
+    drawn with the line API: only the lines on screen are rendered, and the
+    list is kept sorted as members come and go instead of sorted again.
+    Names and colours are kept per roster rather than in the app's
+    `SenderCache`, which scrolling through a big room would empty of the
+    senders the timelines need.
+"""
+
+from __future__ import annotations
+
+import bisect
+
+from rich.segment import Segment
+
+from textual.geometry import Size
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
+
+from nio import MatrixUser
+
+from nitrix.members import Sender, localpart
+from nitrix.utils import get_user_id_colour
+
+
+class MemberList(ScrollView, can_focus=True):
+    """Members of the open room, admins and moderators first, then by name"""
+
+    COMPONENT_CLASSES = {
+        "member-list--header",
+        "member-list--username-1",
+        "member-list--username-2",
+        "member-list--username-3",
+        "member-list--username-4",
+        "member-list--username-5",
+        "member-list--username-6",
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_id: str | None = None
+        # Sort keys of the members, in order, and the key of every member
+        self._keys: list[tuple[int, str, str]] = []
+        self._key_of: dict[str, tuple[int, str, str]] = {}
+        # The members that have been on screen, by user ID
+        self._senders: dict[str, Sender] = {}
+
+    def on_mount(self):
+        self.display = False
+
+    @staticmethod
+    def _key(user: MatrixUser) -> tuple[int, str, str]:
+        return (-user.power_level, (user.display_name or localpart(user.user_id)).casefold(), user.user_id)
+
+    def show_room(self, room_id: str | None):
+        """Show the members of a room. Does nothing while the roster is hidden.
+
+        Args:
+            room_id (str | None): The room
+        """
+        self.room_id = room_id
+        if not self.display:
+            return
+        room = self.app.get_room(room_id) if room_id else None
+        users = room.users.values() if room is not None else ()
+        self._key_of = {user.user_id: self._key(user) for user in users}
+        self._keys = sorted(self._key_of.values())
+        self._senders = {}
+        self._resize()
+        self.scroll_home(animate=False, immediate=True)
+        self.refresh()
+
+    def members_loaded(self, room_id: str):
+        """Show the full member list of a room once it's been fetched
+
+        Args:
+            room_id (str): The room
+        """
+        if room_id == self.room_id:
+            self.show_room(room_id)
+
+    def update_members(self, user_ids: set[str]):
+        """Move, add or remove members that changed, e.g. from sync
+
+        Args:
+            user_ids (set[str]): The members that joined, left or were renamed
+        """
+        if not self.display or self.room_id is None:
+            return
+        room = self.app.get_room(self.room_id)
+        for user_id in user_ids:
+            self._senders.pop(user_id, None)
+            if (old := self._key_of.pop(user_id, None)) is not None:
+                del self._keys[bisect.bisect_left(self._keys, old)]
+            if room is not None and (user := room.users.get(user_id)) is not None:
+                key = self._key_of[user_id] = self._key(user)
+                bisect.insort(self._keys, key)
+        self._resize()
+        self.refresh()
+
+    def _resize(self):
+        # A header line, then a line per member
+        self.virtual_size = Size(self.scrollable_content_region.width, len(self._keys) + 1)
+
+    def on_resize(self):
+        self._resize()
+
+    def render_line(self, y: int) -> Strip:
+        width = self.scrollable_content_region.width
+        index = self.scroll_offset.y + y
+        if index == 0:
+            room = self.app.get_room(self.room_id) if self.room_id else None
+            if room is None:
+                text = ""
+            elif room.members_synced:
+                text = f"Members ({len(self._keys)})"
+            else:
+                text = "Loading members..."
+            style = self.get_component_rich_style("member-list--header")
+            return Strip([Segment(text, style)]).adjust_cell_length(width, self.rich_style)
+        if index > len(self._keys):
+            return Strip.blank(width, self.rich_style)
+
+        sender = self._sender(self._keys[index - 1][2])
+        style = self.get_component_rich_style(f"member-list--username-{sender.colour}")
+        return Strip([Segment(sender.name, style)]).adjust_cell_length(width, self.rich_style)
+
+    def _sender(self, user_id: str) -> Sender:
+        if (sender := self._senders.get(user_id)) is None:
+            room = self.app.get_room(self.room_id)
+            name = (room.user_name(user_id) if room is not None else None) or localpart(user_id)
+            # Straight past get_user_id_colour's cache, which the timelines use
+            sender = self._senders[user_id] = Sender(user_id, name, get_user_id_colour.__wrapped__(user_id))
+        return sender
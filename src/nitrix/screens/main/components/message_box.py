@@ -1,27 +1,50 @@
 from textual import events
 from textual.widgets import TextArea, Input
 
+from nio import MatrixRoom
+
 class MessageBox(Input):
-    
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, classes='message-box', **kwargs)
-    
-    async def send_message(self, body):
-        await self.app.client.room_send(
-            room_id=self.app.current_room,
-            message_type="m.room.message",
-            content={"msgtype": "m.text", "body": body},
-        )
-    
-    async def on_input_submitted(self):
-        print(self.app.current_room)
+
+    def on_input_changed(self, event: Input.Changed):
         if not self.app.current_room:
             return
-        
+        # The notifier only sends when typing starts, is renewed, or stops
+        typing = self.app.client_for(self.app.current_room).typing
+        if self.value:
+            typing.keystroke(self.app.current_room)
+        else:
+            typing.stop()
+
+    async def on_input_submitted(self):
+        if not self.app.current_room or not self.value:
+            return
+
         body = self.value
         self.value = ""
-        
-        self.run_worker(self.send_message(body))
-        
-        
-        
\ No newline at end of file
+
+        # The outbox echoes the message straight away and sends it in the background
+        client = self.app.client_for(self.app.current_room)
+        client.typing.stop()
+        client.outbox.send(self.app.current_room, {"msgtype": "m.text", "body": body})
+
+    def show_typing(self, room: MatrixRoom | None):
+        """Say who else is typing in the room being shown
+
+        Args:
+            room (MatrixRoom | None): The room, None if there isn't one
+        """
+        users = [] if room is None else [
+            room.user_name(user_id) or user_id for user_id in room.typing_users if user_id != room.own_user_id
+        ]
+        if not users:
+            self.placeholder = ""
+        elif len(users) == 1:
+            self.placeholder = f"{users[0]} is typing…"
+        elif len(users) < 4:
+            self.placeholder = f"{', '.join(users[:-1])} and {users[-1]} are typing…"
+        else:
+            self.placeholder = "Several people are typing…"
+
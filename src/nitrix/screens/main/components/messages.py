@@ -1,210 +1,728 @@
 from __future__ import annotations
 
+import time
 import typing
-import datetime
+import asyncio
+import pathlib
 
-from textual.containers import VerticalScroll, Vertical, Horizontal
-from textual.reactive import reactive
-from textual.widgets import Label, Static, ContentSwitcher
-from textual.css.query import NoMatches
+from collections import OrderedDict, deque
 
-from nio import RoomMessageText, MatrixRoom
+from textual.containers import Vertical
 
-from nitrix.utils import clean_room_id, get_user_id_colour
+from nio import AsyncClient, Event, RoomMessageText, MatrixRoom
+from nio.responses import SyncResponse
 
-class NewMessagesStart():
-    ...
+from nitrix.media import MEDIA_EVENTS, MediaError, is_media
+from nitrix.metrics import metrics
+from nitrix.outbox import OutgoingMessage, SendState
+from nitrix.pagination import RoomPaginator
+from nitrix.prewarm import RoomPredictor
+from nitrix.scheduler import Priority
+from nitrix.timeline import RoomTimeline, apply_edit, edited_event_id
 
-class MessageContent(Vertical):
+from .timeline import MessageTimeline, TimelineLayout
+
+class MessagesContainer(Vertical):
     
-    def __init__(self, message: RoomMessageText, *args, **kwargs):
-        
-        self.sender_id = message.sender
-        self.sender = message.sender[1:].split(":")[0]
-        self.messages = []
+    # Default memory budgets, overridable in the Performance section of
+    # the config. Rooms over the event budget drop their oldest events
+    # once they're out of view, and only the most recently viewed rooms
+    # keep their laid out rows around
+    MAX_ROOM_EVENTS = 1000
+    MAX_LIVE_ROOMS = 10
+    
+    # Rooms likely to be opened next that get laid out and rendered ahead,
+    # once the keys have been quiet for PREWARM_IDLE seconds, in slices of
+    # at most PREWARM_SLICE seconds so typing never waits on them
+    PREWARM_ROOMS = 3
+    PREWARM_IDLE = 0.5
+    PREWARM_SLICE = 0.004
+    PREWARM_INTERVAL = 0.5
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, classes='message-container', **kwargs)
+        self.messages: dict[str, RoomTimeline] = {}
+        # Layouts of the most recently viewed rooms, least recent first
+        self.layouts: OrderedDict[str, TimelineLayout] = OrderedDict()
+        # Where the new messages marker goes in rooms without a layout
+        self.unread_after: dict[str, str | None] = {}
+        self.paginators: dict[str, RoomPaginator] = {}
+        # Transaction IDs of sent messages whose local echo is still showing, by event ID
+        self.sent: dict[str, str] = {}
+        self.displayed_room: str | None = None
+        self.max_room_events = self.MAX_ROOM_EVENTS
+        self.max_live_rooms = self.MAX_LIVE_ROOMS
+        self.predictor = RoomPredictor()
+        self.prewarm_rooms = self.PREWARM_ROOMS
+        # Rooms laid out ahead that haven't been opened since, and the rooms
+        # still to get through this round
+        self.prewarmed: set[str] = set()
+        self.predicted: list[str] = []
+        self._prewarm_queue: deque[str] = deque()
+        self._prewarm_scheduled = False
         
-        message_time = message.server_timestamp / 1000
-        message_time = datetime.datetime.fromtimestamp(message_time)
-        self.message_time = message_time
+    def compose(self):
+        yield MessageTimeline(classes="message-vertical")
+    
+    async def on_mount(self):
+        config = self.app.config
+        self.max_room_events = int(
+            config.get_config("Performance", "max_room_events") or self.MAX_ROOM_EVENTS)
+        self.max_live_rooms = max(1, int(
+            config.get_config("Performance", "max_live_rooms") or self.MAX_LIVE_ROOMS))
+        # Prewarmed rooms come out of the live rooms budget, leaving room for the one that's open
+        prewarm_rooms = config.get_config("Performance", "prewarm_rooms")
+        self.prewarm_rooms = min(
+            self.PREWARM_ROOMS if prewarm_rooms is None else int(prewarm_rooms), self.max_live_rooms - 1)
+        if self.prewarm_rooms > 0:
+            self.set_interval(self.PREWARM_INTERVAL, self.prewarm)
         
-        super().__init__(*args, **kwargs)
+        # Echo whatever's still waiting in the outboxes from the last run,
+        # and everything sent from now on
+        for client in self.app.clients:
+            self.watch_account(client)
+        self.app.media.add_callback(self.on_media)
         
-    def compose(self):
-        # Username
-        usercolour = f"username-colour-{get_user_id_colour(self.sender_id)}"
+        # Once mounted and the room list is laid out, populate rooms with
+        # initial messages
+        self.call_after_refresh(lambda: self.run_worker(self.get_all_initial_messages()))
         
-        # Message sent time
-        message_time = self.message_time.strftime("%a %d, %I:%M%p")
+    def watch_account(self, client: AsyncClient):
+        """Echo an account's outgoing messages and splice in its filled gaps
+
+        Args:
+            client (AsyncClient): The account
+        """
+        client.outbox.add_callback(self.on_outgoing)
+        for message in client.outbox.pending():
+            self.on_outgoing(message)
+        client.gaps.add_callback(self.on_gap_filled)
         
-        with Horizontal(classes="sender-container"):
-            yield Label(self.sender, classes=f"sender {usercolour}")
-            yield Label(message_time, classes=f"time")
-        yield Vertical(id="messages", classes="message-body")
+    def add_account(self, client: AsyncClient):
+        """Start showing an account that logged in after the screen was up
+
+        Args:
+            client (AsyncClient): The account
+        """
+        self.watch_account(client)
+        # Rooms shared with an account already shown keep coming from that one
+        room_ids = [room_id for room_id in client.rooms if self.app.client_for(room_id) is client]
+        self.run_worker(self.get_all_initial_messages(room_ids))
         
-    def add_message(self, message: RoomMessageText):
-        """Adds a message to the container
+    async def get_all_initial_messages(self, room_ids: typing.Iterable[str] | None = None):
+        """Queue up the initial messages of rooms, most relevant rooms first
 
         Args:
-            message (RoomMessageText): The message to add
+            room_ids (typing.Iterable[str] | None, optional): The rooms. Defaults to every room.
         """
-        if message.sender != self.sender_id:
-            return
-        self.messages.append(message)
-        message_vert = self.query_one("#messages")
-        body = getattr(message, "body", None) or "<ERROR: NO MESSAGE BODY>"
-        message_vert.mount(Label(body))
-        
-    @property
-    def event_ids(self):
-        return [message.event_id for message in self.messages]
-    
+        visible = self.screen.query_one("RoomsContainer").visible_room_ids()
+        futures = [
+            self.app.client_for(room_id).scheduler.submit(
+                ("initial", room_id),
+                lambda room_id=room_id: self.get_initial_messages(room_id),
+                self.room_priority(room_id, visible),
+            )
+            for room_id in (self.app.rooms.keys() if room_ids is None else room_ids)
+        ]
+        # One room failing to load shouldn't take the others down with it
+        await asyncio.gather(*futures, return_exceptions=True)
+        
+    def room_priority(self, room_id: str, visible: set[str]) -> Priority:
+        """Decide how urgently a room's history is needed
 
-class MessagesContainer(ContentSwitcher):
-    messages = dict()
-    
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, classes='message-container', **kwargs)
-    
-    async def on_mount(self):
-        # Once mounted, populate rooms with initial messages
-        for room_id in self.app.client.rooms.keys():
-            self.run_worker(self.get_initial_messages(room_id))
+        Args:
+            room_id (str): The room ID to prioritize
+            visible (set[str]): Room IDs currently in view in the room list
+
+        Returns:
+            Priority: The room's priority
+        """
+        if room_id == self.app.current_room:
+            return Priority.CURRENT
+        if room_id in visible:
+            return Priority.VISIBLE
+        room = self.app.get_room(room_id)
+        if room and (room.unread_notifications or room.unread_highlights):
+            return Priority.UNREAD
+        return Priority.BACKGROUND
             
-        
     async def get_initial_messages(self, room_id: str):
         """Populate the latest 25 messages for a given room
 
         Args:
             room_id (str): The room ID to populate the messages for
         """
-        # TODO: Turn this into a method of paginating messages
-        # TODO: so we can get any number of old messages
-        messages = self.messages.setdefault(room_id, [])
-        res = await self.app.client.room_messages(room_id, self.app.client.next_batch, limit=25)
-        for msg in res.chunk:
-            messages.append(msg)
-        messages.reverse()
-        
-    async def remove_new_messages_label(self):
-        """Attempt to get the current vertical scroll and remove the new_messages label"""
-        vert_scroll = await self.get_room_vert()
-        try:
-            new_messages = vert_scroll.query_one("#new_messages")
-            await new_messages.remove()
-        except NoMatches:
-            ...
+        # The first page comes from the local store when it can, which
+        # already holds everything synced up to the saved sync token
+        await self.load_older_messages(room_id, 25)
         
-    async def get_room_vert(self) -> VerticalScroll | None:
-        """Get the current room's vertical scroll
+    def get_paginator(self, room_id: str) -> RoomPaginator:
+        """Get the backwards paginator of a room
+
+        Args:
+            room_id (str): The room ID to get the paginator for
 
         Returns:
-            VerticalScroll: The current room's vertical scroll
+            RoomPaginator: The room's paginator
         """
-        # If not ID, return
-        vert_scroll_id = clean_room_id(self.app.current_room)
-        if not vert_scroll_id:
-            return None
+        if room_id not in self.paginators:
+            self.paginators[room_id] = RoomPaginator(self.app.client_for(room_id), room_id)
+        return self.paginators[room_id]
         
-        # Try to get an existing VerticalScroll, failing that, create and mount one
+    def on_message_timeline_message_clicked(self, event: MessageTimeline.MessageClicked):
+        """Send a message that failed to send again, or download an attachment, when it's clicked"""
+        outgoing = getattr(event.message, "outgoing", None)
+        if outgoing is not None and outgoing.state is SendState.FAILED:
+            self.app.client_for(outgoing.room_id).outbox.retry(outgoing.txn_id)
+            return
+        if is_media(event.message) and self.displayed_room is not None:
+            self.run_worker(self.save_media(self.displayed_room, event.message))
+
+    def on_message_timeline_reached_end(self, event: MessageTimeline.ReachedEnd):
+        if self.displayed_room is not None:
+            self.mark_read(self.displayed_room)
+            
+    def mark_read(self, room_id: str):
+        """Mark a room read up to its newest message. The receipt goes out
+        with the client's next batch, however often this is called until then.
+
+        Args:
+            room_id (str): The room ID of the room that was read
+        """
+        timeline = self.messages.get(room_id)
+        if not timeline:
+            return
+        # Local echoes aren't events the homeserver knows about yet
+        latest = next(
+            (message for message in reversed(timeline) if message.event_id.startswith("$")), None)
+        if latest is None:
+            return
+        if self.app.client_for(room_id).receipts.mark(room_id, latest.event_id, latest.server_timestamp):
+            self.screen.query_one("RoomsContainer").mark_read(room_id, latest.server_timestamp)
+        
+    def on_message_timeline_media_near_viewport(self, event: MessageTimeline.MediaNearViewport):
+        """Prefetch the thumbnails of attachments about to be scrolled into view"""
+        if self.displayed_room is None or not self.app.media.previews_enabled:
+            return
+        client = self.app.client_for(self.displayed_room)
+        for message in event.messages:
+            self.run_worker(self.app.media.prefetch_preview(client, message))
+
+    async def save_media(self, room_id: str, message: RoomMessageText):
+        """Save an attachment to the download folder
+
+        Args:
+            room_id (str): The room it was sent in
+            message (RoomMessageText): The media event
+        """
+        folder = self.app.config.get_config("Media", "download_folder") or "~/Downloads"
         try:
-            vert_scroll = self.get_child_by_id(vert_scroll_id)
-        except NoMatches:
-            vert_scroll = VerticalScroll(id=vert_scroll_id, classes="message-vertical")
-            self.mount(vert_scroll)
-        return vert_scroll
-    
-    async def update_displayed_messages(self, messages: list):
-        """Update messages when displayed_messages is updated
+            path = await self.app.media.save(self.app.client_for(room_id), message, pathlib.Path(folder))
+        except MediaError as e:
+            self.app.notify(f"Couldn't download {message.body}: {e}", severity="error")
+        else:
+            self.app.notify(f"Saved to {path}")
+
+    def on_media(self, message: RoomMessageText):
+        """Downloader callback redrawing attachments as they're saved or get a preview
+
+        Args:
+            message (RoomMessageText): The media event
+        """
+        for room_id, layout in self.layouts.items():
+            if layout.row_of(message.event_id) is None:
+                continue
+            layout.update_message(message.event_id)
+            if room_id == self.displayed_room:
+                self.query_one(MessageTimeline).queue_refresh()
+
+    async def on_message_timeline_near_top(self, event: MessageTimeline.NearTop):
+        """Fetch older history when the timeline gets close to the top"""
+        room_id = self.app.current_room
+        paginator = self.get_paginator(room_id)
+        scheduler = self.app.client_for(room_id).scheduler
+        if paginator.exhausted or ("initial", room_id) in scheduler or ("older", room_id) in scheduler:
+            return
+        limit = paginator.page_size(event.velocity)
+        self.run_worker(scheduler.submit(
+            ("older", room_id),
+            lambda: self.load_older_messages(room_id, limit),
+            Priority.CURRENT,
+        ))
+        
+    def get_timeline(self, room_id: str) -> RoomTimeline:
+        """Get the in-memory timeline of a room
+
+        Args:
+            room_id (str): The room ID to get the timeline for
+
+        Returns:
+            RoomTimeline: The room's events
+        """
+        if room_id not in self.messages:
+            self.messages[room_id] = RoomTimeline()
+        return self.messages[room_id]
+        
+    def get_layout(self, room_id: str) -> TimelineLayout:
+        """Get the layout of a room, laying out its timeline again if it
+        was torn down
 
         Args:
-            messages (list[RoomMessageText]): Messages
+            room_id (str): The room ID to get the layout for
+
+        Returns:
+            TimelineLayout: The room's rows
         """
-        # Get the current vertical scroll container
-        # If one doesn't exist, return  
-        vert_scroll = await self.get_room_vert()
-        if not vert_scroll:
+        if room_id in self.layouts:
+            return self.layouts[room_id]
+        
+        timeline = self.get_timeline(room_id)
+        senders, get_room = self.app.senders, self.app.get_room
+        layout = self.layouts[room_id] = TimelineLayout(
+            lambda user_id: senders.resolve(room_id, user_id, get_room(room_id)))
+        if room_id not in self.unread_after:
+            layout.prepend_messages(list(timeline))
+            return layout
+        
+        # Put the new messages marker back where it was. If the message it
+        # followed has been trimmed since, everything in memory is unread
+        index = timeline.index(self.unread_after.pop(room_id) or "")
+        split = 0 if index is None else index + 1
+        layout.prepend_messages(timeline[:split])
+        layout.add_marker(seen=False)
+        for message in timeline[split:]:
+            layout.append_message(message)
+        return layout
+        
+    def evict_layout(self, room_id: str):
+        """Tear down the layout of a room, remembering its unseen new messages marker
+
+        Args:
+            room_id (str): The room ID to tear down the layout of
+        """
+        layout = self.layouts.pop(room_id, None)
+        self.prewarmed.discard(room_id)
+        if layout is None or layout.marker is None or layout.marker_seen:
             return
+        index = layout.index(layout.marker)
+        previous = layout.rows[index - 1] if index else None
+        self.unread_after[room_id] = previous.messages[-1].event_id if previous else None
+        
+    def trim_room(self, room_id: str):
+        """Drop the oldest in-memory events of a room that's over its budget.
+        They stay in the store, so scrolling back pages them in again.
+
+        Args:
+            room_id (str): The room ID to trim
+        """
+        timeline = self.get_timeline(room_id)
+        if not timeline.trim(self.max_room_events):
+            return
+        # The rows referenced the dropped events, and pagination restarts
+        # from the new oldest event
+        self.evict_layout(room_id)
+        self.paginators[room_id] = RoomPaginator(
+            self.app.client_for(room_id), room_id, timeline[0].event_id if timeline else None)
+        
+    def enforce_budgets(self):
+        """Tear down the layouts of the least recently viewed rooms and trim
+        every room that's out of view back to its event budget"""
+        while len(self.layouts) > self.max_live_rooms:
+            room_id = next(iter(self.layouts))
+            if room_id == self.displayed_room:
+                break
+            self.evict_layout(room_id)
+        for room_id, timeline in list(self.messages.items()):
+            if room_id != self.displayed_room and len(timeline) > self.max_room_events:
+                self.trim_room(room_id)
+        self.log.info("Timeline memory", **self.memory_usage())
+                
+    def memory_usage(self) -> dict[str, int]:
+        """Count what the timelines are holding on to, for tuning the budgets
+
+        Returns:
+            dict[str, int]: Rooms, events, live layouts, prewarmed layouts, rows and rendered lines in memory
+        """
+        rendered = [self.query_one(MessageTimeline)._strips]
+        rendered += [layout.warm_strips for layout in self.layouts.values()]
+        return {
+            "rooms": len(self.messages),
+            "events": sum(len(timeline) for timeline in self.messages.values()),
+            "live_rooms": len(self.layouts),
+            "prewarmed_rooms": len(self.prewarmed),
+            "rows": sum(len(layout) for layout in self.layouts.values()),
+            "rendered_lines": sum(len(strips) for rows in rendered for _, strips in rows.values()),
+        }
+        
+    def prewarm(self):
+        """Get the rooms likely to be opened next ready while the user is
+        idle, a slice at a time, carrying on over the next frames"""
+        if self._prewarm_scheduled:
+            return
+        if self.displayed_room is None or self.app.idle_for() < self.PREWARM_IDLE:
+            self._prewarm_queue.clear()
+            return
+        if not self._prewarm_queue:
+            rooms_container = self.screen.query_one("RoomsContainer")
+            unread = {
+                room_id: room.unread_highlights > 0 for room_id, room in self.app.rooms.items()
+                if rooms_container.is_unread(room_id)
+            }
+            self.predicted = self.predictor.predict(
+                self.displayed_room, rooms_container.cursor_room_ids(), unread, self.prewarm_rooms)
+            self._prewarm_queue.extend(self.predicted)
+        
+        deadline = time.perf_counter() + self.PREWARM_SLICE
+        with metrics.timer("prewarm.slice"):
+            while self._prewarm_queue and time.perf_counter() < deadline:
+                if not self.prewarm_step(self._prewarm_queue[0]):
+                    self._prewarm_queue.popleft()
+        if self._prewarm_queue:
+            self._prewarm_scheduled = True
+            self.call_after_refresh(self._prewarm_next)
             
-        # Get a list of event IDs to check against. This
-        # is used to ensure we aren't duplicating messages
-        event_ids = []
-        for child in vert_scroll.children:
-            event_ids.extend(getattr(child, "event_ids", []))
+    def _prewarm_next(self):
+        self._prewarm_scheduled = False
+        self.prewarm()
             
-        for message in messages.copy():
-            # The NewMessageStart is used to add the in-line New message notification
-            if message is NewMessagesStart:
-                # Only add the label if one doesn't already exist
-                try:
-                    vert_scroll.query_one("#new_messages")
-                except NoMatches:
-                    vert_scroll.mount(
-                        Label("NEW MESSAGES", id="new_messages", classes="new-messages"))
-                finally:
-                    # We delete it so we're able to add a new one later
-                    del messages[messages.index(NewMessagesStart)]
-                continue
+    def prewarm_step(self, room_id: str) -> bool:
+        """Do the next small piece of getting a room ready to be opened: its
+        history and members, then its layout, then its rows on screen
+
+        Args:
+            room_id (str): The room ID of the room
+
+        Returns:
+            bool: False once the room is as ready as it gets
+        """
+        client = self.app.client_for(room_id)
+        scheduler = client.scheduler
+        if not self.messages.get(room_id):
+            # Its history is still queued, move it up the line
+            scheduler.reprioritize(("initial", room_id), Priority.VISIBLE)
+            return False
+        room = self.app.get_room(room_id)
+        if room is not None and not room.members_synced and ("members", room_id) not in scheduler:
+            self.run_worker(scheduler.submit(
+                ("members", room_id), lambda: self.load_members(room_id), Priority.VISIBLE))
+            return True
+        
+        if room_id not in self.layouts:
+            if len(self.layouts) >= self.max_live_rooms or len(self.prewarmed) >= self.prewarm_rooms:
+                # Only ever in place of another prewarmed room that's not as likely
+                stale = next((other for other in self.layouts
+                              if other in self.prewarmed and other not in self.predicted), None)
+                if stale is None:
+                    return False
+                self.evict_layout(stale)
+            self.get_layout(room_id)
+            # Least recently viewed, so it's the first to go when over budget
+            self.layouts.move_to_end(room_id, last=False)
+            self.prewarmed.add(room_id)
+            metrics.increment("prewarm.rooms")
+            return True
+        return self.query_one(MessageTimeline).prerender_step(self.layouts[room_id])
+        
+    async def load_older_messages(self, room_id: str, limit: int):
+        """Prepend a page of older messages to a room
+
+        Args:
+            room_id (str): The room ID to load older messages for
+            limit (int): The maximum number of messages to load
+        """
+        paginator = self.get_paginator(room_id)
+        older = await paginator.fetch(limit)
+        if self.paginators.get(room_id) is not paginator:
+            # The room was trimmed while the page was loading
+            return
+        timeline = self.get_timeline(room_id)
+        layout = self.layouts.get(room_id)
+        older = [message for message in older if message.event_id not in timeline]
+        if not older:
+            return
+        
+        # Pages are normally strictly older than everything we have,
+        # anything else gets slotted in message by message
+        displayed = self.query_one(MessageTimeline)
+        if not timeline.prepend(older):
+            for message in older:
+                self.place_message(timeline, layout, message)
+            if room_id == self.displayed_room:
+                displayed.refresh_rows()
+        elif room_id == self.displayed_room:
+            displayed.prepend_messages(older)
+            displayed.check_near_top()
+        elif layout is not None:
+            layout.prepend_messages(older)
             
-            # Add the message to the vertical scroll container
-            elif message.event_id not in event_ids:
-                # ! This whole section is so gross... I can do better
-                last_message = None
-                if vert_scroll.children:
-                    for child in vert_scroll.children[::-1]:
-                        if not isinstance(child, MessageContent):
-                            continue
-                        last_message: MessageContent = child
-                        break
-                    
-                message_time = message.server_timestamp / 1000
-                message_time = datetime.datetime.fromtimestamp(message_time)
-                if last_message and last_message.sender_id == message.sender and (message_time - last_message.message_time).seconds <= 300:
-                    last_message.add_message(message)
-                else:
-                    message_content = MessageContent(message, classes="message-content")
-                    await vert_scroll.mount(message_content)
-                    message_content.add_message(message)
-                
-        # Scroll to the end
-        # TODO: Make it so we don't scroll when we're actively looking at a room
-        vert_scroll.scroll_end(animate=False)
+    async def jump_to_event(self, room_id: str, event_id: str):
+        """Scroll the displayed room to a message, first loading everything
+        from the store between it and the oldest message in memory
+
+        Args:
+            room_id (str): The room ID of the displayed room
+            event_id (str): The event ID of the message
+        """
+        timeline = self.get_timeline(room_id)
+        if event_id not in timeline:
+            store = self.app.client_for(room_id).event_store
+            oldest = timeline[0].event_id if timeline else None
+            # A little context above the message, then up to what's loaded
+            older = store.load_events(room_id, 5, before=event_id)
+            older += store.load_events(room_id, None, before=oldest, since=event_id)
+            older = [message for message in older if message.event_id not in timeline]
+            # Keep paging back from the new oldest message, dropping any
+            # page already on its way
+            self.paginators[room_id] = RoomPaginator(
+                self.app.client_for(room_id), room_id, older[0].event_id if older else oldest)
+            if timeline.prepend(older):
+                self.query_one(MessageTimeline).prepend_messages(older)
+            else:
+                for message in older:
+                    self.place_message(timeline, self.layouts.get(room_id), message)
+                self.query_one(MessageTimeline).refresh_rows()
+        self.query_one(MessageTimeline).scroll_to_message(event_id)
         
+    def place_message(self, timeline: RoomTimeline, layout: TimelineLayout | None, message: RoomMessageText) -> bool:
+        """Add a message to a room's timeline and mirror it in the layout
+
+        Args:
+            timeline (RoomTimeline): The room's timeline
+            layout (TimelineLayout | None): The room's layout, if it has one
+            message (RoomMessageText): The message to add
+
+        Returns:
+            bool: False if the message was already in the timeline
+        """
+        index = timeline.add(message)
+        if index is None:
+            return False
+        if layout is None:
+            return True
+        if index == len(timeline) - 1:
+            layout.append_message(message)
+        elif index == 0:
+            layout.prepend_messages([message])
+        else:
+            layout.insert_message(message, timeline[index - 1])
+        return True
+                
+    def on_gap_filled(self, room_id: str, events: list[Event]):
+        """Gap filler callback splicing the messages that were missing into
+        a room that's in memory, without laying the whole room out again
+
+        Args:
+            room_id (str): The room ID of the room
+            events (list[Event]): The events that were filled in, oldest first
+        """
+        timeline = self.messages.get(room_id)
+        if not timeline:
+            # They're in the store for when the room gets loaded
+            return
+        layout = self.layouts.get(room_id)
+        messages = [
+            event for event in events
+            if isinstance(event, (RoomMessageText, *MEDIA_EVENTS)) and event.event_id not in timeline
+        ]
+        edited, messages = self.apply_edits(timeline, layout, messages)
+        # Anything older than what's in memory gets paged in from the store
+        oldest = timeline[0].server_timestamp
+        messages = [message for message in messages if message.server_timestamp >= oldest]
+        if room_id != self.displayed_room:
+            for message in messages:
+                self.place_message(timeline, layout, message)
+            if len(timeline) > self.max_room_events:
+                self.trim_room(room_id)
+        elif messages or edited:
+            self.query_one(MessageTimeline).splice(
+                lambda: [self.place_message(timeline, layout, message) for message in messages])
+                
+    def on_outgoing(self, message: OutgoingMessage):
+        """Outbox callback showing a local echo of a message as soon as it's
+        queued and keeping it up to date while it's being sent
+
+        Args:
+            message (OutgoingMessage): The queued message
+        """
+        timeline = self.get_timeline(message.room_id)
+        layout = self.layouts.get(message.room_id)
+        if message.txn_id not in timeline:
+            if message.state is SendState.SENT:
+                # The real event came down sync before the send returned
+                return
+            sender = self.app.client_for(message.room_id).user_id
+            self.place_message(timeline, layout, message.local_echo(sender))
+        else:
+            if message.state is SendState.SENT:
+                self.sent[message.event_id] = message.txn_id
+            if layout is not None:
+                layout.update_message(message.txn_id)
+        if message.room_id == self.displayed_room:
+            self.query_one(MessageTimeline).queue_refresh()
+            
+    def reconcile_echoes(self, timeline: RoomTimeline, layout: TimelineLayout | None, messages: list[RoomMessageText]) -> bool:
+        """Swap local echoes for the real events of our own messages
+
+        Args:
+            timeline (RoomTimeline): The room's timeline
+            layout (TimelineLayout | None): The room's layout, if it has one
+            messages (list[RoomMessageText]): Messages that just came in
+
+        Returns:
+            bool: True if any echo was swapped
+        """
+        replaced = False
+        for message in messages:
+            # Our own device gets the transaction ID back, failing that the
+            # send response told us the event ID
+            sent = self.sent.pop(message.event_id, None)
+            txn_id = message.transaction_id or sent
+            if txn_id is None or txn_id not in timeline or message.event_id in timeline:
+                continue
+            timeline.replace(txn_id, message)
+            if layout is not None:
+                layout.replace_message(txn_id, message)
+            replaced = True
+        return replaced
+
+    def apply_edits(self, timeline: RoomTimeline, layout: TimelineLayout | None, messages: list[RoomMessageText]) -> tuple[bool, list[RoomMessageText]]:
+        """Apply edits to the messages they replace, instead of showing them
+        as messages of their own
+
+        Args:
+            timeline (RoomTimeline): The room's timeline
+            layout (TimelineLayout | None): The room's layout, if it has one
+            messages (list[RoomMessageText]): Messages that just came in
+
+        Returns:
+            tuple[bool, list[RoomMessageText]]: Whether any message was edited, and the messages that aren't edits
+        """
+        edited = False
+        remaining = []
+        for message in messages:
+            if (event_id := edited_event_id(message.source)) is None:
+                remaining.append(message)
+                continue
+            index = timeline.index(event_id)
+            if index is None:
+                # Edit of a message that isn't loaded, the store applies it
+                # when the message is
+                continue
+            original = timeline[index]
+            if not apply_edit(original, message.source):
+                continue
+            self.query_one(MessageTimeline).render_cache.invalidate(original.event_id)
+            if layout is not None:
+                layout.update_message(original.event_id)
+            edited = True
+        return edited, remaining
+
+    async def apply_sync(self, response: SyncResponse, received: float | None = None):
+        """Add the new messages of a sync response, one batch per room
+
+        Args:
+            response (SyncResponse): The sync response to apply
+            received (float | None, optional): `time.perf_counter()` when the response arrived. Defaults to None.
+        """
+        visible = None
+        for room_id, room_info in response.rooms.join.items():
+            room = self.app.get_room(room_id)
+            if room_info.timeline.limited:
+                # The store noted the hole this leaves, if there's anything before it
+                if visible is None:
+                    visible = self.screen.query_one("RoomsContainer").visible_room_ids()
+                self.app.client_for(room_id).gaps.queue(room_id, self.room_priority(room_id, visible))
+            messages = [
+                event for event in room_info.timeline.events
+                if isinstance(event, (RoomMessageText, *MEDIA_EVENTS))
+            ]
+            if room is not None and messages:
+                await self.add_messages(room, messages, received)
+        for room_id in response.rooms.leave:
+            if self.app.get_room(room_id) is not None:
+                # Another account is still in the room
+                continue
+            self.messages.pop(room_id, None)
+            self.layouts.pop(room_id, None)
+            self.unread_after.pop(room_id, None)
+            self.paginators.pop(room_id, None)
                 
-    async def add_message(self, room: MatrixRoom, message: RoomMessageText):
-        """Adds a message to the messages dict
+    async def add_messages(self, room: MatrixRoom, messages: list[RoomMessageText], received: float | None = None):
+        """Adds a batch of messages to the room's timeline
 
         Args:
             room (MatrixRoom): Matrix room object
-            message (RoomMessageText): Room message text object to add
+            messages (list[RoomMessageText]): Room message text objects to add, in timeline order
+            received (float | None, optional): `time.perf_counter()` when the messages arrived. Defaults to None.
         """
-        # Get the messages for this room
-        messages = self.messages.setdefault(room.room_id, [])
-        
-        # Get the current vertical scroll container
-        # If one doesn't exist, return  
-        vert_scroll: VerticalScroll = await self.get_room_vert()
-        if not vert_scroll:
+        room_id = room.room_id
+        timeline = self.get_timeline(room_id)
+        layout = self.layouts.get(room_id)
+        displayed = self.query_one(MessageTimeline)
+        is_displayed = room_id == self.displayed_room
+        if self.reconcile_echoes(timeline, layout, messages) and is_displayed:
+            displayed.queue_refresh(received)
+        edited, messages = self.apply_edits(timeline, layout, messages)
+        if edited and is_displayed:
+            displayed.queue_refresh(received)
+        messages = [message for message in messages if message.event_id not in timeline]
+        if not messages:
             return
         
         # Elaborately decide if the New Message notification should be
         # in among the messages
-        if not vert_scroll.has_focus and NewMessagesStart not in messages:
-            message_box = self.app.query_one("MessageBox")
-            if not room.room_id == self.app.current_room or not message_box.has_focus:
-                messages.append(NewMessagesStart)
-        
-        # Add the message to our list of messages
-        messages.append(message)
-        
-        # If we're currently viewing the room in which the message came
-        # update the displayed messages
-        if room.room_id == self.app.current_room:
-            await self.update_displayed_messages(messages)
+        if not displayed.has_focus:
+            message_box = self.screen.query_one("MessageBox")
+            if not room_id == self.app.current_room or not message_box.has_focus:
+                if layout is None:
+                    # Rooms without a layout get their marker once they're shown
+                    self.unread_after.setdefault(room_id, timeline[-1].event_id if timeline else None)
+                else:
+                    # A marker left over from an earlier visit moves down to
+                    # the first message that hasn't been seen yet
+                    if not is_displayed and layout.marker_seen:
+                        layout.remove_marker()
+                    layout.add_marker(seen=is_displayed)
+        
+        with metrics.timer("messages.add"):
+            for message in messages:
+                self.place_message(timeline, layout, message)
+        
+        # If we're currently viewing the room in which the messages came
+        # update the displayed messages. However many batches arrive, the
+        # rows are re-measured and scrolled at most once per frame
+        if is_displayed:
+            displayed.queue_refresh(received)
             return
+        if len(timeline) > self.max_room_events:
+            self.trim_room(room_id)
         
-        # Otherwise highlight the radio button corresponding to the room
-        room_container = self.app.query_one("RoomsContainer")
-        await room_container.highlight_room(room.room_id)
+    async def load_members(self, room_id: str):
+        """Fetch the full member list of a room
+
+        Args:
+            room_id (str): The room ID to load the members of
+        """
+        await self.app.client_for(room_id).joined_members(room_id)
+        # Rooms without a name are named after their members
+        self.screen.query_one("RoomsContainer").rename_room(room_id)
+        # Senders that had gone by their localpart get their display names
+        room = self.app.get_room(room_id)
+        self.update_senders({room_id: self.app.senders.refresh_room(room_id, room)})
+        self.screen.query_one("MemberList").members_loaded(room_id)
+        
+    def update_senders(self, changed: dict[str, set[str]]):
+        """Show the new names of senders that were renamed
+
+        Args:
+            changed (dict[str, set[str]]): User IDs of the senders, by room ID
+        """
+        for room_id, user_ids in changed.items():
+            layout = self.layouts.get(room_id)
+            if not user_ids or layout is None or not layout.update_senders(user_ids):
+                continue
+            if room_id == self.displayed_room:
+                self.query_one(MessageTimeline).queue_refresh()
         
     async def change_room(self, room_id: str):
         """Change the messages displayed to the `room_id`s room
@@ -212,13 +730,39 @@ class MessagesContainer(ContentSwitcher):
         Args:
             room_id (str): Room ID to change to
         """
-        # Remove the new messages label in the vertical scroll
-        await self.remove_new_messages_label()
+        # Requests for the room we're leaving are stale now, and the
+        # room we're opening jumps the queue
+        scheduler = self.app.client_for(room_id).scheduler
+        if self.displayed_room and self.displayed_room != room_id:
+            self.app.client_for(self.displayed_room).scheduler.cancel(("older", self.displayed_room))
+        scheduler.reprioritize(("initial", room_id), Priority.CURRENT)
+        self.displayed_room = room_id
+        self.predictor.record_switch(room_id)
+        self.prewarmed.discard(room_id)
+        self._prewarm_queue.clear()
+        client = self.app.client_for(room_id)
+        if client.event_store.next_gap(room_id) is not None:
+            client.gaps.queue(room_id, Priority.CURRENT)
+        
+        # Members are lazy loaded by the sync filter, the full list is
+        # only fetched for rooms that actually get opened
+        room = self.app.get_room(room_id)
+        if room is not None and not room.members_synced and ("members", room_id) not in scheduler:
+            self.run_worker(scheduler.submit(
+                ("members", room_id), lambda: self.load_members(room_id), Priority.CURRENT))
+        
+        # Remove the new messages marker if it's been seen already
+        layout = self.get_layout(room_id)
+        self.layouts.move_to_end(room_id)
+        if layout.marker_seen:
+            layout.remove_marker()
+        layout.marker_seen = True
         
-        # Get the messages from the room and update the displayed messages
-        messages = self.messages.setdefault(room_id, [])
-        await self.update_displayed_messages(messages)
+        # Display the room's layout. Only the rows in view get rendered,
+        # so this costs the same however long the history is
+        self.query_one(MessageTimeline).show(layout)
+        self.screen.query_one("MessageBox").show_typing(room)
+        self.screen.query_one("MemberList").show_room(room_id)
         
-        # Set the current content to the correct vertical scroll
-        vert_scroll_id = clean_room_id(self.app.current_room)
-        self.current = vert_scroll_id
\ No newline at end of file
+        # With the previous room out of view, bring memory back in budget
+        self.enforce_budgets()
@@ -0,0 +1,34 @@
+from rich.table import Table
+
+from textual.widgets import Static
+
+from nitrix.metrics import metrics
+
+
+class PerformanceOverlay(Static):
+    """Live view of the instrumentation histograms and counters"""
+
+    # Seconds between refreshes while shown
+    INTERVAL = 0.5
+
+    def on_mount(self):
+        self.display = False
+        self.set_interval(self.INTERVAL, self.update_stats)
+
+    def update_stats(self):
+        if not self.display:
+            return
+
+        # Taken under the metrics lock, the sync thread records too
+        stats = metrics.snapshot()
+        table = Table("metric", "n", "p50", "p95", "p99", "max", box=None, padding=(0, 1))
+        for name, snapshot in sorted(stats["histograms"].items()):
+            table.add_row(
+                name, str(snapshot["count"]),
+                *(f"{snapshot[key] * 1000:.1f}ms" for key in ("p50", "p95", "p99", "max")),
+            )
+        for name, count in sorted(stats["counters"].items()):
+            table.add_row(name, str(count))
+        if not stats["histograms"] and not stats["counters"]:
+            table.add_row("Waiting for samples...")
+        self.update(table)
@@ -1,27 +1,523 @@
+from textual import events
 from textual.reactive import reactive
-from textual.widgets import Label, RadioButton, RadioSet
-from textual.containers import VerticalScroll
+from textual.widgets import Label, RadioButton, RadioSet, Static
+from textual.containers import Vertical, VerticalScroll
 from textual.message import Message
-  
+
+from nio import AsyncClient, MatrixRoom
+from nio import ReceiptEvent
+from nio.responses import SyncResponse
+
+from nitrix.scheduler import Priority
+from nitrix.spaces import SpaceCache, SpaceChild, is_space
 from nitrix.utils import clean_room_id
 
+# State events that can change how a room is named
+NAMING_EVENTS = {"m.room.name", "m.room.canonical_alias", "m.room.member"}
+
+# State events that change which rooms are in a Space
+SPACE_EVENTS = {"m.space.child"}
+
+
+class SpaceHeader(Static, can_focus=True):
+    """The line of a Space in the room list, which opens and closes it"""
+
+    BINDINGS = [
+        ("enter", "toggle", "Open/close"),
+        ("space", "toggle", "Open/close"),
+    ]
+
+    def action_toggle(self):
+        self.parent.toggle()
+
+    def on_click(self, event: events.Click):
+        self.parent.toggle()
+
+
+class MoreChildren(Static, can_focus=True):
+    """The last line of a Space with more children left to fetch"""
+
+    BINDINGS = [("enter", "more", "More")]
+
+    def action_more(self):
+        self.parent.parent.load_more()
+
+    def on_click(self, event: events.Click):
+        self.parent.parent.load_more()
+
+
+class SpaceNode(Vertical):
+    """A Space in the room list. Its children are fetched a page at a time,
+    and their widgets created, only while it's open.
+
+    Args:
+        space_id (str): Room ID of the Space
+        name (str): Name to show until the Space's own room is known
+        depth (int, optional): How many Spaces this one is nested in. Defaults to 0.
+    """
+
+    def __init__(self, space_id: str, name: str, depth: int = 0):
+        super().__init__(classes="space-node")
+        self.space_id = space_id
+        self.title = name
+        self.depth = depth
+        self.expanded = False
+        self.loading = False
+
+    def compose(self):
+        yield SpaceHeader(self.header_text(), classes="space-header")
+        yield Vertical(classes="space-children")
+
+    @property
+    def rooms_container(self) -> "RoomsContainer":
+        return self.screen.query_one(RoomsContainer)
+
+    def header_text(self) -> str:
+        arrow = "▾" if self.expanded else "▸"
+        loading = " …" if self.loading else ""
+        return f"{'  ' * self.depth}{arrow} {self.title}{loading}"
+
+    def update_header(self):
+        header = self.query_one(SpaceHeader)
+        header.update(self.header_text())
+        header.set_class(self.rooms_container.space_unread(self.space_id), "room-highlighted")
+
+    def toggle(self):
+        """Open or close the Space"""
+        self.expanded = not self.expanded
+        if self.expanded:
+            self.run_worker(self.expand())
+        else:
+            self.run_worker(self.collapse())
+        self.update_header()
+
+    async def expand(self):
+        """Show the Space's children, fetching the first page unless it's cached"""
+        container = self.rooms_container
+        hierarchy = container.spaces_for(self.space_id).get(self.space_id)
+        if not hierarchy.fetched:
+            self.loading = True
+            self.update_header()
+            await container.fetch_space_page(self.space_id)
+            self.loading = False
+            self.update_header()
+        if self.expanded:
+            await self.show_children(hierarchy.children, hierarchy.next_batch is not None)
+
+    async def collapse(self):
+        """Drop the widgets of the Space's children, what was fetched stays cached"""
+        body = self.query_one(".space-children")
+        for btn in body.query(RadioButton):
+            self.rooms_container.forget_button(btn)
+        await body.remove_children()
+
+    async def reload(self):
+        """Show the children again after the cached ones were invalidated"""
+        await self.collapse()
+        if self.expanded:
+            await self.expand()
+
+    def load_more(self):
+        self.run_worker(self._load_more())
+
+    async def _load_more(self):
+        hierarchy = self.rooms_container.spaces_for(self.space_id).get(self.space_id)
+        if self.loading or hierarchy.complete:
+            return
+        self.loading = True
+        self.update_header()
+        children = await self.rooms_container.fetch_space_page(self.space_id)
+        self.loading = False
+        self.update_header()
+        if self.expanded:
+            await self.show_children(children, hierarchy.next_batch is not None)
+
+    async def show_children(self, children: list[SpaceChild], more: bool):
+        """Add widgets for fetched children: Spaces to open in turn, and the
+        rooms we're in to pick from
+
+        Args:
+            children (list[SpaceChild]): The children to add
+            more (bool): Whether there's more to fetch
+        """
+        container = self.rooms_container
+        body = self.query_one(".space-children")
+        if not body.query(RadioSet):
+            await body.mount(RadioSet())
+        room_set = body.query_one(RadioSet)
+
+        spaces = [
+            SpaceNode(child.room_id, child.name, self.depth + 1)
+            for child in children if child.is_space
+        ]
+        buttons = [
+            container.make_button(child.room_id, self.depth + 1)
+            for child in children if not child.is_space and self.app.get_room(child.room_id) is not None
+        ]
+        if spaces:
+            await body.mount_all(spaces, before=room_set)
+        if buttons:
+            await room_set.mount_all(buttons)
+            container.select_current(room_set)
+        for more_row in body.query(MoreChildren):
+            await more_row.remove()
+        if more:
+            await body.mount(MoreChildren(f"{'  ' * (self.depth + 1)}more…", classes="space-more"))
+        room_set.display = bool(room_set.children)
+
+
 class RoomsContainer(VerticalScroll):
-    rooms = reactive({})
+    """The room list. Spaces come first, closed, and the rooms that aren't
+    in any of our Spaces follow in a flat list. Rooms in a Space only get a
+    widget while the Space is open, so however many rooms are joined only
+    what's shown costs anything.
+    """
+
+    rooms = reactive({}, always_update=True)
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Room ID -> radio button, room ID -> latest event timestamp, and
+        # room ID -> timestamp of the latest event we've read
+        self.buttons: dict[str, RadioButton] = {}
+        self.activity: dict[str, int] = {}
+        self.read_up_to: dict[str, int] = {}
+        self.order_by_activity = True
+        # The rooms as of the last reconcile, and the Spaces on top of the list
+        self.known: set[str] = set()
+        self.space_nodes: dict[str, SpaceNode] = {}
     
     async def watch_rooms(self, old, val):
-        room_set = self.query_one(RadioSet)
-        room_set.remove_children()
+        """Reconcile the Spaces and the radio buttons of the rooms outside
+        of them with `val`, leaving untouched any that were already there
+
+        Args:
+            old (dict[str, MatrixRoom]): The previous rooms
+            val (dict[str, MatrixRoom]): The new rooms
+        """
+        room_set = self.query_one("#room-list", RadioSet)
+        for room_id in self.known - val.keys():
+            self.activity.pop(room_id, None)
+            self.read_up_to.pop(room_id, None)
+        self.known = set(val)
+        
+        # Rooms in one of our Spaces are listed under it instead
+        spaces = {room_id: room for room_id, room in val.items() if is_space(room)}
+        nested = set().union(*(room.children for room in spaces.values()))
+        await self.reconcile_spaces({
+            room_id: room for room_id, room in spaces.items() if room_id not in nested})
+        
+        # Removes
+        for btn in list(room_set.children):
+            if btn.room_id not in val or btn.room_id in nested:
+                self.forget_button(btn)
+                await btn.remove()
+            
+        # Inserts and renames
+        new_buttons = []
         for room_id, room_obj in val.items():
-            cleaned_id = "radio_btn_" + clean_room_id(room_id)
-            btn = RadioButton(room_obj.display_name, id=cleaned_id)
-            btn.room_id = room_id
-            room_set.mount(btn)
+            if room_id in spaces or room_id in nested:
+                continue
+            if (btn := self.buttons.get(room_id)) is not None:
+                if str(btn.label) != (label := self.room_label(room_id, room_obj)):
+                    btn.label = label
+                if btn.parent is room_set:
+                    continue
+            new_buttons.append(self.make_button(room_id))
+        
+        if not new_buttons:
+            return
+        if not self.order_by_activity:
+            await room_set.mount_all(new_buttons)
+            return
+        
+        # New rooms are slotted in by their latest activity, the very first
+        # reconcile therefore sorts the whole list once
+        new_buttons.sort(key=lambda btn: self.activity.get(btn.room_id, 0), reverse=True)
+        existing = [btn for btn in room_set.children if btn not in new_buttons]
+        if not existing:
+            await room_set.mount_all(new_buttons)
+            return
+        for btn in new_buttons:
+            activity = self.activity.get(btn.room_id, 0)
+            before = next(
+                (child for child in existing if self.activity.get(child.room_id, 0) <= activity), None)
+            await room_set.mount(btn, before=before)
+        
+    async def reconcile_spaces(self, spaces: dict[str, MatrixRoom]):
+        """Add and remove the Spaces on top of the list
+
+        Args:
+            spaces (dict[str, MatrixRoom]): The Spaces that aren't in another of our Spaces
+        """
+        for space_id in self.space_nodes.keys() - spaces.keys():
+            node = self.space_nodes.pop(space_id)
+            await node.collapse()
+            await node.remove()
+        new_nodes = [
+            SpaceNode(space_id, room.display_name)
+            for space_id, room in spaces.items() if space_id not in self.space_nodes
+        ]
+        for node in new_nodes:
+            self.space_nodes[node.space_id] = node
+        if new_nodes:
+            nodes = self.query_one("#space-list")
+            await nodes.mount_all(sorted(new_nodes, key=lambda node: node.title.lower()))
+            
+    def make_button(self, room_id: str, depth: int = 0) -> RadioButton:
+        """Create the radio button of a room
+
+        Args:
+            room_id (str): Matrix room ID of the room
+            depth (int, optional): How many Spaces the button is nested in. Defaults to 0.
+
+        Returns:
+            RadioButton: The button, not mounted yet
+        """
+        room = self.app.get_room(room_id)
+        btn = RadioButton(self.room_label(room_id, room), id=None if depth else "radio_btn_" + clean_room_id(room_id))
+        btn.room_id = room_id
+        btn.styles.padding = (0, 0, 0, 2 * depth)
+        # A room listed under more than one Space is tracked by its first button
+        self.buttons.setdefault(room_id, btn)
+        self.set_unread_classes(room_id)
+        return btn
+            
+    def forget_button(self, btn: RadioButton):
+        """Stop tracking a radio button that's about to be removed
+
+        Args:
+            btn (RadioButton): The button
+        """
+        if self.buttons.get(btn.room_id) is btn:
+            del self.buttons[btn.room_id]
+            
+    def select_current(self, room_set: RadioSet):
+        """Press the button of the current room if it's just been added to a set,
+        without switching to the room again
+
+        Args:
+            room_set (RadioSet): The set with new buttons
+        """
+        for btn in room_set.query(RadioButton):
+            if btn.room_id == self.app.current_room and not btn.value:
+                with room_set.prevent(RadioButton.Changed):
+                    btn.value = True
+            
+    def spaces_for(self, space_id: str) -> SpaceCache:
+        """The hierarchy cache of the account a Space is shown for"""
+        return self.app.client_for(space_id).spaces
+            
+    async def fetch_space_page(self, space_id: str) -> list[SpaceChild]:
+        """Fetch the next page of a Space's children through the account's scheduler
+
+        Args:
+            space_id (str): Room ID of the Space
+
+        Returns:
+            list[SpaceChild]: The children on the page
+        """
+        client = self.app.client_for(space_id)
+        return await client.scheduler.submit(
+            ("space", space_id), lambda: client.spaces.fetch_page(client, space_id), Priority.CURRENT)
         
     def on_mount(self):
-        self.rooms = self.app.client.rooms
+        self.order_by_activity = (
+            self.app.config.get_config("Interface", "room_order") or "activity") == "activity"
+        for client in self.app.clients:
+            self.load_account(client)
+        self.rooms = self.app.rooms
+        
+    def load_account(self, client: AsyncClient):
+        """Pick up the stored activity and read markers of an account's rooms
+
+        Args:
+            client (AsyncClient): The account
+        """
+        for room_id, timestamp in client.event_store.room_activity().items():
+            self.activity[room_id] = max(timestamp, self.activity.get(room_id, 0))
+        for room_id, (_, _, read_ts) in client.event_store.load_unread().items():
+            if read_ts:
+                self.read_up_to[room_id] = max(read_ts, self.read_up_to.get(room_id, 0))
+                
+    def add_account(self, client: AsyncClient):
+        """Add the rooms of an account that logged in after the list was shown
+
+        Args:
+            client (AsyncClient): The account
+        """
+        self.load_account(client)
+        self.rooms = self.app.rooms
         
     def compose(self):
-        yield RadioSet()
+        yield Vertical(id="space-list")
+        yield RadioSet(id="room-list")
+        
+    async def apply_sync(self, response: SyncResponse):
+        """Bring the room list up to date with a sync response, touching
+        only the rooms that changed
+
+        Args:
+            response (SyncResponse): The sync response
+        """
+        joined = response.rooms.join
+        reconcile = joined.keys() - self.known or response.rooms.leave.keys() & self.known
+            
+        latest = []
+        changed = set()
+        for room_id, room_info in joined.items():
+            events = room_info.state + room_info.timeline.events
+            types = {getattr(event, "source", {}).get("type") for event in events}
+            if types & NAMING_EVENTS:
+                changed.add(room_id)
+            if types & SPACE_EVENTS:
+                # The Space's children changed, what was fetched of it is stale
+                reconcile = True
+                self.spaces_for(room_id).invalidate(room_id)
+                for node in self.query(SpaceNode):
+                    if node.space_id == room_id and node.expanded:
+                        self.run_worker(node.reload())
+            timestamps = [getattr(event, "server_timestamp", 0) for event in room_info.timeline.events]
+            if timestamps:
+                latest.append((max(timestamps), room_id))
+                changed.add(room_id)
+            if room_info.unread_notifications is not None:
+                changed.add(room_id)
+            if timestamps or any(isinstance(event, ReceiptEvent) for event in room_info.ephemeral):
+                self.sync_read(room_id)
+                
+        # Bump the rooms oldest first so the most recent ends up on top
+        for timestamp, room_id in sorted(latest):
+            self.bump_room(room_id, timestamp)
+        if reconcile:
+            self.rooms = self.app.rooms
+        # Only the rooms the response touched get their label redone
+        for room_id in changed:
+            self.rename_room(room_id)
+            self.set_unread_classes(room_id)
+            
+    def sync_read(self, room_id: str):
+        """Pick up how far a room has been read after our own messages or
+        receipts, from this device or any other, came down sync
+
+        Args:
+            room_id (str): Matrix room ID of the room
+        """
+        client = self.app.client_for(room_id)
+        timestamp = client.event_store.read_timestamp(room_id)
+        if timestamp is None or timestamp <= self.read_up_to.get(room_id, 0):
+            return
+        self.read_up_to[room_id] = timestamp
+        client.receipts.read_elsewhere(room_id, timestamp)
+            
+    def mark_read(self, room_id: str, timestamp: int):
+        """Clear a room's unread state once its latest messages were on screen
+
+        Args:
+            room_id (str): Matrix room ID of the room
+            timestamp (int): Server timestamp of the latest event read in milliseconds
+        """
+        self.read_up_to[room_id] = max(timestamp, self.read_up_to.get(room_id, 0))
+        if (room := self.app.get_room(room_id)) is not None:
+            room.unread_notifications = room.unread_highlights = 0
+        self.app.client_for(room_id).event_store.save_read(room_id, timestamp)
+        self.rename_room(room_id)
+        self.set_unread_classes(room_id)
+            
+    def is_unread(self, room_id: str) -> bool:
+        """Whether a room has messages we haven't read. Rooms we've never
+        seen a receipt for only go by their notification count.
+
+        Args:
+            room_id (str): Matrix room ID of the room
+
+        Returns:
+            bool: True if there's something new
+        """
+        room = self.app.get_room(room_id)
+        if room is not None and room.unread_notifications:
+            return True
+        read = self.read_up_to.get(room_id)
+        return read is not None and self.activity.get(room_id, 0) > read
+            
+    def space_unread(self, space_id: str) -> bool:
+        """Whether any room we're in directly under a Space is unread
+
+        Args:
+            space_id (str): Room ID of the Space
+
+        Returns:
+            bool: True if there's something new
+        """
+        space = self.app.get_room(space_id)
+        return space is not None and any(self.is_unread(room_id) for room_id in space.children)
+            
+    def set_unread_classes(self, room_id: str):
+        """Style a room's radio button by whether it's unread or mentions us,
+        and the Spaces it's in by whether anything in them is unread
+
+        Args:
+            room_id (str): Matrix room ID of the room
+        """
+        for node in self.space_nodes.values():
+            space = self.app.get_room(node.space_id)
+            if space is not None and room_id in space.children:
+                node.update_header()
+        if (btn := self.buttons.get(room_id)) is None:
+            return
+        room = self.app.get_room(room_id)
+        btn.set_class(self.is_unread(room_id), "room-highlighted")
+        btn.set_class(room is not None and room.unread_highlights > 0, "room-mentioned")
+            
+    def rename_room(self, room_id: str):
+        """Refresh the label of a single room, name and unread count
+
+        Args:
+            room_id (str): Matrix room ID of the room to rename
+        """
+        room = self.app.get_room(room_id)
+        if (node := self.space_nodes.get(room_id)) is not None and room is not None:
+            node.title = room.display_name
+            node.update_header()
+        btn = self.buttons.get(room_id)
+        if btn is not None and room is not None and str(btn.label) != (label := self.room_label(room_id, room)):
+            btn.label = label
+            
+    def room_label(self, room_id: str, room: MatrixRoom) -> str:
+        """Label of a room's radio button, tagged with the account when
+        logged in to more than one and followed by the notification count
+
+        Args:
+            room_id (str): Matrix room ID of the room
+            room (MatrixRoom): The room
+
+        Returns:
+            str: The label
+        """
+        label = room.display_name
+        if len(self.app.clients) > 1:
+            label = f"{label} · {self.app.account_name(room_id)}"
+        if room.unread_notifications:
+            label = f"{label} ({room.unread_notifications})"
+        return label
+            
+    def bump_room(self, room_id: str, timestamp: int):
+        """Record activity in a room, moving it to the top when ordering by activity
+
+        Args:
+            room_id (str): Matrix room ID of the room with activity
+            timestamp (int): Server timestamp of the latest event in milliseconds
+        """
+        if timestamp <= self.activity.get(room_id, 0):
+            return
+        self.activity[room_id] = timestamp
+        btn = self.buttons.get(room_id)
+        room_set = self.query_one("#room-list", RadioSet)
+        # Rooms in Spaces stay in the Space's order
+        if not self.order_by_activity or btn is None or btn.parent is not room_set:
+            return
+        if room_set.children and room_set.children[0] is not btn:
+            room_set.move_child(btn, before=0)
         
     async def on_radio_set_changed(self, val: RadioSet.Changed):
         """Action to perform when a new radio button is selected
@@ -30,16 +526,35 @@ class RoomsContainer(VerticalScroll):
             val (RadioSet.Changed): The changed radio button event
         """
         self.app.current_room = val.pressed.room_id
-        val.pressed.remove_class("room-highlighted")
-        msg_container = self.app.query_one("MessagesContainer")
+        # Every Space has a set of its own, only one room is picked across them
+        for room_set in self.query(RadioSet):
+            if room_set is not val.radio_set and (btn := room_set.pressed_button) is not None and btn.value:
+                with room_set.prevent(RadioButton.Changed):
+                    btn.value = False
+        msg_container = self.screen.query_one("MessagesContainer")
         self.run_worker(msg_container.change_room(self.app.current_room))
         
-    async def highlight_room(self, room_id: str):
-        """Highlights a room, indicating it has a new message to be viewed
+    def cursor_room_ids(self) -> list[str]:
+        """Get the room under the keyboard cursor of the room list, then the
+        rooms either side of it. Nothing unless the list has focus.
 
-        Args:
-            room_id (str): Matrix room ID to be mapped to the radio button
+        Returns:
+            list[str]: Matrix room IDs
+        """
+        room_set = self.screen.focused
+        if not isinstance(room_set, RadioSet) or self not in room_set.ancestors:
+            return []
+        buttons = list(room_set.children)
+        index = next((i for i, btn in enumerate(buttons) if btn.has_class("-selected")), None)
+        if index is None:
+            return []
+        around = [buttons[index]] + buttons[index + 1:index + 2] + buttons[max(0, index - 1):index]
+        return [btn.room_id for btn in around]
+        
+    def visible_room_ids(self) -> set[str]:
+        """Get the rooms whose radio buttons are currently scrolled into view
+
+        Returns:
+            set[str]: Matrix room IDs
         """
-        cleaned_id = "radio_btn_" + clean_room_id(room_id)
-        room_set = self.query_one(RadioSet)
-        room_set.get_child_by_id(cleaned_id).add_class("room-highlighted")
\ No newline at end of file
+        return {room_id for room_id, btn in self.buttons.items() if self.can_view_partial(btn)}
@@ -0,0 +1,902 @@
+"""
+    Virtualized message timeline. Only the rows intersecting the viewport
+    (plus a small overscan) are ever rendered, no matter how long the
+    room history grows.
+"""
+
+from __future__ import annotations
+
+import time
+import bisect
+import typing
+import datetime
+
+from rich.console import Group, RenderableType
+from rich.padding import Padding
+from rich.rule import Rule
+from rich.style import Style
+from rich.table import Table
+from rich.text import Text
+
+from textual import events
+from textual.geometry import Size
+from textual.message import Message
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
+
+from nio import RoomMessageText
+
+from nitrix.formatting import RenderCache
+from nitrix.media import is_media
+from nitrix.members import Sender, plain_sender
+from nitrix.metrics import metrics
+from nitrix.outbox import SendState
+
+
+class MessageGroup():
+    """A run of consecutive messages sent by the same user
+
+    Args:
+        message (RoomMessageText): The first message of the group
+        sender (Sender): How the user is shown
+    """
+
+    def __init__(self, message: RoomMessageText, sender: Sender):
+        self.sender_id = message.sender
+        self.sender = sender
+        self.messages = []
+        self.version = 0
+
+        message_time = message.server_timestamp / 1000
+        message_time = datetime.datetime.fromtimestamp(message_time)
+        self.message_time = message_time
+
+    def accepts(self, message: RoomMessageText) -> bool:
+        """Whether a message should be appended to this group
+
+        Args:
+            message (RoomMessageText): The message to check
+
+        Returns:
+            bool: True if the message was sent by the same user within five minutes
+        """
+        message_time = message.server_timestamp / 1000
+        message_time = datetime.datetime.fromtimestamp(message_time)
+        return message.sender == self.sender_id and 0 <= (message_time - self.message_time).total_seconds() <= 300
+
+    def add_message(self, message: RoomMessageText, position: int | None = None):
+        """Adds a message to the group
+
+        Args:
+            message (RoomMessageText): The message to add
+            position (int | None, optional): Where in the group to add it. Defaults to the end.
+        """
+        if message.sender != self.sender_id:
+            return
+        if position is None:
+            self.messages.append(message)
+        else:
+            self.messages.insert(position, message)
+        self.version += 1
+
+    def estimate_height(self, width: int) -> int:
+        """Cheaply guess the rendered height of the group without rendering it
+
+        Args:
+            width (int): Width of the timeline
+
+        Returns:
+            int: Estimated number of lines
+        """
+        body_width = max(1, width - 4)
+        height = 2
+        for message in self.messages:
+            body = getattr(message, "body", None) or ""
+            height += max(1, -(-len(body) // body_width))
+            if is_media(message):
+                height += 1
+        return height
+
+    def render(self, timeline: MessageTimeline) -> RenderableType:
+        """Build the Rich renderable for the group
+
+        Args:
+            timeline (MessageTimeline): The timeline used to resolve component styles
+
+        Returns:
+            RenderableType: The renderable
+        """
+        bodies = [body for _, body in self._bodies(timeline)]
+        return Padding(Group(self._header(timeline), *bodies), (0, 1, 1, 1))
+
+    def message_at(self, timeline: MessageTimeline, line: int, width: int) -> RoomMessageText | None:
+        """Find the message on a line of the rendered group
+
+        Args:
+            timeline (MessageTimeline): The timeline the group is rendered in
+            line (int): The line, counting from the top of the group
+            width (int): Width of the timeline
+
+        Returns:
+            RoomMessageText | None: The message, None for the header and spacing
+        """
+        console = timeline.app.console
+        options = console.options.update_width(max(1, width - 2))
+        line -= len(console.render_lines(self._header(timeline), options, pad=False))
+        for message, body in self._bodies(timeline):
+            line -= len(console.render_lines(body, options, pad=False))
+            if line < 0:
+                return message
+        return None
+
+    def _header(self, timeline: MessageTimeline) -> RenderableType:
+        usercolour = f"timeline--username-{self.sender.colour}"
+        sender_style = timeline.get_component_rich_style("timeline--sender")
+        sender_style += timeline.get_component_rich_style(usercolour)
+        time_style = timeline.get_component_rich_style("timeline--time")
+
+        header = Table.grid(expand=True)
+        header.add_column()
+        header.add_column(justify="right")
+        header.add_row(
+            Text(self.sender.name, style=sender_style),
+            Text(self.message_time.strftime("%a %d, %I:%M%p"), style=time_style),
+        )
+        return header
+
+    def _bodies(self, timeline: MessageTimeline) -> list[tuple[RoomMessageText, RenderableType]]:
+        pending_style = timeline.get_component_rich_style("timeline--pending")
+        failed_style = timeline.get_component_rich_style("timeline--failed")
+        styles, colours = timeline.body_styles()
+        media = timeline.app.media
+
+        bodies = []
+        for message in self.messages:
+            # Local echoes of our own messages that the homeserver hasn't
+            # confirmed yet change as they're sent, so they skip the cache
+            outgoing = getattr(message, "outgoing", None)
+            if outgoing is None:
+                body = timeline.render_cache.body(message, styles, colours)
+                if is_media(message):
+                    # What's been downloaded changes, so it's kept out of the cache too
+                    status = Text(media.status(message), style=styles["quote"])
+                    preview = media.previews.get(message.event_id)
+                    body = Group(body, preview, status) if preview is not None else Group(body, status)
+                bodies.append((message, Padding(body, (0, 0, 0, 2))))
+                continue
+            body = Text(getattr(message, "body", None) or "<ERROR: NO MESSAGE BODY>")
+            if outgoing.state is SendState.PENDING:
+                body.stylize(pending_style)
+            elif outgoing.state is SendState.FAILED:
+                body.stylize(failed_style)
+                body.append(f"  (not sent: {outgoing.error or 'unknown error'}, click to retry)", style=failed_style)
+            bodies.append((message, Padding(body, (0, 0, 0, 2))))
+        return bodies
+
+
+class NewMessagesMarker():
+    """The in-line "NEW MESSAGES" notification"""
+
+    version = 0
+
+    def estimate_height(self, width: int) -> int:
+        return 1
+
+    def render(self, timeline: MessageTimeline) -> RenderableType:
+        style = timeline.get_component_rich_style("timeline--new-messages")
+        return Rule(Text("NEW MESSAGES", style=style), style=style, align="left")
+
+
+TimelineRow = typing.Union[MessageGroup, NewMessagesMarker]
+
+
+def build_rows(messages: list[RoomMessageText], resolve_sender: typing.Callable[[str], Sender]) -> list[MessageGroup]:
+    """Group consecutive messages into rows
+
+    Args:
+        messages (list[RoomMessageText]): Messages, oldest first
+        resolve_sender (typing.Callable[[str], Sender]): Gets how a user is shown
+
+    Returns:
+        list[MessageGroup]: The grouped rows
+    """
+    rows = []
+    for message in messages:
+        if not rows or not rows[-1].accepts(message):
+            rows.append(MessageGroup(message, resolve_sender(message.sender)))
+        rows[-1].add_message(message)
+    return rows
+
+
+class TimelineLayout():
+    """Rows and row geometry of a single room's timeline
+
+    Heights are estimated when a row is added and replaced with the real
+    height once the row is rendered, so only on-screen rows are ever measured.
+
+    Args:
+        resolve_sender (typing.Callable[[str], Sender], optional): Gets how a user is shown. Defaults to their localpart.
+    """
+
+    def __init__(self, resolve_sender: typing.Callable[[str], Sender] = plain_sender):
+        self.resolve_sender = resolve_sender
+        self.rows: list[TimelineRow] = []
+        self.width = 0
+        self.scroll_y = 0
+        self.following = True
+        self._heights: list[int] = []
+        self._measured: list[bool] = []
+        # _offsets[i] is the y position of row i, valid up to _valid
+        self._offsets: list[int] = [0]
+        self._valid = 0
+        # The group new messages get appended to, and the group of every event
+        self.tail_group: MessageGroup | None = None
+        self._groups: dict[str, MessageGroup] = {}
+        # The "NEW MESSAGES" row, and whether it has been on screen yet
+        self.marker: NewMessagesMarker | None = None
+        self.marker_seen = False
+        # Row -> its index, dropped when rows are inserted or removed
+        # anywhere but the end and built again on the next lookup
+        self._indices: dict[TimelineRow, int] | None = {}
+        # Rows rendered ahead of the layout being shown, see `MessageTimeline.prerender_step`
+        self.warm_strips: dict[TimelineRow, tuple[int, list[Strip]]] = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def height(self) -> int:
+        return self.offset(len(self.rows))
+
+    def set_width(self, width: int) -> bool:
+        """Set the width the rows are laid out at
+
+        Args:
+            width (int): The new width
+
+        Returns:
+            bool: True if the width changed and all measurements were discarded
+        """
+        if width == self.width:
+            return False
+        self.width = width
+        self._heights = [row.estimate_height(width) for row in self.rows]
+        self._measured = [False] * len(self.rows)
+        self._valid = 0
+        return True
+
+    def insert(self, index: int, rows: list[TimelineRow]):
+        """Insert rows before `index`
+
+        Args:
+            index (int): Position to insert at
+            rows (list[TimelineRow]): The rows to insert
+        """
+        if index == len(self.rows) and self._indices is not None:
+            self._indices.update((row, index + i) for i, row in enumerate(rows))
+        else:
+            self._indices = None
+        self.rows[index:index] = rows
+        self._heights[index:index] = [row.estimate_height(self.width) for row in rows]
+        self._measured[index:index] = [False] * len(rows)
+        self._valid = min(self._valid, index)
+
+    def append(self, row: TimelineRow):
+        """Append a row to the end of the timeline
+
+        Args:
+            row (TimelineRow): The row to append
+        """
+        self.insert(len(self.rows), [row])
+
+    def remove(self, index: int):
+        """Remove the row at `index`
+
+        Args:
+            index (int): The row to remove
+        """
+        if index == len(self.rows) - 1 and self._indices is not None:
+            del self._indices[self.rows[index]]
+        else:
+            self._indices = None
+        del self.rows[index]
+        del self._heights[index]
+        del self._measured[index]
+        self._valid = min(self._valid, index)
+
+    def index(self, row: TimelineRow) -> int:
+        """Find the index of a row
+
+        Args:
+            row (TimelineRow): The row
+
+        Returns:
+            int: Its index
+        """
+        if self._indices is None:
+            self._indices = {row: index for index, row in enumerate(self.rows)}
+        return self._indices[row]
+
+    def append_message(self, message: RoomMessageText):
+        """Add a message after every other message
+
+        Args:
+            message (RoomMessageText): The message to add
+        """
+        group = self.tail_group
+        if group is not None and group.accepts(message):
+            group.add_message(message)
+            self.invalidate(len(self.rows) - 1)
+        else:
+            group = MessageGroup(message, self.resolve_sender(message.sender))
+            group.add_message(message)
+            self.append(group)
+            self.tail_group = group
+        self._groups[message.event_id] = group
+
+    def prepend_messages(self, messages: list[RoomMessageText]):
+        """Add messages before every other message
+
+        Args:
+            messages (list[RoomMessageText]): The messages to add, oldest first
+        """
+        rows = build_rows(messages, self.resolve_sender)
+        for group in rows:
+            for message in group.messages:
+                self._groups[message.event_id] = group
+        self.insert(0, rows)
+        if self.tail_group is None and self.marker is None and rows:
+            self.tail_group = self.rows[-1]
+
+    def insert_message(self, message: RoomMessageText, previous: RoomMessageText):
+        """Add a message right after another one, splitting its group if needed
+
+        Args:
+            message (RoomMessageText): The message to add
+            previous (RoomMessageText): The message it follows
+        """
+        group = self._groups[previous.event_id]
+        index = self.index(group)
+        position = group.messages.index(previous) + 1
+
+        if group.accepts(message):
+            group.add_message(message, position)
+            self.invalidate(index)
+            self._groups[message.event_id] = group
+            return
+
+        new_group = MessageGroup(message, self.resolve_sender(message.sender))
+        new_group.add_message(message)
+        self._groups[message.event_id] = new_group
+        rows = [new_group]
+
+        # Messages after the insertion point move into a group of their own
+        if (rest := group.messages[position:]):
+            del group.messages[position:]
+            group.version += 1
+            self.invalidate(index)
+            rest_group = build_rows(rest, self.resolve_sender)[0]
+            for moved in rest:
+                self._groups[moved.event_id] = rest_group
+            rows.append(rest_group)
+            if self.tail_group is group:
+                self.tail_group = rest_group
+        self.insert(index + 1, rows)
+
+    def replace_message(self, event_id: str, message: RoomMessageText):
+        """Swap a message for another one from the same sender in the same spot
+
+        Args:
+            event_id (str): The event ID of the message to swap out
+            message (RoomMessageText): The message to put in its place
+        """
+        if (group := self._groups.pop(event_id, None)) is None:
+            return
+        position = next(i for i, old in enumerate(group.messages) if old.event_id == event_id)
+        group.messages[position] = message
+        self._groups[message.event_id] = group
+        self.update_message(message.event_id)
+
+    def update_message(self, event_id: str):
+        """Mark the row of a message that changed for rendering again
+
+        Args:
+            event_id (str): The event ID of the message
+        """
+        if (group := self._groups.get(event_id)) is None:
+            return
+        group.version += 1
+        self.invalidate(self.index(group))
+
+    def update_senders(self, user_ids: set[str]) -> bool:
+        """Mark the rows of users whose name may have changed for rendering again
+
+        Args:
+            user_ids (set[str]): The users
+
+        Returns:
+            bool: True if any row changed
+        """
+        changed = False
+        for index, row in enumerate(self.rows):
+            if isinstance(row, MessageGroup) and row.sender_id in user_ids:
+                # The sender may have been dropped from the cache since, get it again
+                row.sender = self.resolve_sender(row.sender_id)
+                row.version += 1
+                self.invalidate(index)
+                changed = True
+        return changed
+
+    def row_of(self, event_id: str) -> int | None:
+        """Find the row a message is in
+
+        Args:
+            event_id (str): The event ID of the message
+
+        Returns:
+            int | None: The row index, None if the message isn't laid out
+        """
+        if (group := self._groups.get(event_id)) is None:
+            return None
+        return self.index(group)
+
+    def add_marker(self, seen: bool):
+        """Add the "NEW MESSAGES" row after the last message, unless there already is one
+
+        Args:
+            seen (bool): Whether the row is going straight on screen
+        """
+        if self.marker is not None:
+            return
+        self.marker = NewMessagesMarker()
+        self.marker_seen = seen
+        self.append(self.marker)
+        self.tail_group = None
+
+    def remove_marker(self):
+        """Remove the "NEW MESSAGES" row"""
+        if self.marker is None:
+            return
+        self.remove(self.index(self.marker))
+        self.marker = None
+        if self.tail_group is None and self.rows and isinstance(self.rows[-1], MessageGroup):
+            self.tail_group = self.rows[-1]
+
+    def invalidate(self, index: int):
+        """Mark a row as changed so it gets measured again
+
+        Args:
+            index (int): The row that changed
+        """
+        self._heights[index] = self.rows[index].estimate_height(self.width)
+        self._measured[index] = False
+        self._valid = min(self._valid, index)
+
+    def is_measured(self, index: int) -> bool:
+        return self._measured[index]
+
+    def set_height(self, index: int, height: int) -> int:
+        """Record the measured height of a row
+
+        Args:
+            index (int): The row that was measured
+            height (int): Its rendered height
+
+        Returns:
+            int: Difference between the new and the previous height
+        """
+        delta = height - self._heights[index]
+        self._heights[index] = height
+        self._measured[index] = True
+        if delta:
+            self._valid = min(self._valid, index)
+        return delta
+
+    def offset(self, index: int) -> int:
+        """Get the y position at which a row starts
+
+        Args:
+            index (int): The row index, or the row count for the total height
+
+        Returns:
+            int: The y position
+        """
+        if index > self._valid:
+            del self._offsets[self._valid + 1:]
+            total = self._offsets[self._valid]
+            for height in self._heights[self._valid:]:
+                total += height
+                self._offsets.append(total)
+            self._valid = len(self.rows)
+        return self._offsets[index]
+
+    def row_at(self, y: int) -> int:
+        """Get the index of the row covering line `y`
+
+        Args:
+            y (int): A line in the timeline
+
+        Returns:
+            int: The row index
+        """
+        self.offset(len(self.rows))
+        index = bisect.bisect_right(self._offsets, y, 0, len(self.rows)) - 1
+        return max(0, index)
+
+
+class MessageTimeline(ScrollView, can_focus=True):
+    """Renders a `TimelineLayout` with the line API"""
+
+    COMPONENT_CLASSES = {
+        "timeline--sender",
+        "timeline--time",
+        "timeline--new-messages",
+        "timeline--pending",
+        "timeline--failed",
+        "timeline--code",
+        "timeline--quote",
+        "timeline--mention",
+        "timeline--link",
+        "timeline--media",
+        "timeline--username-1",
+        "timeline--username-2",
+        "timeline--username-3",
+        "timeline--username-4",
+        "timeline--username-5",
+        "timeline--username-6",
+    }
+
+    # Lines rendered above and below the viewport
+    OVERSCAN = 10
+
+    # Message bodies kept parsed and rendered, see `RenderCache`
+    RENDER_CACHE_SIZE = 2000
+
+    # Older history is requested this many screens from the top, plus
+    # however far PREFETCH_SECONDS of scrolling at the current speed goes
+    PREFETCH_SCREENS = 2
+    PREFETCH_SECONDS = 2
+
+    class NearTop(Message):
+        """Posted when the viewport approaches the oldest loaded row"""
+
+        def __init__(self, velocity: float):
+            self.velocity = velocity
+            super().__init__()
+
+    class MessageClicked(Message):
+        """Posted when a message is clicked"""
+
+        def __init__(self, message: RoomMessageText):
+            self.message = message
+            super().__init__()
+
+    class ReachedEnd(Message):
+        """Posted when the newest message is on screen"""
+
+    class MediaNearViewport(Message):
+        """Posted when media messages come within the rendered rows for the first time"""
+
+        def __init__(self, messages: list[RoomMessageText]):
+            self.messages = messages
+            super().__init__()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_layout: TimelineLayout | None = None
+        # Rendered rows in and around the viewport: row -> (version, strips)
+        self._strips: dict[TimelineRow, tuple[int, list[Strip]]] = {}
+        self.render_cache = RenderCache(self.RENDER_CACHE_SIZE)
+        # Media messages already posted in a MediaNearViewport
+        self._media_seen: set[str] = set()
+        self._update_pending = False
+        # When the oldest change waiting to be painted arrived, if it's being timed
+        self._received: float | None = None
+        # Upwards scroll speed in lines per second
+        self._velocity = 0.0
+        self._last_scroll = time.monotonic()
+
+    def on_mount(self):
+        size = self.app.config.get_config("Performance", "render_cache_size")
+        if size:
+            self.render_cache.max_entries = max(1, int(size))
+        self.app.theme_changed_signal.subscribe(self, self.on_theme_changed)
+
+    def on_theme_changed(self, theme):
+        # Cached bodies have the old theme's colours baked in
+        self.render_cache.clear()
+        self._strips = {}
+        self.refresh_rows()
+
+    def body_styles(self) -> tuple[dict[str, Style], dict[int, Style]]:
+        """Resolve the component styles message bodies are rendered with
+
+        Returns:
+            tuple[dict[str, Style], dict[int, Style]]: Styles by element, and username colours by `get_user_id_colour`
+        """
+        styles = {
+            name: self.get_component_rich_style(f"timeline--{name}")
+            for name in ("code", "quote", "mention", "link", "media")
+        }
+        colours = {
+            number: self.get_component_rich_style(f"timeline--username-{number}")
+            for number in range(1, 7)
+        }
+        return styles, colours
+
+    @property
+    def at_end(self) -> bool:
+        return self.scroll_y >= self.max_scroll_y
+
+    def show(self, layout: TimelineLayout):
+        """Swap the displayed timeline
+
+        Args:
+            layout (TimelineLayout): The room layout to display
+        """
+        if self.room_layout is not None:
+            self.room_layout.scroll_y = self.scroll_y
+            self.room_layout.following = self.at_end
+        self.room_layout = layout
+        # Whatever was rendered ahead while the room was prewarmed
+        self._strips, layout.warm_strips = layout.warm_strips, {}
+        # Scroll to where the room opens before rendering anything, so only
+        # the rows there get rendered
+        width = self.scrollable_content_region.width
+        if width > 0:
+            if layout.set_width(width):
+                self._strips = {}
+            self.virtual_size = Size(width, layout.height)
+        if not layout.following:
+            self.scroll_to(y=layout.scroll_y, animate=False, immediate=True, force=True)
+        else:
+            self.scroll_end(animate=False, immediate=True, force=True)
+        self.update_layout()
+        if layout.following:
+            # The rows measured at the end may have grown
+            self.scroll_end(animate=False, immediate=True, force=True)
+            self.post_message(self.ReachedEnd())
+        self.refresh()
+        self.check_near_top()
+
+    def update_layout(self):
+        """Measure the rows around the viewport and resize the virtual canvas"""
+        with metrics.timer("timeline.layout"):
+            self._update_layout()
+
+    def _update_layout(self):
+        layout = self.room_layout
+        width = self.scrollable_content_region.width
+        if layout is None or width <= 0:
+            return
+        if layout.set_width(width):
+            self._strips = {}
+            layout.warm_strips = {}
+
+        following = self.at_end
+        scroll_y = int(self.scroll_y)
+        top = max(0, scroll_y - self.OVERSCAN)
+        bottom = scroll_y + self.scrollable_content_region.height + self.OVERSCAN
+
+        # Render everything between top and bottom, keeping track of how much
+        # the rows above the viewport grew so the content stays anchored
+        strips = {}
+        media = []
+        shift = 0
+        index = layout.row_at(top) if layout.rows else 0
+        while index < len(layout.rows) and layout.offset(index) < bottom:
+            row = layout.rows[index]
+            if isinstance(row, MessageGroup):
+                media += [
+                    message for message in row.messages
+                    if is_media(message) and message.event_id not in self._media_seen
+                ]
+            strips[row] = self._render_row(row, width)
+            if not layout.is_measured(index):
+                delta = layout.set_height(index, len(strips[row][1]))
+                if layout.offset(index) < scroll_y:
+                    shift += delta
+            index += 1
+        self._strips = strips
+        if media:
+            self._media_seen.update(message.event_id for message in media)
+            self.post_message(self.MediaNearViewport(media))
+
+        self.virtual_size = Size(width, layout.height)
+        if shift and not following:
+            self.scroll_to(y=self.scroll_y + shift, animate=False, immediate=True, force=True)
+
+    def prepend_messages(self, messages: list[RoomMessageText]):
+        """Insert older messages at the top without disturbing the rows on screen
+
+        Args:
+            messages (list[RoomMessageText]): The messages to insert, oldest first
+        """
+        layout = self.room_layout
+        height = layout.height
+        layout.prepend_messages(messages)
+        shift = layout.height - height
+
+        # Keep what's on screen in place, the rendered rows are reused as is
+        self.virtual_size = Size(self.virtual_size.width, layout.height)
+        self.scroll_to(y=self.scroll_y + shift, animate=False, immediate=True, force=True)
+        self.update_layout()
+        self.refresh()
+
+    def splice(self, change: typing.Callable[[], typing.Any]):
+        """Make a change that may add rows anywhere in the displayed layout,
+        e.g. messages filled in before the rows on screen, keeping what's on
+        screen in place. Only the rows that changed get measured again.
+
+        Args:
+            change (typing.Callable[[], typing.Any]): Makes the change
+        """
+        layout = self.room_layout
+        following = self.at_end
+        anchor = layout.rows[layout.row_at(int(self.scroll_y))] if layout.rows else None
+        top = layout.offset(layout.index(anchor)) if anchor is not None else 0
+        change()
+        if anchor is not None and not following and anchor in layout.rows:
+            shift = layout.offset(layout.index(anchor)) - top
+            if shift:
+                self.virtual_size = Size(self.virtual_size.width, layout.height)
+                self.scroll_to(y=self.scroll_y + shift, animate=False, immediate=True, force=True)
+        self.refresh_rows()
+
+    def scroll_to_message(self, event_id: str):
+        """Bring a message into view, a third of the way down the screen
+
+        Args:
+            event_id (str): The event ID of the message
+        """
+        layout = self.room_layout
+        if layout is None or (index := layout.row_of(event_id)) is None:
+            return
+        y = max(0, layout.offset(index) - self.size.height // 3)
+        self.scroll_to(y=y, animate=False, immediate=True, force=True)
+        self.update_layout()
+        self.refresh()
+
+    def check_near_top(self):
+        """Ask for older history if the viewport is getting close to the top"""
+        if self.room_layout is None:
+            return
+        distance = self.PREFETCH_SCREENS * self.size.height + self._velocity * self.PREFETCH_SECONDS
+        if self.scroll_y <= distance:
+            self.post_message(self.NearTop(self._velocity))
+
+    def queue_refresh(self, received: float | None = None):
+        """Refresh the rows on the next frame, however often this is called before then
+
+        Args:
+            received (float | None, optional): `time.perf_counter()` when the change arrived, to time it until it's painted. Defaults to None.
+        """
+        if received is not None and metrics.enabled:
+            self._received = received if self._received is None else min(self._received, received)
+        if not self._update_pending:
+            self._update_pending = True
+            self.call_after_refresh(self.refresh_rows)
+
+    def refresh_rows(self):
+        """Re-measure and repaint after rows were added or changed"""
+        self._update_pending = False
+        following = self.at_end
+        self.update_layout()
+        if following:
+            self.scroll_end(animate=False, immediate=True, force=True)
+            self.post_message(self.ReachedEnd())
+        self.refresh()
+
+        if self._received is not None:
+            received, self._received = self._received, None
+            self.call_after_refresh(
+                lambda: metrics.record("event.received_to_rendered", time.perf_counter() - received))
+
+    def prerender_step(self, layout: TimelineLayout) -> bool:
+        """Render and measure one more of the rows a layout that isn't shown
+        would open at, keeping them on the layout until it's shown
+
+        Args:
+            layout (TimelineLayout): The layout of a room that might be opened next
+
+        Returns:
+            bool: False once there's nothing left to render
+        """
+        width = self.scrollable_content_region.width
+        if width <= 0 or layout is self.room_layout or not layout.rows:
+            return False
+        if layout.set_width(width):
+            layout.warm_strips = {}
+
+        height = self.scrollable_content_region.height + self.OVERSCAN
+        if layout.following:
+            bottom = layout.height
+            top = max(0, bottom - height)
+        else:
+            top = max(0, layout.scroll_y - self.OVERSCAN)
+            bottom = layout.scroll_y + height
+        index = layout.row_at(top)
+        while index < len(layout.rows) and layout.offset(index) < bottom:
+            row = layout.rows[index]
+            cached = layout.warm_strips.get(row)
+            rendered = self._render_row(row, width, layout.warm_strips)
+            if rendered is not cached or not layout.is_measured(index):
+                layout.warm_strips[row] = rendered
+                layout.set_height(index, len(rendered[1]))
+                return True
+            index += 1
+        return False
+
+    def _render_row(self, row: TimelineRow, width: int, rendered: dict | None = None) -> tuple[int, list[Strip]]:
+        """Render a row, reusing the previous render if it's still current
+
+        Args:
+            row (TimelineRow): The row to render
+            width (int): Width to render at
+            rendered (dict | None, optional): Previous renders to reuse. Defaults to the rows on screen.
+
+        Returns:
+            tuple[int, list[Strip]]: The row version and its lines
+        """
+        cached = (self._strips if rendered is None else rendered).get(row)
+        if cached and cached[0] == row.version and cached[1] and cached[1][0].cell_length == width:
+            return cached
+        console = self.app.console
+        options = console.options.update_width(width)
+        lines = console.render_lines(row.render(self), options, style=self.rich_style)
+        return row.version, [Strip(line, width) for line in lines]
+
+    def render_line(self, y: int) -> Strip:
+        width = self.scrollable_content_region.width
+        layout = self.room_layout
+        virtual_y = self.scroll_offset.y + y
+        if layout is None or not layout.rows or virtual_y >= layout.height:
+            return Strip.blank(width, self.rich_style)
+
+        index = layout.row_at(virtual_y)
+        row = layout.rows[index]
+        if row not in self._strips or width != layout.width:
+            # Scrolled faster than the window was updated, or the
+            # scrollbar appeared and the width changed under us
+            self._strips[row] = self._render_row(row, width)
+            self.queue_refresh()
+        _, strips = self._strips[row]
+
+        line = virtual_y - layout.offset(index)
+        if line >= len(strips):
+            return Strip.blank(width, self.rich_style)
+        return strips[line]
+
+    def watch_scroll_y(self, old_value: float, new_value: float):
+        super().watch_scroll_y(old_value, new_value)
+        if round(old_value) != round(new_value):
+            now = time.monotonic()
+            elapsed = max(now - self._last_scroll, 0.001)
+            self._last_scroll = now
+            speed = max(0.0, (old_value - new_value) / elapsed)
+            self._velocity = (self._velocity + speed) / 2
+
+            self.update_layout()
+            self.check_near_top()
+            if new_value >= self.max_scroll_y > old_value:
+                self.post_message(self.ReachedEnd())
+
+    def on_click(self, event: events.Click):
+        layout = self.room_layout
+        offset = event.get_content_offset(self)
+        if layout is None or not layout.rows or offset is None:
+            return
+        virtual_y = self.scroll_offset.y + offset.y
+        if virtual_y >= layout.height:
+            return
+        index = layout.row_at(virtual_y)
+        row = layout.rows[index]
+        if not isinstance(row, MessageGroup):
+            return
+        width = self.scrollable_content_region.width
+        message = row.message_at(self, virtual_y - layout.offset(index), width)
+        if message is not None:
+            self.post_message(self.MessageClicked(message))
+
+    def on_resize(self, event: events.Resize):
+        self.refresh_rows()
@@ -8,14 +8,12 @@ import typing
 from pathlib import Path
 
 from textual.screen import Screen
-from textual.widgets import Input, Button, Label, TextArea
-from textual.containers import Container, Center, VerticalScroll, Horizontal, Vertical
-from textual.reactive import reactive
+from textual.containers import Horizontal, Vertical
 
-from nio import JoinedRoomsResponse, MatrixRoom, RoomMessageText
-from nio.responses import Rooms, SyncResponse
+from nitrix.metrics import metrics
+from nitrix.screens.search.screen import SearchScreen
 
-from .components import RoomsContainer, MessagesContainer, MessageBox
+from .components import RoomsContainer, MessagesContainer, MessageBox, MemberList, PerformanceOverlay
 
 if typing.TYPE_CHECKING:
     from nitrix.app import NitrixApp
@@ -24,18 +22,79 @@ if typing.TYPE_CHECKING:
 class MainScreen(Screen):
     CSS_PATH = Path(__file__).parent / "style.tcss"
     
+    BINDINGS = [
+        ("ctrl+f", "search", "Search"),
+        ("f2", "toggle_performance", "Performance"),
+        ("f3", "toggle_members", "Members"),
+    ]
+    
+    # Whether metrics were on before the performance overlay was shown
+    _metrics_enabled = False
+    
     def compose(self):
         with Horizontal():
             yield RoomsContainer()
             with Vertical():
                 yield MessagesContainer()
                 yield MessageBox()
+            yield MemberList()
+        yield PerformanceOverlay()
         
-    async def on_nitrix_app_client_update(self, client_update: "NitrixApp.ClientUpdate"):
-        room = client_update.room
-        message = client_update.message
-        await self.update_rooms(room, message)
+    def on_nitrix_app_account_added(self, account_added: "NitrixApp.AccountAdded"):
+        self.query_one(RoomsContainer).add_account(account_added.client)
+        self.query_one(MessagesContainer).add_account(account_added.client)
         
-    async def update_rooms(self, room: MatrixRoom, message: RoomMessageText):
+    async def on_nitrix_app_sync_update(self, sync_update: "NitrixApp.SyncUpdate"):
+        rooms_container = self.query_one("RoomsContainer")
+        await rooms_container.apply_sync(sync_update.response)
         msg_container = self.query_one("MessagesContainer")
-        self.run_worker(msg_container.add_message(room, message))
\ No newline at end of file
+        with metrics.timer("sync.apply_ui"):
+            # Renamed senders first, so new messages come in under their new names
+            members = self.app.senders.apply_sync(sync_update.response, self.app.get_room)
+            msg_container.update_senders(members)
+            await msg_container.apply_sync(sync_update.response, sync_update.received)
+        if self.app.current_room in members:
+            self.query_one(MemberList).update_members(members[self.app.current_room])
+        if self.app.current_room in sync_update.response.rooms.join:
+            self.query_one(MessageBox).show_typing(self.app.get_room(self.app.current_room))
+        
+    def action_search(self):
+        self.app.push_screen(SearchScreen(), self.jump_to_result)
+        
+    async def jump_to_result(self, result: tuple[str, str] | None):
+        """Open the room of a search result and scroll to the message
+
+        Args:
+            result (tuple[str, str] | None): Room ID and event ID, None if the search was closed
+        """
+        if result is None:
+            return
+        room_id, event_id = result
+        rooms_container = self.query_one("RoomsContainer")
+        if (btn := rooms_container.buttons.get(room_id)) is not None:
+            btn.value = True
+        msg_container = self.query_one("MessagesContainer")
+        if msg_container.displayed_room != room_id:
+            self.app.current_room = room_id
+            await msg_container.change_room(room_id)
+        await msg_container.jump_to_event(room_id, event_id)
+        
+    def action_toggle_performance(self):
+        """Show or hide the performance overlay, turning instrumentation
+        on while it's shown if it isn't already"""
+        overlay = self.query_one(PerformanceOverlay)
+        overlay.display = not overlay.display
+        if overlay.display:
+            # Back to how the config had it once the overlay is hidden again
+            self._metrics_enabled = metrics.enabled
+            metrics.enabled = True
+            overlay.update_stats()
+        else:
+            metrics.enabled = self._metrics_enabled
+            
+    def action_toggle_members(self):
+        """Show or hide the member roster of the open room"""
+        member_list = self.query_one(MemberList)
+        member_list.display = not member_list.display
+        if member_list.display:
+            member_list.show_room(self.app.current_room)
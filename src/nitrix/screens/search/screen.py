@@ -0,0 +1,144 @@
+"""
+    Search screen of Nitrix. Searches the full text index of the local
+    store, so results come up as you type without asking the homeserver.
+"""
+
+from __future__ import annotations
+
+import time
+import datetime
+import itertools
+
+from pathlib import Path
+
+from rich.text import Text
+
+from textual.screen import ModalScreen
+from textual.widgets import Input, Label, OptionList, Select
+from textual.widgets.option_list import Option
+from textual.containers import Horizontal, Vertical
+
+from nitrix.metrics import metrics
+
+
+class SearchScreen(ModalScreen):
+    """Search through the messages of every room, dismissing with the
+    room ID and event ID of the chosen result
+    """
+    CSS_PATH = Path(__file__).parent / "style.tcss"
+
+    BINDINGS = [
+        ("escape", "dismiss", "Close"),
+    ]
+
+    # Seconds of no typing before searching
+    DEBOUNCE = 0.15
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results: list[tuple[str, str]] = []
+        self._timer = None
+
+    def compose(self):
+        rooms = sorted(
+            (room.display_name, room_id) for room_id, room in self.app.rooms.items())
+        with Vertical(id="search"):
+            yield Input(id="search_query", placeholder="Search messages")
+            with Horizontal(id="search_filters"):
+                yield Select(rooms, id="search_room", prompt="All rooms")
+                yield Input(id="search_sender", placeholder="Sender")
+                yield Input(id="search_since", placeholder="From (YYYY-MM-DD)")
+                yield Input(id="search_until", placeholder="To (YYYY-MM-DD)")
+            yield Label(id="search_status")
+            yield OptionList(id="search_results")
+
+    def on_mount(self):
+        self.query_one("#search_query").focus()
+
+    def on_input_changed(self, event: Input.Changed):
+        self.queue_search()
+
+    def on_select_changed(self, event: Select.Changed):
+        self.queue_search()
+
+    def on_input_submitted(self, event: Input.Submitted):
+        # Enter jumps to the top result
+        if self.results:
+            self.dismiss(self.results[0])
+
+    def on_option_list_option_selected(self, event: OptionList.OptionSelected):
+        self.dismiss(self.results[event.option_index])
+
+    def queue_search(self):
+        """Search once typing has paused"""
+        if self._timer is not None:
+            self._timer.stop()
+        self._timer = self.set_timer(self.DEBOUNCE, self.search)
+
+    @staticmethod
+    def parse_date(value: str) -> int | None:
+        """Turn a YYYY-MM-DD date into a timestamp in milliseconds
+
+        Args:
+            value (str): The date, or an empty string
+
+        Returns:
+            int | None: Milliseconds since the epoch at the start of the day, None if it isn't a date
+        """
+        try:
+            date = datetime.datetime.strptime(value.strip(), "%Y-%m-%d")
+        except ValueError:
+            return None
+        return int(date.timestamp() * 1000)
+
+    def search(self):
+        """Run the search and list the results"""
+        query = self.query_one("#search_query", Input).value
+        room_id = self.query_one("#search_room", Select).value
+        since = self.parse_date(self.query_one("#search_since", Input).value)
+        until = self.parse_date(self.query_one("#search_until", Input).value)
+        if until is not None:
+            # Up to and including the day
+            until += 24 * 60 * 60 * 1000
+
+        room_id = None if room_id is Select.NULL else room_id
+        sender = self.query_one("#search_sender", Input).value.strip() or None
+
+        start = time.perf_counter()
+        with metrics.timer("search.query"):
+            # Every account has a store of its own, their best results are
+            # interleaved and messages in rooms shared by accounts only listed once
+            per_account = [
+                client.event_store.search(query, room_id=room_id, sender=sender, since=since, until=until)
+                for client in self.app.clients
+                if room_id is None or room_id in client.rooms
+            ]
+            results, seen = [], set()
+            for result in itertools.chain.from_iterable(itertools.zip_longest(*per_account)):
+                if result is not None and result[1].event_id not in seen:
+                    seen.add(result[1].event_id)
+                    results.append(result)
+        elapsed = time.perf_counter() - start
+
+        rooms = self.app.rooms
+        words = query.split()
+        options = []
+        self.results = []
+        for room_id, event in results:
+            room = rooms.get(room_id)
+            sent = datetime.datetime.fromtimestamp(event.server_timestamp / 1000)
+            heading = Text.assemble(
+                (room.display_name if room else room_id, "bold"), "  ",
+                event.sender, "  ",
+                (sent.strftime("%Y-%m-%d %H:%M"), "italic"),
+            )
+            body = Text(getattr(event, "body", None) or "")
+            body.highlight_words(words, "reverse", case_sensitive=False)
+            options.append(Option(Text("\n").join([heading, body])))
+            self.results.append((room_id, event.event_id))
+
+        result_list = self.query_one("#search_results", OptionList)
+        result_list.clear_options()
+        result_list.add_options(options)
+        status = f"{len(results)} results in {elapsed * 1000:.0f}ms" if words else ""
+        self.query_one("#search_status", Label).update(status)
@@ -0,0 +1,133 @@
+"""
+    The rooms in Spaces, fetched from the room hierarchy API a page at a
+    time and only for the Spaces that are opened. Fetched pages are kept
+    until the Space's children change.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+
+from nio import AsyncClient, MatrixRoom, SpaceGetHierarchyError
+
+from nitrix.metrics import metrics
+from nitrix.scheduler import RateLimited
+
+SPACE_TYPE = "m.space"
+
+
+def is_space(room: MatrixRoom | None) -> bool:
+    return room is not None and room.room_type == SPACE_TYPE
+
+
+class SpaceChild():
+    """A room or Space listed in a Space
+
+    Args:
+        chunk (dict): The room's entry in a hierarchy response
+    """
+
+    def __init__(self, chunk: dict):
+        self.room_id: str = chunk["room_id"]
+        self.name: str = chunk.get("name") or chunk.get("canonical_alias") or self.room_id
+        self.is_space = chunk.get("room_type") == SPACE_TYPE
+        self.members: int = chunk.get("num_joined_members", 0)
+
+
+class SpaceHierarchy():
+    """The pages of a Space's direct children fetched so far
+
+    Args:
+        space_id (str): Room ID of the Space
+    """
+
+    def __init__(self, space_id: str):
+        self.space_id = space_id
+        self.children: list[SpaceChild] = []
+        # Token of the next page, None once every child has been fetched
+        self.next_batch: str | None = None
+        self.fetched = False
+
+    @property
+    def complete(self) -> bool:
+        return self.fetched and self.next_batch is None
+
+
+class SpaceCache():
+    """Hierarchies of the most recently opened Spaces of an account
+
+    Args:
+        max_spaces (int, optional): Spaces kept before the least recently opened are forgotten. Defaults to MAX_SPACES.
+    """
+
+    # Children per page, and Spaces kept
+    PAGE_SIZE = 50
+    MAX_SPACES = 100
+
+    def __init__(self, max_spaces: int = MAX_SPACES):
+        self.max_spaces = max_spaces
+        self.hierarchies: OrderedDict[str, SpaceHierarchy] = OrderedDict()
+
+    def get(self, space_id: str) -> SpaceHierarchy:
+        """Get the cached hierarchy of a Space, an empty one if nothing's been fetched
+
+        Args:
+            space_id (str): Room ID of the Space
+
+        Returns:
+            SpaceHierarchy: The hierarchy
+        """
+        if (hierarchy := self.hierarchies.get(space_id)) is None:
+            hierarchy = self.hierarchies[space_id] = SpaceHierarchy(space_id)
+            while len(self.hierarchies) > self.max_spaces:
+                self.hierarchies.popitem(last=False)
+        self.hierarchies.move_to_end(space_id)
+        return hierarchy
+
+    def invalidate(self, space_id: str) -> bool:
+        """Forget the fetched children of a Space, e.g. after its m.space.child state changed
+
+        Args:
+            space_id (str): Room ID of the Space
+
+        Returns:
+            bool: True if anything had been fetched
+        """
+        return self.hierarchies.pop(space_id, None) is not None
+
+    async def fetch_page(self, client: AsyncClient, space_id: str) -> list[SpaceChild]:
+        """Fetch the next page of a Space's children
+
+        Args:
+            client (AsyncClient): The client to fetch with
+            space_id (str): Room ID of the Space
+
+        Raises:
+            RateLimited: The homeserver asked to slow down
+
+        Returns:
+            list[SpaceChild]: The children on the page, nothing if the Space is complete or couldn't be fetched
+        """
+        hierarchy = self.get(space_id)
+        if hierarchy.complete:
+            return []
+        with metrics.timer("spaces.fetch_page"):
+            response = await client.space_get_hierarchy(
+                space_id, from_page=hierarchy.next_batch, limit=self.PAGE_SIZE, max_depth=1)
+        if isinstance(response, SpaceGetHierarchyError):
+            if response.status_code == "M_LIMIT_EXCEEDED":
+                raise RateLimited(response.retry_after_ms)
+            # e.g. a Space we can't peek into, shown as empty
+            hierarchy.fetched = True
+            hierarchy.next_batch = None
+            return []
+
+        # Invalidated while the page was on its way, it's stale
+        if self.hierarchies.get(space_id) is not hierarchy:
+            return []
+        # The Space itself leads the first page
+        children = [SpaceChild(chunk) for chunk in response.rooms if chunk.get("room_id") not in (space_id, None)]
+        hierarchy.children += children
+        hierarchy.next_batch = response.next_batch or None
+        hierarchy.fetched = True
+        return children
@@ -0,0 +1,52 @@
+"""
+    Startup timing. Marks are taken as the app comes up, recorded as
+    metrics, and reported by `nitrix --profile-startup`, which quits as soon
+    as the login form is on screen.
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+
+from nitrix.metrics import metrics
+
+# Modules only needed once logging in starts, which the login form
+# shouldn't have to wait on
+DEFERRED_MODULES = ("nio", "aiohttp", "nitrix.client", "nitrix.screens.main.screen", "PIL")
+
+
+class StartupProfile():
+    """Time since nitrix started of every step of getting the login form up"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.enabled = False
+        self.marks: list[tuple[str, float]] = []
+        # Deferred modules that had been loaded by the first paint
+        self.loaded_early: list[str] | None = None
+
+    def mark(self, name: str):
+        """Note that a step of starting up is done
+
+        Args:
+            name (str): The step, e.g. "first_paint"
+        """
+        elapsed = time.perf_counter() - self.started
+        self.marks.append((name, elapsed))
+        metrics.record(f"startup.{name}", elapsed)
+        if name == "first_paint":
+            self.loaded_early = [name for name in DEFERRED_MODULES if name in sys.modules]
+
+    def report(self) -> str:
+        lines = ["nitrix startup"]
+        for name, elapsed in self.marks:
+            lines.append(f"  {name.replace('_', ' '):<24} {elapsed * 1000:8.1f} ms")
+        lines.append(f"  {'modules loaded':<24} {len(sys.modules):8}")
+        if self.loaded_early is not None:
+            loaded = ", ".join(self.loaded_early) or "none"
+            lines.append(f"  {'loaded before paint':<24} {loaded:>8}")
+        return "\n".join(lines)
+
+
+startup = StartupProfile()
@@ -0,0 +1,677 @@
+from __future__ import annotations
+
+import re
+import json
+import hashlib
+import sqlite3
+
+from urllib.parse import urlparse
+
+from nio import Event, MatrixRoom, ReceiptEvent, RoomMemberEvent
+from nio.responses import RoomInfo, SyncResponse
+
+from nitrix.timeline import apply_edit, edited_event_id
+from nitrix.utils import NitrixConfig
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS session (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY,
+    prev_batch TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    room_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    state_key TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (room_id, type, state_key)
+);
+CREATE TABLE IF NOT EXISTS events (
+    stream INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT UNIQUE NOT NULL,
+    room_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    origin_server_ts INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    sender TEXT,
+    replaces TEXT
+);
+CREATE INDEX IF NOT EXISTS events_room_ts ON events (room_id, origin_server_ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5 (body);
+CREATE TABLE IF NOT EXISTS unread (
+    room_id TEXT PRIMARY KEY,
+    notifications INTEGER NOT NULL DEFAULT 0,
+    highlights INTEGER NOT NULL DEFAULT 0,
+    read_ts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS gaps (
+    room_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    prev_batch TEXT NOT NULL,
+    origin_server_ts INTEGER NOT NULL,
+    PRIMARY KEY (room_id, event_id)
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    txn_id TEXT PRIMARY KEY,
+    room_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created INTEGER NOT NULL,
+    error TEXT
+);
+"""
+
+# Columns added to tables after they were first shipped, which stores
+# created before then get added when they're opened
+MIGRATIONS = [
+    ("outbox", "error", "TEXT"),
+    ("events", "sender", "TEXT"),
+    ("events", "replaces", "TEXT"),
+]
+
+# The search index. Edits aren't indexed as messages of their own, the
+# message they edit is indexed with the text of its latest edit instead.
+# Bumping SEARCH_VERSION indexes every stored message again on the next start
+SEARCH_VERSION = 1
+LATEST_EDIT = """
+    SELECT edits.source FROM events AS edits
+    WHERE edits.replaces = {event}.event_id AND edits.sender = {event}.sender
+    ORDER BY edits.origin_server_ts DESC LIMIT 1
+"""
+SEARCH_SCHEMA = f"""
+CREATE INDEX IF NOT EXISTS events_sender ON events (sender);
+CREATE INDEX IF NOT EXISTS events_replaces ON events (replaces);
+DROP TRIGGER IF EXISTS events_fts_insert;
+CREATE TRIGGER events_fts_insert AFTER INSERT ON events
+WHEN new.type = 'm.room.message' AND new.replaces IS NULL BEGIN
+    INSERT INTO events_fts (rowid, body) VALUES (new.stream, COALESCE(
+        json_extract(({LATEST_EDIT.format(event="new")}), '$.content."m.new_content".body'),
+        json_extract(new.source, '$.content.body')));
+END;
+DROP TRIGGER IF EXISTS events_fts_edit;
+CREATE TRIGGER events_fts_edit AFTER INSERT ON events
+WHEN new.type = 'm.room.message' AND new.replaces IS NOT NULL BEGIN
+    UPDATE events_fts SET body = COALESCE(json_extract(new.source, '$.content."m.new_content".body'), body)
+    WHERE rowid = (SELECT stream FROM events WHERE event_id = new.replaces AND sender = new.sender)
+    AND NOT EXISTS (
+        SELECT 1 FROM events AS later
+        WHERE later.replaces = new.replaces AND later.sender = new.sender
+        AND later.origin_server_ts > new.origin_server_ts);
+END;
+DROP TRIGGER IF EXISTS events_fts_delete;
+CREATE TRIGGER events_fts_delete AFTER DELETE ON events WHEN old.type = 'm.room.message' BEGIN
+    DELETE FROM events_fts WHERE rowid = old.stream;
+END;
+"""
+
+
+class EventStore():
+    """SQLite store holding the session, room state, timeline events and
+    the last sync token of a single account, so a restart can paint from
+    disk and resume syncing where it left off.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # The sync engine writes from a connection of its own, which this
+        # keeps from holding up reads on this one
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+        for table, column, definition in MIGRATIONS:
+            columns = {row[1] for row in self.connection.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                with self.connection:
+                    self.connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        self.connection.executescript(SEARCH_SCHEMA)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < SEARCH_VERSION:
+            # Stores from before the current search index get theirs built once
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE events SET sender = json_extract(source, '$.sender'), replaces = CASE "
+                    "WHEN json_extract(source, '$.content.\"m.relates_to\".rel_type') = 'm.replace' "
+                    "THEN json_extract(source, '$.content.\"m.relates_to\".event_id') END "
+                    "WHERE sender IS NULL"
+                )
+            self.rebuild_search_index()
+            self.connection.execute(f"PRAGMA user_version = {SEARCH_VERSION}")
+
+    @classmethod
+    def for_account(cls, homeserver: str, username: str) -> EventStore:
+        """Open the store belonging to an account
+
+        Args:
+            homeserver (str): The account's homeserver
+            username (str): The account's username
+
+        Returns:
+            EventStore: The account's store
+        """
+        host = urlparse(homeserver).netloc or homeserver
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", f"{username}_{host}")
+        folder = NitrixConfig().config_folder / "store"
+        folder.mkdir(parents=True, exist_ok=True)
+        return cls(folder / f"{name}.db")
+
+    def close(self):
+        self.connection.close()
+
+    def _get(self, key: str) -> str | None:
+        row = self.connection.execute(
+            "SELECT value FROM session WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str | None):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO session (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def load_session(self, homeserver: str) -> tuple[str, str, str] | None:
+        """Get a previously saved login
+
+        Args:
+            homeserver (str): The homeserver the login has to belong to
+
+        Returns:
+            tuple[str, str, str] | None: User ID, device ID and access token
+        """
+        if self._get("homeserver") != homeserver:
+            return None
+        user_id, device_id, access_token = (
+            self._get("user_id"), self._get("device_id"), self._get("access_token"))
+        if not (user_id and device_id and access_token):
+            return None
+        return user_id, device_id, access_token
+
+    def save_session(self, homeserver: str, user_id: str, device_id: str, access_token: str):
+        """Save a login so it can be reused instead of logging in again
+
+        Args:
+            homeserver (str): The homeserver logged in to
+            user_id (str): The full user ID
+            device_id (str): The device ID of the login
+            access_token (str): The access token of the login
+        """
+        with self.connection:
+            self._set("homeserver", homeserver)
+            self._set("user_id", user_id)
+            self._set("device_id", device_id)
+            self._set("access_token", access_token)
+
+    def clear_session(self):
+        """Forget the saved login. Everything synced through it is kept, along
+        with the sync token, so logging in again carries on where it left off.
+        """
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM session WHERE key IN ('homeserver', 'user_id', 'device_id', 'access_token')")
+
+    @property
+    def sync_token(self) -> str | None:
+        return self._get("next_batch")
+    
+    def sync_filter_id(self, definition: str) -> str | None:
+        """Get the ID of a previously uploaded sync filter
+
+        Args:
+            definition (str): The filter as canonical JSON
+
+        Returns:
+            str | None: The filter ID, None if this filter hasn't been uploaded
+        """
+        return self._get(self._filter_key(definition))
+    
+    def save_sync_filter(self, definition: str, filter_id: str):
+        """Remember the ID the homeserver gave a sync filter
+
+        Args:
+            definition (str): The filter as canonical JSON
+            filter_id (str): The filter ID
+        """
+        with self.connection:
+            self._set(self._filter_key(definition), filter_id)
+
+    @staticmethod
+    def _filter_key(definition: str) -> str:
+        # One ID per filter, so the interface and `nitrix tail` syncing
+        # the same account with different filters don't replace each other's
+        return "sync_filter." + hashlib.sha256(definition.encode()).hexdigest()
+
+    def _save_state(self, room_id: str, source: dict):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO state (room_id, type, state_key, source) VALUES (?, ?, ?, ?)",
+            (room_id, source["type"], source["state_key"], json.dumps(source)),
+        )
+
+    def _save_events(self, room_id: str, events: list[Event]):
+        rows = []
+        for event in events:
+            source = getattr(event, "source", None)
+            if not source or "event_id" not in source:
+                continue
+            if "state_key" in source:
+                self._save_state(room_id, source)
+            rows.append((
+                source["event_id"], room_id, source.get("type", ""),
+                source.get("origin_server_ts", 0), json.dumps(source),
+                source.get("sender"), edited_event_id(source),
+            ))
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO events (event_id, room_id, type, origin_server_ts, source, sender, replaces) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def save_events(self, room_id: str, events: list[Event]):
+        """Save timeline events, e.g. from a /messages response
+
+        Args:
+            room_id (str): The room the events belong to
+            events (list[Event]): The events to save
+        """
+        with self.connection:
+            self._save_events(room_id, events)
+
+    def save_sync(self, response: SyncResponse):
+        """Save the state, timeline events and token of a sync response.
+        Meant to be registered as a response callback.
+
+        Args:
+            response (SyncResponse): The sync response to save
+        """
+        if not isinstance(response, SyncResponse):
+            return
+
+        with self.connection:
+            for room_id, room_info in response.rooms.join.items():
+                self._save_gap(room_id, room_info)
+                # prev_batch is only kept the first time we see a room, it's
+                # the token to paginate backwards from the oldest stored event
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO rooms (room_id, prev_batch) VALUES (?, ?)",
+                    (room_id, room_info.timeline.prev_batch),
+                )
+                for event in room_info.state:
+                    source = getattr(event, "source", None)
+                    if source and "state_key" in source:
+                        self._save_state(room_id, source)
+                self._save_events(room_id, room_info.timeline.events)
+                self._save_unread(room_id, room_info)
+
+            for room_id in response.rooms.leave:
+                for table in ("rooms", "state", "events", "unread", "gaps"):
+                    self.connection.execute(f"DELETE FROM {table} WHERE room_id = ?", (room_id,))
+
+            self._set("next_batch", response.next_batch)
+
+    def _save_gap(self, room_id: str, room_info: RoomInfo):
+        # A limited timeline skipped whatever happened between the last sync
+        # and its first event, unless there's nothing stored to have a hole in
+        timeline = room_info.timeline
+        first = next((getattr(event, "source", {}) for event in timeline.events), {})
+        if not timeline.limited or not timeline.prev_batch or "event_id" not in first:
+            return
+        if self._event_timestamp(first["event_id"]) is not None:
+            return
+        if self.connection.execute("SELECT 1 FROM events WHERE room_id = ? LIMIT 1", (room_id,)).fetchone() is None:
+            return
+        self.connection.execute(
+            "INSERT OR IGNORE INTO gaps (room_id, event_id, prev_batch, origin_server_ts) VALUES (?, ?, ?, ?)",
+            (room_id, first["event_id"], timeline.prev_batch, first.get("origin_server_ts", 0)),
+        )
+
+    def gap_rooms(self) -> list[str]:
+        """Get the rooms with holes in their stored history
+
+        Returns:
+            list[str]: Room IDs
+        """
+        return [room_id for room_id, in self.connection.execute("SELECT DISTINCT room_id FROM gaps")]
+
+    def next_gap(self, room_id: str) -> tuple[str, str] | None:
+        """Get the most recent hole in a room's stored history
+
+        Args:
+            room_id (str): The room
+
+        Returns:
+            tuple[str, str] | None: The event right after the hole and the token to paginate backwards from it, None if there's no hole
+        """
+        return self.connection.execute(
+            "SELECT event_id, prev_batch FROM gaps WHERE room_id = ? ORDER BY origin_server_ts DESC LIMIT 1",
+            (room_id,),
+        ).fetchone()
+
+    def has_event(self, event_id: str) -> bool:
+        return self._event_timestamp(event_id) is not None
+
+    def fill_gap(self, room_id: str, event_id: str, events: list[Event], prev_batch: str | None):
+        """Save the events paginated back from a hole, shrinking or closing it
+
+        Args:
+            room_id (str): The room
+            event_id (str): The event the hole was before
+            events (list[Event]): The missing events, oldest first
+            prev_batch (str | None): Token to paginate further back from the oldest of them, None if the hole is closed
+        """
+        with self.connection:
+            self._save_events(room_id, events)
+            self.connection.execute("DELETE FROM gaps WHERE room_id = ? AND event_id = ?", (room_id, event_id))
+            oldest = next((getattr(event, "source", {}) for event in events), {})
+            if prev_batch and "event_id" in oldest:
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO gaps (room_id, event_id, prev_batch, origin_server_ts) VALUES (?, ?, ?, ?)",
+                    (room_id, oldest["event_id"], prev_batch, oldest.get("origin_server_ts", 0)),
+                )
+
+    def _save_unread(self, room_id: str, room_info: RoomInfo):
+        if (counts := room_info.unread_notifications) is not None:
+            self.connection.execute(
+                "INSERT INTO unread (room_id, notifications, highlights) VALUES (?, ?, ?) "
+                "ON CONFLICT (room_id) DO UPDATE SET "
+                "notifications = COALESCE(?, notifications), highlights = COALESCE(?, highlights)",
+                (room_id, counts.notification_count or 0, counts.highlight_count or 0,
+                 counts.notification_count, counts.highlight_count),
+            )
+        # Our own messages and receipts, from any device, move how far
+        # the room has been read
+        user_id = self._get("user_id")
+        read = [
+            event.server_timestamp for event in room_info.timeline.events
+            if getattr(event, "sender", None) == user_id and hasattr(event, "server_timestamp")
+        ]
+        for event in room_info.ephemeral:
+            if isinstance(event, ReceiptEvent):
+                for receipt in event.receipts:
+                    if receipt.user_id == user_id and receipt.receipt_type.startswith("m.read"):
+                        read.append(self._event_timestamp(receipt.event_id) or receipt.timestamp)
+        if read:
+            self._save_read(room_id, max(read))
+
+    def _save_read(self, room_id: str, timestamp: int):
+        self.connection.execute(
+            "INSERT INTO unread (room_id, read_ts) VALUES (?, ?) "
+            "ON CONFLICT (room_id) DO UPDATE SET read_ts = MAX(read_ts, excluded.read_ts)",
+            (room_id, timestamp),
+        )
+
+    def _event_timestamp(self, event_id: str) -> int | None:
+        row = self.connection.execute(
+            "SELECT origin_server_ts FROM events WHERE event_id = ?", (event_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_read(self, room_id: str, timestamp: int):
+        """Mark a room read up to an event, clearing its counts until the
+        homeserver says otherwise
+
+        Args:
+            room_id (str): The room that was read
+            timestamp (int): Server timestamp of the latest event read in milliseconds
+        """
+        with self.connection:
+            self._save_read(room_id, timestamp)
+            self.connection.execute(
+                "UPDATE unread SET notifications = 0, highlights = 0 WHERE room_id = ?", (room_id,))
+
+    def read_timestamp(self, room_id: str) -> int | None:
+        """Get how far a room has been read
+
+        Args:
+            room_id (str): The room
+
+        Returns:
+            int | None: Server timestamp of the latest event read in milliseconds, None if it isn't known
+        """
+        row = self.connection.execute(
+            "SELECT read_ts FROM unread WHERE room_id = ? AND read_ts > 0", (room_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def load_unread(self) -> dict[str, tuple[int, int, int]]:
+        """Get the unread counts of every room, as of the last sync
+
+        Returns:
+            dict[str, tuple[int, int, int]]: Notification count, highlight count and the server timestamp of the latest event read, keyed by room ID
+        """
+        cursor = self.connection.execute(
+            "SELECT room_id, notifications, highlights, read_ts FROM unread")
+        return {room_id: (notifications, highlights, read_ts) for room_id, notifications, highlights, read_ts in cursor}
+
+    def save_outgoing(self, room_id: str, txn_id: str, content: dict, created: int):
+        """Keep a message that hasn't been sent yet
+
+        Args:
+            room_id (str): The room the message goes to
+            txn_id (str): The message's transaction ID
+            content (dict): The event content
+            created (int): When the message was written, in milliseconds since the epoch
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outbox (txn_id, room_id, content, created) VALUES (?, ?, ?, ?)",
+                (txn_id, room_id, json.dumps(content), created),
+            )
+
+    def set_outgoing_error(self, txn_id: str, error: str | None):
+        """Mark a message as failed to send, or as queued again to retry it
+
+        Args:
+            txn_id (str): The message's transaction ID
+            error (str | None): Why it failed, None once it's queued again
+        """
+        with self.connection:
+            self.connection.execute("UPDATE outbox SET error = ? WHERE txn_id = ?", (error, txn_id))
+
+    def remove_outgoing(self, txn_id: str):
+        """Forget a message once it's been sent
+
+        Args:
+            txn_id (str): The message's transaction ID
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM outbox WHERE txn_id = ?", (txn_id,))
+
+    def load_outgoing(self) -> list[tuple[str, str, dict, int, str | None]]:
+        """Get the messages that haven't been sent yet
+
+        Returns:
+            list[tuple[str, str, dict, int, str | None]]: Room ID, transaction ID, content, creation time and the error of failed messages, oldest first
+        """
+        cursor = self.connection.execute(
+            "SELECT room_id, txn_id, content, created, error FROM outbox ORDER BY rowid")
+        return [
+            (room_id, txn_id, json.loads(content), created, error)
+            for room_id, txn_id, content, created, error in cursor
+        ]
+
+    def load_rooms(self, own_user_id: str) -> dict[str, MatrixRoom]:
+        """Rebuild the joined rooms from their stored state
+
+        Args:
+            own_user_id (str): The user ID of the account
+
+        Returns:
+            dict[str, MatrixRoom]: The rooms, keyed by room ID
+        """
+        rooms = {}
+        for room_id, in self.connection.execute("SELECT room_id FROM rooms"):
+            rooms[room_id] = MatrixRoom(room_id, own_user_id)
+
+        cursor = self.connection.execute("SELECT room_id, source FROM state")
+        for room_id, source in cursor:
+            if room_id not in rooms:
+                continue
+            event = Event.parse_event(json.loads(source))
+            if isinstance(event, RoomMemberEvent):
+                rooms[room_id].handle_membership(event)
+            elif isinstance(event, Event):
+                rooms[room_id].handle_event(event)
+
+        for room_id, (notifications, highlights, _) in self.load_unread().items():
+            if room_id in rooms:
+                rooms[room_id].unread_notifications = notifications
+                rooms[room_id].unread_highlights = highlights
+        return rooms
+
+    def prev_batch(self, room_id: str) -> str | None:
+        """Get the token to paginate backwards from the oldest stored event
+
+        Args:
+            room_id (str): The room to get the token of
+
+        Returns:
+            str | None: The pagination token
+        """
+        row = self.connection.execute(
+            "SELECT prev_batch FROM rooms WHERE room_id = ?", (room_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_prev_batch(self, room_id: str, token: str | None):
+        """Set the token to paginate backwards from the oldest stored event
+
+        Args:
+            room_id (str): The room to set the token of
+            token (str | None): The pagination token, None once the start of the room is reached
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO rooms (room_id, prev_batch) VALUES (?, ?)",
+                (room_id, token),
+            )
+
+    def room_activity(self) -> dict[str, int]:
+        """Get the timestamp of the latest stored event of every room
+
+        Returns:
+            dict[str, int]: Server timestamps in milliseconds, keyed by room ID
+        """
+        cursor = self.connection.execute(
+            "SELECT room_id, MAX(origin_server_ts) FROM events GROUP BY room_id")
+        return dict(cursor)
+
+    def load_events(self, room_id: str, limit: int | None = 25, before: str | None = None, since: str | None = None) -> list[Event]:
+        """Get the latest stored messages of a room
+
+        Args:
+            room_id (str): The room to get the messages of
+            limit (int | None, optional): The maximum number of messages, None for no limit. Defaults to 25.
+            before (str | None, optional): Only get messages older than this event ID. Defaults to None.
+            since (str | None, optional): Only get this event ID and the messages after it. Defaults to None.
+
+        Returns:
+            list[Event]: The messages with their latest edits applied, oldest first
+        """
+        # Edits come applied to the messages they edit rather than on their own
+        query = (
+            f"SELECT source, ({LATEST_EDIT.format(event='events')}) FROM events "
+            "WHERE room_id = ? AND type = 'm.room.message' AND replaces IS NULL "
+        )
+        params = [room_id]
+        if before and not self.connection.execute("SELECT 1 FROM events WHERE event_id = ?", (before,)).fetchone():
+            # e.g. a local echo at the top of the timeline, page back from
+            # the newest stored message instead of getting nothing
+            before = None
+        if before:
+            query += (
+                "AND (origin_server_ts, stream) < "
+                "(SELECT origin_server_ts, stream FROM events WHERE event_id = ?) "
+            )
+            params.append(before)
+        if since:
+            query += (
+                "AND (origin_server_ts, stream) >= "
+                "(SELECT origin_server_ts, stream FROM events WHERE event_id = ?) "
+            )
+            params.append(since)
+        query += "ORDER BY origin_server_ts DESC, stream DESC LIMIT ?"
+        params.append(-1 if limit is None else limit)
+
+        events = []
+        for source, edit in self.connection.execute(query, params):
+            event = Event.parse_event(json.loads(source))
+            if edit is not None:
+                apply_edit(event, json.loads(edit))
+            events.append(event)
+        events.reverse()
+        return events
+
+    def rebuild_search_index(self):
+        """Index the body of every stored message again"""
+        with self.connection:
+            self.connection.execute("DELETE FROM events_fts")
+            self.connection.execute(
+                "INSERT INTO events_fts (rowid, body) SELECT stream, COALESCE("
+                f"json_extract(({LATEST_EDIT.format(event='events')}), '$.content.\"m.new_content\".body'), "
+                "json_extract(source, '$.content.body')) "
+                "FROM events WHERE type = 'm.room.message' AND replaces IS NULL"
+            )
+
+    def search(
+        self, query: str, room_id: str | None = None, sender: str | None = None,
+        since: int | None = None, until: int | None = None, limit: int = 50,
+    ) -> list[tuple[str, Event]]:
+        """Full text search through every stored message. Matches are ranked
+        by relevance, best first, and the last word of the query matches as a
+        prefix so results come up while typing. Edited messages match on and
+        come back with the text of their latest edit.
+
+        Args:
+            query (str): Words the messages have to contain
+            room_id (str | None, optional): Only search this room. Defaults to None.
+            sender (str | None, optional): Only search messages from this user ID, or from user IDs starting with it if it has no server name. Defaults to None.
+            since (int | None, optional): Only search messages from this timestamp on, in milliseconds. Defaults to None.
+            until (int | None, optional): Only search messages before this timestamp, in milliseconds. Defaults to None.
+            limit (int, optional): The maximum number of results. Defaults to 50.
+
+        Returns:
+            list[tuple[str, Event]]: Room ID and message of every result
+        """
+        words = query.split()
+        if not words:
+            return []
+        # Quoted, so whatever's typed is searched for rather than read as FTS syntax
+        match = " ".join('"' + word.replace('"', '""') + '"' for word in words) + "*"
+
+        sql = (
+            f"SELECT events.room_id, events.source, ({LATEST_EDIT.format(event='events')}) FROM events_fts "
+            "JOIN events ON events.stream = events_fts.rowid WHERE events_fts MATCH ? "
+        )
+        params: list = [match]
+        if room_id:
+            sql += "AND events.room_id = ? "
+            params.append(room_id)
+        if sender:
+            sender = sender if sender.startswith("@") else "@" + sender
+            if ":" in sender:
+                sql += "AND events.sender = ? "
+                params.append(sender)
+            else:
+                # A range rather than LIKE, so the sender index can be used
+                sql += "AND events.sender >= ? AND events.sender < ? "
+                params += [sender, sender + "\U0010ffff"]
+        if since is not None:
+            sql += "AND events.origin_server_ts >= ? "
+            params.append(since)
+        if until is not None:
+            sql += "AND events.origin_server_ts < ? "
+            params.append(until)
+        sql += "ORDER BY events_fts.rank LIMIT ?"
+        params.append(limit)
+
+        try:
+            cursor = self.connection.execute(sql, params)
+        except sqlite3.OperationalError:
+            # Whatever is left of the query after quoting can still be unsearchable
+            return []
+        results = []
+        for room_id, source, edit in cursor:
+            event = Event.parse_event(json.loads(source))
+            if edit is not None:
+                apply_edit(event, json.loads(edit))
+            results.append((room_id, event))
+        return results
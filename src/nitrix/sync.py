@@ -0,0 +1,273 @@
+"""
+    Sync engine keeping network I/O, response parsing and saving to the
+    store away from the event loop Textual renders and handles input on.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+
+from dataclasses import dataclass
+
+from aiohttp import ClientConnectionError
+from nio import Api, AsyncClient, ErrorResponse
+from nio.responses import DeviceList, Rooms, SyncResponse
+
+from nitrix.connections import ConnectionPool
+from nitrix.metrics import metrics
+from nitrix.store import EventStore
+
+logger = logging.getLogger(__name__)
+
+
+class SyncThread():
+    """A thread running its own event loop, which the sync engines of
+    every account can share along with one connection pool
+    """
+
+    def __init__(self):
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.connections = ConnectionPool()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self):
+        """Start the thread, unless it's already running"""
+        if self.thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="nitrix-sync", daemon=True)
+        self.thread.start()
+
+    async def run(self, coroutine):
+        """Run a coroutine on the thread's loop and wait for its result
+
+        Args:
+            coroutine (Coroutine): The coroutine to run
+        """
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    async def stop(self):
+        """Close the pooled connections and shut the thread down"""
+        if self.thread is None:
+            return
+        await self.run(self.connections.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        await asyncio.to_thread(self.thread.join)
+        self.loop.close()
+        self.thread = None
+
+
+@dataclass
+class SyncBatch(SyncResponse):
+    """Some of the rooms of a sync response too big to apply in one go.
+    Only the first part carries what isn't per room, like to-device events
+    and invites.
+    """
+
+    part: int = 0
+
+
+class SyncEngine():
+    """Long-polls /sync from a dedicated thread with its own event loop.
+
+    The thread does the HTTP round trip, decodes the JSON, builds the nio
+    response objects and saves them to the store through a connection of
+    its own. Big responses are then cut into batches of whole rooms, and
+    handed to the app's loop through a bounded queue, where only applying
+    them to the client state and running the response callbacks is left
+    to do, a batch at a time with input and repaints let in between. While
+    the queue is full the thread stops syncing, so a flood of events waits
+    on the homeserver instead of piling up in front of input handling.
+
+    Args:
+        client (AsyncClient): The logged in client the responses are for
+        sync_filter (str | None, optional): Filter ID to sync with. Defaults to None.
+        timeout (int, optional): Long-poll timeout in milliseconds. Defaults to 30000.
+        queue_size (int, optional): Parsed batches allowed to wait for the app. Defaults to 2.
+        thread (SyncThread | None, optional): Thread shared with other accounts. Defaults to a thread of its own.
+    """
+
+    # Seconds to wait before retrying after a failed sync, doubling with
+    # every failure in a row up to MAX_RETRY_DELAY
+    RETRY_DELAY = 5
+    MAX_RETRY_DELAY = 60
+
+    # Timeline and state events per batch, rooms are never split
+    BATCH_EVENTS = 200
+
+    # Errors retrying won't fix, the engine stops on them
+    FATAL_ERRORS = {"M_UNKNOWN_TOKEN", "M_MISSING_TOKEN", "M_USER_DEACTIVATED"}
+
+    def __init__(self, client: AsyncClient, sync_filter: str | None = None, timeout: int = 30000, queue_size: int = 2, thread: SyncThread | None = None):
+        self.client = client
+        self.sync_filter = sync_filter
+        self.timeout = timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.app_loop: asyncio.AbstractEventLoop | None = None
+        self.thread = thread or SyncThread()
+        self._owns_thread = thread is None
+        self._http: AsyncClient | None = None
+        # The thread's own connection to the client's store
+        self._store: EventStore | None = None
+        self._poll: asyncio.Future | None = None
+        # What stopped the engine, if anything did
+        self.error: ErrorResponse | None = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop | None:
+        return self.thread.loop
+
+    def start(self):
+        """Start the engine's thread if it isn't running yet, to be called from the app's loop"""
+        self.app_loop = asyncio.get_running_loop()
+        self.thread.start()
+
+    async def stop(self):
+        """Stop syncing, shutting the thread down if it isn't shared"""
+        if not self.thread.running:
+            return
+        if self._poll is not None:
+            self._poll.cancel()
+        await self.thread.run(self._close())
+        if self._owns_thread:
+            await self.thread.stop()
+
+    async def fetch(self, since: str | None = None, timeout: int | None = 0, sync_filter: str | dict | None = None) -> SyncResponse | ErrorResponse:
+        """Do a single sync on the engine's thread
+
+        Args:
+            since (str | None, optional): Sync token to sync from. Defaults to None.
+            timeout (int | None, optional): Long-poll timeout in milliseconds. Defaults to 0.
+            sync_filter (str | dict | None, optional): Filter to sync with. Defaults to the engine's filter.
+
+        Returns:
+            SyncResponse | ErrorResponse: The parsed response, saved to the store but not yet applied to the client
+        """
+        return await self.thread.run(self._fetch(since, timeout, sync_filter or self.sync_filter))
+
+    def is_fatal(self, response: SyncResponse | ErrorResponse) -> bool:
+        return isinstance(response, ErrorResponse) and response.status_code in self.FATAL_ERRORS
+
+    async def sync_forever(self):
+        """Keep syncing, applying each response on the app's loop as it's
+        taken off the queue. Stands in for `AsyncClient.sync_forever`.
+        Returns when the homeserver gives an error retrying won't fix,
+        which is passed to the response callbacks and kept in `error`.
+        """
+        self._poll = asyncio.run_coroutine_threadsafe(self._poll_forever(self.client.next_batch), self.loop)
+        while True:
+            response = await self.queue.get()
+            if isinstance(response, SyncBatch) and response.part:
+                # The parts of a response share its token, which nio takes
+                # for the same response coming in twice
+                self.client.next_batch = None
+            if isinstance(response, SyncResponse):
+                await self.client.receive_response(response)
+            await self.client.run_response_callbacks([response])
+            if self.is_fatal(response):
+                self.error = response
+                return
+            # Let input and repaints in before the next response
+            await asyncio.sleep(0)
+
+    async def _fetch(self, since: str | None, timeout: int | None, sync_filter: str | dict | None) -> SyncResponse | ErrorResponse:
+        if self._http is None:
+            # The HTTP session has to belong to this thread's loop
+            self._http = AsyncClient(self.client.homeserver, self.client.user_id, self.client.device_id)
+            self.thread.connections.attach(self._http)
+        method, path = Api.sync(self.client.access_token, since=since, timeout=timeout or None, filter=sync_filter)
+        headers = {"Authorization": f"Bearer {self.client.access_token}"}
+        with metrics.timer("sync.round_trip"):
+            # Give the homeserver a chance to return on its own before timing out
+            transport_response = await self._http.send(
+                method, path, headers=headers, timeout=timeout / 1000 + 15 if timeout else 0)
+            with metrics.timer("parse.SyncResponse"):
+                response = await self._http.create_matrix_response(SyncResponse, transport_response)
+        if self.client.recorder is not None:
+            await self.client.recorder.add(SyncResponse, transport_response)
+        if isinstance(response, SyncResponse):
+            if self._store is None:
+                self._store = EventStore(self.client.event_store.path)
+            with metrics.timer("sync.save"):
+                self._store.save_sync(response)
+        return response
+
+    def split(self, response: SyncResponse) -> list[SyncResponse]:
+        """Cut a sync response into batches of whole rooms with about
+        BATCH_EVENTS events each
+
+        Args:
+            response (SyncResponse): The sync response
+
+        Returns:
+            list[SyncResponse]: The batches, the response itself if it's small enough
+        """
+        parts: list[dict] = [{}]
+        events = 0
+        for room_id, room_info in response.rooms.join.items():
+            size = len(room_info.timeline.events) + len(room_info.state)
+            if parts[-1] and events + size > self.BATCH_EVENTS:
+                parts.append({})
+                events = 0
+            parts[-1][room_id] = room_info
+            events += size
+        if len(parts) == 1:
+            return [response]
+
+        metrics.increment("sync.batches", len(parts))
+        batches = [SyncBatch(
+            response.next_batch, Rooms(response.rooms.invite, parts[0], response.rooms.leave),
+            response.device_key_count, response.device_list, response.to_device_events,
+            response.presence_events, response.account_data_events,
+        )]
+        for part, join in enumerate(parts[1:], 1):
+            batches.append(SyncBatch(
+                response.next_batch, Rooms({}, join, {}), response.device_key_count,
+                DeviceList([], []), [], [], [], part=part,
+            ))
+        return batches
+
+    async def _poll_forever(self, since: str | None):
+        delay = self.RETRY_DELAY
+        while True:
+            try:
+                response = await self._fetch(since, self.timeout, self.sync_filter)
+            except (ClientConnectionError, asyncio.TimeoutError):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+                continue
+            except Exception:
+                # e.g. a truncated or malformed response. Nothing awaits this
+                # coroutine, so anything raised here would stop syncing silently
+                logger.exception("Sync failed, retrying in %ss", delay)
+                metrics.increment("sync.failed")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+                continue
+
+            # Blocks while the app is behind, which holds off the next sync
+            batches = self.split(response) if isinstance(response, SyncResponse) else [response]
+            for batch in batches:
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self.queue.put(batch), self.app_loop))
+            if self.is_fatal(response):
+                return
+            if isinstance(response, ErrorResponse):
+                await asyncio.sleep((response.retry_after_ms or delay * 1000) / 1000)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+                continue
+            delay = self.RETRY_DELAY
+            since = response.next_batch
+
+    async def _close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        if self._store is not None:
+            self._store.close()
+            self._store = None
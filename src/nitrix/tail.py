@@ -0,0 +1,234 @@
+"""
+    Headless streaming mode. Logs in with the saved credentials, streams
+    the timeline events of the chosen rooms to stdout as JSON lines and
+    sends every line read from stdin, all without loading Textual.
+
+    nitrix tail [--room ROOM]... [--type TYPE]... [--timeline-limit 1000] [--flush-interval 0.1]
+"""
+
+from __future__ import annotations
+
+import sys
+import json
+import asyncio
+import argparse
+import threading
+
+from typing import TextIO
+
+from nio import MatrixRoom
+from nio.responses import SyncResponse
+
+from nitrix.client import NitrixClient, client_factory
+from nitrix.metrics import metrics
+from nitrix.utils import NitrixConfig
+
+
+class JsonlWriter():
+    """Writes events as JSON lines, batching the lines of every sync into
+    one write and coalescing flushes
+
+    Args:
+        stream (TextIO): Where the lines go
+        rooms (set[str] | None, optional): Room IDs to stream, None for every room. Defaults to None.
+        types (set[str] | None, optional): Event types to stream, None for every type. Defaults to None.
+        flush_interval (float, optional): Seconds a written line can wait to be flushed. Defaults to 0.1.
+    """
+
+    def __init__(self, stream: TextIO, rooms: set[str] | None = None, types: set[str] | None = None, flush_interval: float = 0.1):
+        self.stream = stream
+        self.rooms = rooms
+        self.types = types
+        self.flush_interval = flush_interval
+        self.closed = False
+        self._flush_pending = False
+
+    def on_sync(self, response: SyncResponse):
+        """Response callback writing out the timeline events of a sync
+
+        Args:
+            response (SyncResponse): The sync response
+        """
+        lines = []
+        for room_id, room_info in response.rooms.join.items():
+            if self.rooms is not None and room_id not in self.rooms:
+                continue
+            timeline = room_info.timeline
+            if timeline.limited:
+                # The homeserver left events out, let the reader know there's a hole
+                lines.append(json.dumps({"type": "nitrix.gap", "room_id": room_id, "prev_batch": timeline.prev_batch}))
+            for event in timeline.events:
+                source = getattr(event, "source", None)
+                if not source or (self.types is not None and source.get("type") not in self.types):
+                    continue
+                lines.append(json.dumps({"room_id": room_id, **source}))
+        if lines:
+            metrics.increment("tail.events", len(lines))
+            self.write(lines)
+
+    def write(self, lines: list[str]):
+        """Write lines, flushing them within `flush_interval`
+
+        Args:
+            lines (list[str]): Lines without their line endings
+        """
+        if self.closed:
+            return
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+        except BrokenPipeError:
+            # Whoever was reading has gone, e.g. piped into head
+            self.closed = True
+            return
+        if not self._flush_pending:
+            self._flush_pending = True
+            asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self._flush_pending = False
+        if self.closed:
+            return
+        try:
+            self.stream.flush()
+        except BrokenPipeError:
+            self.closed = True
+
+
+def parse_outgoing(line: str, default_room: str | None) -> tuple[str, dict] | None:
+    """Turn a line from stdin into a message to send. A line is either
+    plain text for the only room being streamed, or a JSON object with a
+    `room_id` and either a `body` or a full event `content`.
+
+    Args:
+        line (str): The line, without its line ending
+        default_room (str | None): The room plain text goes to
+
+    Returns:
+        tuple[str, dict] | None: Room ID and event content, None if the line can't be sent
+    """
+    if not line.strip():
+        return None
+    if line.lstrip().startswith("{"):
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        room_id = data.get("room_id") or default_room
+        content = data.get("content") or {"msgtype": "m.text", "body": data.get("body")}
+        if not room_id or not isinstance(content, dict) or content.get("body") is None:
+            return None
+        return room_id, content
+    if default_room is None:
+        return None
+    return default_room, {"msgtype": "m.text", "body": line}
+
+
+def resolve_room(rooms: dict[str, MatrixRoom], name: str) -> str | None:
+    """Find a joined room by its ID, canonical alias or display name
+
+    Args:
+        rooms (dict[str, MatrixRoom]): The joined rooms
+        name (str): What the room was given as
+
+    Returns:
+        str | None: The room ID, None if no room matched
+    """
+    if name in rooms:
+        return name
+    for room_id, room in rooms.items():
+        if name in (room.canonical_alias, room.display_name):
+            return room_id
+    return None
+
+
+async def send_stdin(client: NitrixClient, default_room: str | None):
+    """Send every line read from stdin through the outbox until stdin closes
+
+    Args:
+        client (NitrixClient): The logged in client
+        default_room (str | None): The room plain text lines go to
+    """
+    loop = asyncio.get_running_loop()
+    lines: asyncio.Queue[str | None] = asyncio.Queue()
+
+    def read():
+        # A daemon thread, so a blocked read never holds up exiting
+        try:
+            for line in sys.stdin:
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            loop.call_soon_threadsafe(lines.put_nowait, None)
+        except RuntimeError:
+            # The loop closed while we were reading
+            pass
+
+    threading.Thread(target=read, name="nitrix-stdin", daemon=True).start()
+    while (line := await lines.get()) is not None:
+        if (outgoing := parse_outgoing(line.rstrip("\n"), default_room)) is None:
+            print(f"nitrix tail: can't send {line.strip()!r}", file=sys.stderr)
+            continue
+        client.outbox.send(*outgoing)
+
+
+async def run(options: argparse.Namespace) -> int:
+    config = NitrixConfig()
+    metrics.configure(
+        config.get_flag("Performance", "metrics"),
+        config.get_config("Performance", "metrics_export"),
+    )
+    homeserver = config.get_config("Credentials", "homeserver")
+    username = config.get_config("Credentials", "username")
+    password = config.get_config("Credentials", "password")
+    if not (homeserver and username and password):
+        print("nitrix tail: log in with nitrix and remember the login first", file=sys.stderr)
+        return 2
+
+    # The UI's filter leaves out every type it doesn't show, tail syncs
+    # exactly the types asked for
+    client = await client_factory(
+        homeserver, username, password, timeline_limit=options.timeline_limit,
+        timeline_types=sorted(options.type) if options.type else None)
+    if client is None:
+        print("nitrix tail: could not log in", file=sys.stderr)
+        return 1
+
+    try:
+        rooms = None
+        if options.room:
+            rooms = set()
+            for name in options.room:
+                if (room_id := resolve_room(client.rooms, name)) is None:
+                    print(f"nitrix tail: not in a room called {name}", file=sys.stderr)
+                    return 2
+                rooms.add(room_id)
+
+        writer = JsonlWriter(
+            sys.stdout, rooms, set(options.type) if options.type else None, options.flush_interval)
+        client.add_response_callback(writer.on_sync, SyncResponse)
+
+        reader = None
+        if not options.no_stdin:
+            reader = asyncio.get_event_loop().create_task(
+                send_stdin(client, next(iter(rooms)) if rooms and len(rooms) == 1 else None))
+        while not writer.closed:
+            await asyncio.sleep(options.flush_interval)
+        if reader is not None:
+            reader.cancel()
+        return 0
+    finally:
+        await client.close()
+        client.event_store.close()
+        metrics.flush()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="nitrix tail", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--room", "-r", action="append", help="Room ID, alias or name to stream, can be repeated. Defaults to every room")
+    parser.add_argument("--type", "-t", action="append", help="Event type to stream, can be repeated. Defaults to every type")
+    parser.add_argument("--timeline-limit", type=int, default=1000, help="Events per room per sync before the homeserver leaves a gap")
+    parser.add_argument("--flush-interval", type=float, default=0.1, help="Seconds output can wait before being flushed")
+    parser.add_argument("--no-stdin", action="store_true", help="Don't send the lines read from stdin")
+    options = parser.parse_args(argv)
+    try:
+        return asyncio.run(run(options))
+    except KeyboardInterrupt:
+        return 130
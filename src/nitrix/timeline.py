@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import bisect
+import itertools
+
+from nio import Event
+
+
+def edited_event_id(source: dict) -> str | None:
+    """The event an `m.replace` edit edits, None if the event isn't an edit"""
+    content = source.get("content")
+    relation = content.get("m.relates_to") if isinstance(content, dict) else None
+    if isinstance(relation, dict) and relation.get("rel_type") == "m.replace":
+        return relation.get("event_id")
+    return None
+
+
+def apply_edit(original: Event, edit: dict) -> bool:
+    """Replace the content of a message with that of an edit to it
+
+    Args:
+        original (Event): The message that was edited
+        edit (dict): The source of the `m.replace` edit
+
+    Returns:
+        bool: False if the edit has no new content or was sent by someone else
+    """
+    new_content = edit.get("content", {}).get("m.new_content")
+    if not isinstance(new_content, dict) or edit.get("sender") != original.sender:
+        return False
+    original.body = new_content.get("body", getattr(original, "body", None))
+    original.format = new_content.get("format")
+    original.formatted_body = new_content.get("formatted_body")
+    return True
+
+
+class RoomTimeline():
+    """The events of a single room, de-duplicated and kept in order.
+
+    Events are ordered by server timestamp, falling back to the order they
+    were added in. Live events land at the end in constant time, while
+    back-filled and late events are slotted in where they belong.
+    """
+
+    def __init__(self):
+        self.events: list[Event] = []
+        # Event ID -> sort key, the key finding the event in _keys by bisection
+        self.event_ids: dict[str, tuple[int, int]] = {}
+        self._keys: list[tuple[int, int]] = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __getitem__(self, index):
+        return self.events[index]
+
+    def __contains__(self, event_id: str) -> bool:
+        return event_id in self.event_ids
+
+    def index(self, event_id: str) -> int | None:
+        """Find the position of an event
+
+        Args:
+            event_id (str): The event ID to look for
+
+        Returns:
+            int | None: The index of the event, None if it isn't in the timeline
+        """
+        if (key := self.event_ids.get(event_id)) is None:
+            return None
+        index = bisect.bisect_left(self._keys, key)
+        # Keys only repeat if a prepended batch reused a counter value, step over the twins
+        while self.events[index].event_id != event_id:
+            index += 1
+        return index
+
+    def _key(self, event: Event) -> tuple[int, int]:
+        return (getattr(event, "server_timestamp", 0), next(self._counter))
+
+    def add(self, event: Event) -> int | None:
+        """Add an event where it belongs in the timeline
+
+        Args:
+            event (Event): The event to add
+
+        Returns:
+            int | None: The index the event was added at, None if it was already there
+        """
+        if event.event_id in self.event_ids:
+            return None
+        key = self.event_ids[event.event_id] = self._key(event)
+        if not self._keys or key >= self._keys[-1]:
+            self._keys.append(key)
+            self.events.append(event)
+            return len(self.events) - 1
+
+        index = bisect.bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self.events.insert(index, event)
+        return index
+
+    def replace(self, event_id: str, event: Event) -> int | None:
+        """Swap an event for another one in the same spot, e.g. a local echo
+        for the real event
+
+        Args:
+            event_id (str): The event ID of the event to swap out
+            event (Event): The event to put in its place
+
+        Returns:
+            int | None: The index of the event, None if there was nothing to swap out
+        """
+        index = self.index(event_id)
+        if index is None:
+            return None
+        self.event_ids[event.event_id] = self.event_ids.pop(event_id)
+        self.events[index] = event
+        return index
+
+    def prepend(self, events: list[Event]) -> bool:
+        """Add a batch of events that are all older than the current oldest event
+
+        Args:
+            events (list[Event]): The events to add, oldest first, none of them already in the timeline
+
+        Returns:
+            bool: False, leaving the timeline as is, if the events aren't all older
+        """
+        if not events:
+            return True
+        timestamps = [getattr(event, "server_timestamp", 0) for event in events]
+        if timestamps != sorted(timestamps) or (self._keys and timestamps[-1] > self._keys[0][0]):
+            return False
+
+        # Older events sort before anything added so far with the same timestamp
+        start = self._keys[0][1] - len(events) if self._keys else 0
+        keys = [(timestamp, start + i) for i, timestamp in enumerate(timestamps)]
+        self._keys[:0] = keys
+        self.events[:0] = events
+        self.event_ids.update(zip((event.event_id for event in events), keys))
+        return True
+
+    def trim(self, keep: int) -> list[Event]:
+        """Drop the oldest events, keeping only the latest ones
+
+        Args:
+            keep (int): The number of events to keep
+
+        Returns:
+            list[Event]: The dropped events, oldest first
+        """
+        if len(self.events) <= keep:
+            return []
+        cut = len(self.events) - keep
+        dropped = self.events[:cut]
+        del self.events[:cut]
+        del self._keys[:cut]
+        for event in dropped:
+            del self.event_ids[event.event_id]
+        return dropped
@@ -4,15 +4,18 @@ import os
 import pathlib
 import hashlib
 import platform
+import functools
 import configparser
 
 from typing import Any
 
 class NitrixConfig():
     
-    def __init__(self):
-        self.config = configparser.ConfigParser()
+    # Parsed config files and when they were last modified, shared by every
+    # instance so a file is only read again once it changes
+    _parsed: dict[pathlib.Path, tuple[float, configparser.ConfigParser]] = {}
 
+    def __init__(self):
         if platform.system() == 'Linux':
             self.config_folder = pathlib.Path(os.path.expanduser('~') + "/.nitrix/")
         elif platform.system() == 'Windows':
@@ -21,8 +24,16 @@ class NitrixConfig():
             raise NotImplementedError("Config not implemented for this OS")
         
         os.makedirs(self.config_folder, exist_ok=True)
-        if os.path.exists(self.config_folder / 'config'):
-            self.config.read(self.config_folder / 'config')
+        path = self.config_folder / 'config'
+        modified = path.stat().st_mtime if path.exists() else 0.0
+        cached = self._parsed.get(path)
+        if cached is not None and cached[0] == modified:
+            self.config = cached[1]
+            return
+        self.config = configparser.ConfigParser()
+        if modified:
+            self.config.read(path)
+        self._parsed[path] = (modified, self.config)
     
     def add_config(self, section: str, key: str, value: Any):
         """Add a configuration key/value to a section
@@ -34,8 +45,7 @@ class NitrixConfig():
         """
         section_data = self.get_section(section)
         section_data.update({key: value})
-        with open(self.config_folder / 'config', 'w') as fil:
-            self.config.write(fil)
+        self._save()
             
     def add_configs(self, section: str, data: dict[str, Any]):
         """Add multiple configurations to a section at once
@@ -46,8 +56,13 @@ class NitrixConfig():
         """
         section_data = self.get_section(section)
         section_data.update(data)
-        with open(self.config_folder / 'config', 'w') as fil:
+        self._save()
+        
+    def _save(self):
+        path = self.config_folder / 'config'
+        with open(path, 'w') as fil:
             self.config.write(fil)
+        self._parsed[path] = (path.stat().st_mtime, self.config)
         
     def get_section(self, section: str):
         if not section in self.config:
@@ -57,6 +72,40 @@ class NitrixConfig():
     def get_config(self, section: str, key: str):
         return self.config.get(section, key, fallback=None)
     
+    def get_accounts(self) -> list[tuple[str, str, str]]:
+        """Get the saved login of every account. The `Credentials` section
+        holds the main account, any others go in `Credentials.<name>` sections
+
+        Returns:
+            list[tuple[str, str, str]]: Homeserver, username and password, main account first
+        """
+        sections = [
+            section for section in self.config.sections()
+            if section == "Credentials" or section.startswith("Credentials.")
+        ]
+        accounts = []
+        for section in sorted(sections, key=lambda section: section != "Credentials"):
+            login = tuple(self.get_config(section, key) for key in ("homeserver", "username", "password"))
+            if all(login):
+                accounts.append(login)
+        return accounts
+    
+    def get_flag(self, section: str, key: str, default: bool = False) -> bool:
+        """Get an on/off configuration
+
+        Args:
+            section (str): Section header the configuration is under
+            key (str): Key of the configuration
+            default (bool, optional): Value when it isn't configured. Defaults to False.
+
+        Returns:
+            bool: Whether the configuration is turned on
+        """
+        value = self.get_config(section, key)
+        if value is None:
+            return default
+        return value.strip().lower() in ("on", "true", "yes", "1")
+    
     
 def clean_room_id(room_id: str):
         if not room_id:
@@ -66,6 +115,7 @@ def clean_room_id(room_id: str):
         room_id = room_id.replace(".", "_")
         return room_id
     
+@functools.lru_cache(maxsize=4096)
 def get_user_id_colour(user_id: str):
     MIN, MAX = 1, 6
     hashed = hashlib.md5(user_id.encode()).hexdigest()